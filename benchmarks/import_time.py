@@ -0,0 +1,86 @@
+#!/usr/bin/env python3
+"""
+import_time
+
+Measures the time it takes a fresh interpreter to import parts of the
+`hyper_systems` package.
+
+    python benchmarks/import_time.py [-n RUNS] [module ...]
+
+Each import is timed in a new python process, the minimum and median over the
+runs are reported. `-v` also prints the slowest modules loaded by each import,
+from `python -X importtime`.
+"""
+import argparse
+import os
+import statistics
+import subprocess
+import sys
+
+PROJECT_ROOT = os.path.dirname(os.path.dirname(os.path.realpath(__file__)))
+
+MODULES = [
+    "hyper_systems",
+    "hyper_systems.http",
+    "from hyper_systems.http import Client",
+    "from hyper_systems.devices import Device",
+    "from hyper_systems.storage import MessageLog",
+]
+
+TIMER = """
+import time
+start = time.perf_counter()
+%s
+print(time.perf_counter() - start)
+"""
+
+
+def statement(module):
+    return module if module.startswith("from ") else "import " + module
+
+
+def time_import(module, runs):
+    times = []
+    for _ in range(runs):
+        output = subprocess.check_output(
+            [sys.executable, "-c", TIMER % statement(module)], cwd=PROJECT_ROOT
+        )
+        times.append(float(output))
+    return times
+
+
+def slowest_modules(module, count=5):
+    output = subprocess.run(
+        [sys.executable, "-X", "importtime", "-c", statement(module)],
+        cwd=PROJECT_ROOT,
+        stderr=subprocess.PIPE,
+        universal_newlines=True,
+        check=True,
+    ).stderr
+    rows = []
+    for line in output.splitlines()[1:]:
+        (_self_us, cumulative_us, name) = line.split(":", 1)[1].split("|")
+        rows.append((int(cumulative_us), name.strip()))
+    return sorted(rows, reverse=True)[:count]
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split("\n\n")[1])
+    parser.add_argument("modules", nargs="*", default=MODULES)
+    parser.add_argument("-n", "--runs", type=int, default=10)
+    parser.add_argument("-v", "--verbose", action="store_true")
+    args = parser.parse_args()
+
+    for module in args.modules:
+        times = time_import(module, args.runs)
+        print(
+            "%-45s min %7.2fms  median %7.2fms"
+            % (statement(module), min(times) * 1e3, statistics.median(times) * 1e3)
+        )
+        if args.verbose:
+            for (cumulative_us, name) in slowest_modules(module):
+                print("    %8.2fms  %s" % (cumulative_us / 1e3, name))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,83 @@
+#!/usr/bin/env python3
+"""
+load
+
+Publishes the messages of simulated devices at a fixed rate and reports the
+achieved throughput and publishing latency.
+
+    python benchmarks/load.py SCHEMA_FILE [-d DEVICES] [-r RATE] [-t SECONDS]
+        [-b BATCH] [--compiled] [--url API_URL --api-key KEY --site-id ID]
+
+Without `--url` messages go to a local sink that only encodes them, which
+measures the cost of the SDK itself.
+"""
+import argparse
+import os
+import sys
+
+PROJECT_ROOT = os.path.dirname(os.path.dirname(os.path.realpath(__file__)))
+sys.path.insert(0, PROJECT_ROOT)
+
+from hyper_systems.devices import Schema  # noqa: E402
+from hyper_systems.devices.simulator import LocalSink, Simulator  # noqa: E402
+
+
+def percentile(latency, fraction):
+    target = latency["count"] * fraction
+    for (bound, count) in sorted(latency["buckets"].items()):
+        if count >= target:
+            return bound
+    return float("inf")
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split("\n\n")[1])
+    parser.add_argument("schema_file")
+    parser.add_argument("-d", "--devices", type=int, default=1000)
+    parser.add_argument("-r", "--rate", type=float, default=1000.0)
+    parser.add_argument("-t", "--seconds", type=float, default=10.0)
+    parser.add_argument("-b", "--batch", type=int, default=500)
+    parser.add_argument("--compiled", action="store_true")
+    parser.add_argument("--url")
+    parser.add_argument("--api-key", default="")
+    parser.add_argument("--site-id", default=1)
+    args = parser.parse_args()
+
+    if args.url:
+        from hyper_systems.http import Client
+        from hyper_systems.http.pool import ConnectionPool
+
+        sink = Client(
+            args.url, args.api_key, args.site_id, pool=ConnectionPool(args.url, 1)
+        )
+    else:
+        sink = LocalSink()
+    simulator = Simulator(
+        Schema.load(args.schema_file),
+        sink,
+        count=args.devices,
+        rate=args.rate,
+        batch_size=args.batch,
+        compiled=args.compiled,
+    )
+    stats = simulator.run(duration=args.seconds)
+    latency = stats["latency"]
+    print(
+        "%d messages in %d batches, %.1f messages/s (target %.1f), %d errors"
+        % (stats["sent"], stats["batches"], stats["rate"], args.rate, stats["errors"])
+    )
+    if latency["count"]:
+        print(
+            "latency mean %.3fms  p50 <= %gms  p99 <= %gms"
+            % (
+                latency["sum"] / latency["count"] * 1e3,
+                percentile(latency, 0.5) * 1e3,
+                percentile(latency, 0.99) * 1e3,
+            )
+        )
+    if simulator.last_error is not None:
+        print("last error: %s" % simulator.last_error)
+
+
+if __name__ == "__main__":
+    main()
@@ -1,4 +1,15 @@
-from . import devices
-from . import http
+import importlib
 
-__all__ = ["devices", "http"]
\ No newline at end of file
+__all__ = ["devices", "gateway", "http", "storage"]
+
+
+def __getattr__(name):
+    # submodules are imported on first access, keeping `import hyper_systems`
+    # cheap for short-lived processes
+    if name in __all__:
+        return importlib.import_module("." + name, __name__)
+    raise AttributeError("module %r has no attribute %r" % (__name__, name))
+
+
+def __dir__():
+    return sorted(list(globals()) + __all__)
\ No newline at end of file
@@ -0,0 +1,29 @@
+"""
+_lazy
+
+Lazy loading of the public names of the packages.
+"""
+import importlib
+
+
+def lazy_exports(package_globals, exports):
+    """
+    Returns the module `__getattr__` and `__dir__` functions of a package
+    whose public names are imported on first access from the modules given
+    by `exports`, a dict of names to relative module names. Imported values
+    are kept in the package globals.
+    """
+    package = package_globals["__name__"]
+
+    def __getattr__(name):
+        module = exports.get(name)
+        if module is None:
+            raise AttributeError("module %r has no attribute %r" % (package, name))
+        value = getattr(importlib.import_module(module, package), name)
+        package_globals[name] = value
+        return value
+
+    def __dir__():
+        return sorted(set(package_globals) | set(exports))
+
+    return (__getattr__, __dir__)
@@ -1,3 +1,13 @@
-from .device import Device, Schema
+from .._lazy import lazy_exports
 
-__all__ = ["Device", "Schema"]
+_exports = {
+    "Device": ".device",
+    "Fleet": ".fleet",
+    "Schema": ".device",
+    "dispatch_many": ".device",
+}
+
+__all__ = ["Device", "Fleet", "Schema", "dispatch_many"]
+
+# the schema dataclasses are only built when `Device` or `Schema` are used
+(__getattr__, __dir__) = lazy_exports(globals(), _exports)
@@ -0,0 +1,365 @@
+"""
+checkpoint
+
+Binary checkpoints of the read values of many devices, to resume publishing
+right after a restart.
+
+Devices are grouped per schema, and every group stores its values column by
+column: per read slot, a bitmap of the devices with a value and the values
+of all the devices, as a packed `array.array` for numbers and bools or as a
+JSON list for data and keyed values. A checkpoint file is written to a
+temporary file and renamed over the previous one, and read back with a
+single sequential read.
+
+    header  magic "HYCK", version (u16), byte order (u8), group count (u32)
+    group   device_class_id (u32), schema digest (32 bytes),
+            device count (u32), slot count (u16),
+            vendor device ids (u32 length, newline separated UTF-8)
+    slot    slot (u16), column code (1 byte), value bytes (u32),
+            presence bitmap ((device count + 7) // 8 bytes), values
+"""
+import hashlib
+import json
+import os
+import struct
+import sys
+import tempfile
+import threading
+import time
+from array import array
+
+MAGIC = b"HYCK"
+VERSION = 1
+
+_header = struct.Struct("<4sHBxI")
+_group = struct.Struct("<I32sIH")
+_length = struct.Struct("<I")
+_column = struct.Struct("<HcI")
+
+# array typecodes of the numeric formats, "?" are bools stored as bytes and
+# "j" JSON lists
+_TYPECODES = {
+    "Int8": "b",
+    "Int16": "h",
+    "Int32": "i",
+    "Int64": "q",
+    "Uint8": "B",
+    "Uint16": "H",
+    "Uint32": "I",
+    "Uint64": "Q",
+    "Float32": "d",
+    "Float64": "d",
+    "Enum": "q",
+    "Bool": "?",
+}
+_JSON = "j"
+
+
+class CheckpointError(Exception):
+    """
+    Raised when a checkpoint file is invalid.
+    """
+
+    def __init__(self, path, reason):
+        ctx = {"path": path, "reason": reason}
+        super().__init__("invalid device checkpoint: " + str(ctx))
+        self.path = path
+        self.reason = reason
+
+
+def _read_slots(schema):
+    return sorted(
+        (slot for (slot, attr) in schema.attributes.items() if attr.access.read),
+        key=int,
+    )
+
+
+def _schema_digest(schema, digests):
+    # the canonical schema and the checkpoint format, independent of the
+    # code generator
+    digest = digests.get(id(schema))
+    if digest is None:
+        digest = hashlib.sha256(b"HYCK:%d:" % VERSION)
+        digest.update(json.dumps(schema.to_json(), sort_keys=True).encode())
+        digest = digests[id(schema)] = digest.digest()
+    return digest
+
+
+def _encode_column(kind, values):
+    """
+    Returns the (code, presence bitmap, value bytes) of the values of a slot.
+    """
+    count = len(values)
+    bitmap = bytearray((count + 7) // 8)
+    for (i, value) in enumerate(values):
+        if value is not None:
+            bitmap[i >> 3] |= 1 << (i & 7)
+    code = _TYPECODES.get(kind)
+    if code is not None:
+        fill = 0.0 if code == "d" else 0
+        try:
+            column = array(
+                "B" if code == "?" else code,
+                [fill if value is None else value for value in values],
+            )
+            return (code, bitmap, column.tobytes())
+        except (OverflowError, TypeError):
+            # out of range values, keep them exactly
+            pass
+    if kind == "Keyed":
+        # keyed value containers, or plain dicts stored by dispatch
+        from .device import copy_keyed_value
+
+        values = [
+            value if value is None else copy_keyed_value(value) for value in values
+        ]
+    return (_JSON, bitmap, json.dumps(values, separators=(",", ":")).encode())
+
+
+def _decode_column(code, data, swap):
+    if code == _JSON:
+        return json.loads(bytes(data))
+    column = array("B" if code == "?" else code)
+    column.frombytes(data)
+    if swap:
+        column.byteswap()
+    if code == "?":
+        return [value == 1 for value in column]
+    return column.tolist()
+
+
+def write_checkpoint(path, devices, sync=False):
+    """
+    Writes the read values of `devices` (a `Fleet`, or an iterable or dict
+    of devices) to a checkpoint file, atomically. With `sync` the file is
+    fsynced before it replaces the previous checkpoint. Returns the number
+    of devices written.
+    """
+    if isinstance(devices, dict):
+        devices = devices.values()
+    groups = {}
+    digests = {}
+    for device in devices:
+        schema = device.schema
+        key = (device.device_class_id, _schema_digest(schema, digests))
+        group = groups.get(key)
+        if group is None:
+            group = groups[key] = (schema, [])
+        group[1].append(device)
+
+    chunks = [_header.pack(MAGIC, VERSION, sys.byteorder == "big", len(groups))]
+    count = 0
+    for ((device_class_id, digest), (schema, group)) in groups.items():
+        slots = _read_slots(schema)
+        ids = "\n".join(device.vendor_device_id for device in group).encode()
+        chunks += [
+            _group.pack(device_class_id, digest, len(group), len(slots)),
+            _length.pack(len(ids)),
+            ids,
+        ]
+        rows = [device._rvalues for device in group]
+        for slot in slots:
+            (code, bitmap, data) = _encode_column(
+                schema.attributes[slot].format.kind, [row[slot] for row in rows]
+            )
+            chunks += [_column.pack(int(slot), code.encode(), len(data)), bitmap, data]
+        count += len(group)
+
+    (fd, tmp_path) = tempfile.mkstemp(dir=os.path.dirname(path) or ".", suffix=".tmp")
+    try:
+        with os.fdopen(fd, "wb") as f:
+            f.write(b"".join(chunks))
+            if sync:
+                f.flush()
+                os.fsync(f.fileno())
+        os.replace(tmp_path, path)
+    except BaseException:
+        os.unlink(tmp_path)
+        raise
+    return count
+
+
+def read_checkpoint(path):
+    """
+    Reads a checkpoint file, returning a list of
+    `(device_class_id, schema digest, vendor device ids, {slot: values})`
+    groups, where missing values are None.
+    """
+    with open(path, "rb") as f:
+        data = memoryview(f.read())
+    try:
+        (magic, version, big, group_count) = _header.unpack_from(data, 0)
+        if magic != MAGIC or version != VERSION:
+            raise CheckpointError(path, "unsupported format %r %r" % (magic, version))
+        swap = bool(big) != (sys.byteorder == "big")
+        offset = _header.size
+        groups = []
+        for _ in range(group_count):
+            (device_class_id, digest, count, slot_count) = _group.unpack_from(
+                data, offset
+            )
+            offset += _group.size
+            (size,) = _length.unpack_from(data, offset)
+            offset += _length.size
+            ids = bytes(data[offset : offset + size]).decode().split("\n")
+            offset += size
+            if len(ids) != count:
+                raise CheckpointError(path, "expected %d device ids" % count)
+            columns = {}
+            bitmap_size = (count + 7) // 8
+            for _ in range(slot_count):
+                (slot, code, size) = _column.unpack_from(data, offset)
+                offset += _column.size
+                bitmap = bytes(data[offset : offset + bitmap_size])
+                offset += bitmap_size
+                values = _decode_column(
+                    code.decode(), data[offset : offset + size], swap
+                )
+                offset += size
+                if len(values) != count:
+                    raise CheckpointError(path, "truncated slot %d" % slot)
+                if bitmap.count(255) * 8 < count:
+                    # clear the missing values
+                    for (i, value) in enumerate(values):
+                        if not bitmap[i >> 3] >> (i & 7) & 1:
+                            values[i] = None
+                columns[str(slot)] = values
+            groups.append((device_class_id, digest, ids, columns))
+    except (struct.error, ValueError, UnicodeDecodeError) as e:
+        raise CheckpointError(path, str(e))
+    finally:
+        data.release()
+    return groups
+
+
+def _restore_values(device, slots, columns, i, keyed):
+    # generic devices keep their values in a dict of their class, compiled
+    # devices in slot attributes
+    rvalues = type(device).__dict__.get("_rvalues")
+    if not isinstance(rvalues, dict):
+        rvalues = None
+    for (slot, values) in zip(slots, columns):
+        value = values[i]
+        if slot in keyed:
+            if value is not None:
+                # validated, as a keyed value container
+                device[int(slot)] = value
+                continue
+        if rvalues is not None:
+            rvalues[slot] = value
+        else:
+            setattr(device, "_v" + slot, value)
+    if rvalues is not None:
+        type(device)._message = None
+    else:
+        device._message = None
+
+
+def restore_checkpoint(path, devices, schemas=None, compiled=False):
+    """
+    Restores the values of a checkpoint into `devices` (a `Fleet`, or a dict
+    of devices by vendor device id, or an iterable of devices), and returns
+    the restored devices.
+
+    Values are stored without validation or listener calls. Devices whose
+    schema changed since the checkpoint are skipped, and so are devices of
+    the checkpoint missing from `devices`, unless their schema is part of
+    `schemas`: those are created (see `Device.from_schema`) and added to
+    `devices` when it is a `Fleet` or a dict.
+    """
+    groups = read_checkpoint(path)
+    if not isinstance(devices, dict) and not hasattr(devices, "add"):
+        devices = {device.vendor_device_id: device for device in devices}
+    digests = {}
+    schemas = {
+        (schema.id, _schema_digest(schema, digests)): schema
+        for schema in (schemas or ())
+    }
+    restored = []
+    for (device_class_id, digest, ids, columns) in groups:
+        schema = schemas.get((device_class_id, digest))
+        slots = list(columns)
+        values = [columns[slot] for slot in slots]
+        for (i, vendor_device_id) in enumerate(ids):
+            device = devices.get(vendor_device_id)
+            if device is None:
+                if schema is None:
+                    continue
+                from .device import Device
+
+                device = Device.from_schema(schema, vendor_device_id, compiled=compiled)
+                if isinstance(devices, dict):
+                    devices[vendor_device_id] = device
+                else:
+                    devices.add(device)
+            elif (
+                device.device_class_id != device_class_id
+                or _schema_digest(device.schema, digests) != digest
+            ):
+                continue
+            _restore_values(device, slots, values, i, device._table.keyed)
+            restored.append(device)
+    return restored
+
+
+class Checkpointer(object):
+    """
+    Writes a checkpoint of `devices` to `path` every `interval` seconds from
+    a background thread, see `write_checkpoint`. Errors are kept in
+    `last_error`.
+    """
+
+    def __init__(self, devices, path, interval=60.0, sync=False):
+        self.devices = devices
+        self.path = path
+        self.interval = interval
+        self.sync = sync
+        self.checkpoints = 0
+        self.last_checkpoint = None
+        self.last_error = None
+        self._stopped = threading.Event()
+        self._thread = None
+
+    def checkpoint(self):
+        """
+        Writes a checkpoint now, returns the number of devices written.
+        """
+        count = write_checkpoint(self.path, self.devices, self.sync)
+        self.checkpoints += 1
+        self.last_checkpoint = time.time()
+        return count
+
+    def restore(self, schemas=None, compiled=False):
+        """
+        Restores the last checkpoint, if any, see `restore_checkpoint`.
+        """
+        if not os.path.exists(self.path):
+            return []
+        return restore_checkpoint(self.path, self.devices, schemas, compiled)
+
+    def _loop(self):
+        while not self._stopped.wait(self.interval):
+            try:
+                self.checkpoint()
+            except Exception as e:
+                self.last_error = e
+
+    def start(self):
+        """
+        Starts checkpointing in a background thread.
+        """
+        self._stopped.clear()
+        self._thread = threading.Thread(target=self._loop, daemon=True)
+        self._thread.start()
+
+    def stop(self, checkpoint=True):
+        """
+        Stops the background thread, writing a last checkpoint if
+        `checkpoint` is set.
+        """
+        self._stopped.set()
+        if self._thread is not None:
+            self._thread.join()
+            self._thread = None
+        if checkpoint:
+            self.checkpoint()
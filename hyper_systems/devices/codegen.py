@@ -0,0 +1,382 @@
+"""
+codegen
+
+Compilation of device schemas to Python source.
+
+`Device.from_schema` builds a class per device out of generic closures. For
+hot paths `compile_schema` instead generates the source of one class per
+schema, with a `__slots__` entry per attribute slot, the type and enum checks
+inlined in the property setters and a `to_message` method that reads the
+slots directly. Instances hold their own values, message, executor, profiler
+and listeners, so all the devices of a schema share the same class. Profilers
+of compiled devices time messages, validation and callbacks but do not count
+the slot reads and writes.
+
+Generated modules are cached on disk, in `cache_dir`, under a name derived
+from the schema hash (`hyper_device_<schema id>_<hash>.py`). The cache
+directory defaults to `$HYPER_CODEGEN_DIR`, read when a schema is compiled,
+or else `DEFAULT_CACHE_DIR`.
+"""
+import hashlib
+import importlib.util
+import json
+import os
+import sys
+import tempfile
+
+from .device import get_schema_table, make_attr_doc
+
+CODEGEN_VERSION = 5
+
+DEFAULT_CACHE_DIR = os.path.join(
+    os.path.expanduser("~"), ".cache", "hyper_systems", "codegen"
+)
+
+_classes = {}
+
+
+def schema_hash(schema):
+    """
+    Returns the hex digest identifying a schema and the code generator
+    version.
+    """
+    digest = hashlib.sha256(b"%d:" % CODEGEN_VERSION)
+    digest.update(json.dumps(schema.to_json(), sort_keys=True).encode())
+    return digest.hexdigest()
+
+
+def module_name(schema):
+    return "hyper_device_%d_%s" % (schema.id, schema_hash(schema)[:16])
+
+
+def _read_slot_lines(slot, slug, attr_py_type, valid_rvalues):
+    attr = "self._v" + slot
+    lines = ["", "    def _get_%s(self):" % slot]
+    if isinstance(attr_py_type, list):
+        lines += [
+            "        value = %s" % attr,
+            "        if value is None:",
+            "            value = %s = make_keyed_value(self, %r, None)" % (attr, slot),
+            "        self._message = None",
+            "        return value",
+            "",
+            "    def _set_%s(self, value):" % slot,
+            "        if not isinstance(value, (dict, KeyedArray)):",
+            "            raise TypeError(",
+            "                %r"
+            % (
+                "value '%%s' for attribute '%s' has an invalid type: "
+                "expected dict, got %%s" % slug
+            ),
+            "                % (value, type(value).__name__)",
+            "            )",
+            "        %s = make_keyed_value(self, %r, value)" % (attr, slot),
+            "        self._message = None",
+        ]
+    else:
+        lines += [
+            "        return %s" % attr,
+            "",
+            "    def _set_%s(self, value):" % slot,
+            "        if not isinstance(value, %s):" % attr_py_type.__name__,
+            "            raise TypeError(",
+            "                %r"
+            % (
+                "value '%%s' for attribute '%s' has an invalid type: "
+                "expected %s, got %%s" % (slug, attr_py_type.__name__)
+            ),
+            "                % (value, type(value).__name__)",
+            "            )",
+        ]
+        if valid_rvalues is not None:
+            lines += [
+                "        if value not in _ENUM_%s:" % slot,
+                "            raise TypeError(",
+                "                %r"
+                % (
+                    "value %%s for enum attribute '%s' is invalid: "
+                    "expected one of: %s" % (slug, list(valid_rvalues))
+                ),
+                "                % value",
+                "            )",
+            ]
+        lines += [
+            "        %s = value" % attr,
+            "        self._message = None",
+        ]
+    lines += [
+        "",
+        "    def _del_%s(self):" % slot,
+        "        %s = None" % attr,
+        "        self._message = None",
+    ]
+    return lines
+
+
+def generate_source(schema):
+    """
+    Returns the source of the module defining the compiled device class of a
+    schema.
+    """
+    table = get_schema_table(schema)
+    class_name = "Device%d" % schema.id
+    rslots = [slot for (slot, attr) in schema.attributes.items() if attr.access.read]
+    wslots = [slot for (slot, attr) in schema.attributes.items() if attr.access.write]
+    slots = (
+        "vendor_device_id",
+        "_message",
+        "_executor",
+        "_profiler",
+        "_listeners",
+        "_wbinds",
+    ) + tuple("_v" + slot for slot in rslots)
+
+    lines = [
+        "# generated by hyper_systems.devices.codegen, do not edit",
+        "# schema %d (%s)" % (schema.id, schema_hash(schema)),
+        "from datetime import datetime",
+        "from uuid import uuid4",
+        "",
+        "from hyper_systems.devices import device as _device",
+        "from hyper_systems.devices.device import make_keyed_value",
+        "from hyper_systems.devices.keyed import KeyedArray",
+    ]
+    for slot in rslots:
+        valid_rvalues = table.types[slot][1]
+        if valid_rvalues is not None:
+            if not lines[-1].startswith("_ENUM_"):
+                lines.append("")
+            lines.append("_ENUM_%s = frozenset(%r)" % (slot, sorted(valid_rvalues)))
+    lines += [
+        "",
+        "",
+        "class %s(object):" % class_name,
+        "    %r" % (schema.name + "\n" + schema.description),
+        "",
+        "    __slots__ = %r" % (slots,),
+        "",
+        "    device_class_id = %d" % schema.id,
+        "    attributes = %r" % list(table.slugs.values()),
+        "    values = property(_device.get_device_values)",
+        "    dispatch = _device.dispatch",
+        "    slot_of = _device.slot_of",
+        "    slug_of = _device.slug_of",
+        "    __repr__ = _device.device_repr",
+        "",
+        "    def __init__(self, vendor_device_id, executor=None):",
+        "        self.vendor_device_id = vendor_device_id",
+        "        self._message = None",
+        "        self._executor = executor",
+        "        self._profiler = None",
+        "        self._listeners = ()",
+        "        self._wbinds = %r" % {slot: None for slot in wslots},
+    ]
+    lines += ["        self._v%s = None" % slot for slot in rslots]
+    lines += [
+        "",
+        "    @property",
+        "    def _rvalues(self):",
+        "        return {%s}" % ", ".join("%r: self._v%s" % (s, s) for s in rslots),
+    ]
+    for slot in rslots:
+        lines += _read_slot_lines(slot, table.slugs[slot], *table.types[slot])
+
+    lines += [
+        "",
+        "    def __getitem__(self, slot):",
+        "        getter = _GETTERS.get(slot)",
+        "        if getter is None or type(slot) is not int:",
+        "            _device.get_attr_from_slot(self, slot)",
+        "        return getter(self)",
+        "",
+        "    def __setitem__(self, slot, value):",
+        "        setter = _SETTERS.get(slot)",
+        "        if setter is None or type(slot) is not int:",
+        "            _device.get_attr_from_slot(self, slot)",
+        "        setter(self, value)",
+        "",
+        "    def to_message(self):",
+        "        message = self._message",
+        "        if message is not None:",
+        "            return message",
+        "        profiler = self._profiler",
+        "        start = profiler.start() if profiler is not None else None",
+        "        values = {}",
+    ]
+    for slot in rslots:
+        lines += [
+            "        value = self._v%s" % slot,
+            "        if value is not None:",
+        ]
+        if slot in table.keyed:
+            lines.append(
+                "            values[%r] = _device.copy_keyed_value(value)" % slot
+            )
+        else:
+            lines.append("            values[%r] = value" % slot)
+    lines += [
+        "        message = self._message = {",
+        '            "message_uuid": str(uuid4()),',
+        '            "created_time": datetime.utcnow().strftime("%Y-%m-%dT%H:%M:%SZ"),',
+        '            "vendor_device_id": self.vendor_device_id,',
+        '            "device_class_id": %d,' % schema.id,
+        '            "values": values,',
+        "        }",
+        "        if start is not None:",
+        "            profiler.observe_message_build(self, start)",
+        "        return message",
+        "",
+        "    message = property(to_message)",
+        "",
+        "    def _apply_incoming(self, values):",
+        "        for (slot, value) in values.items():",
+        "            store = _STORE.get(slot)",
+        "            if store is not None:",
+        "                store(self, value)",
+        "                self._message = None",
+        "        wbinds = self._wbinds",
+        "        executor = self._executor",
+        "        profiler = self._profiler",
+        "        if profiler is not None:",
+        "            profiler.count_incoming(self, values)",
+        "        for listener in self._listeners:",
+        "            listener(self, values)",
+        "        for (slot, value) in values.items():",
+        "            f = wbinds.get(slot)",
+        "            if f is not None:",
+        "                if profiler is not None:",
+        "                    f = profiler.wrap_callback(self, slot, f)",
+        "                if executor is None:",
+        "                    f(value)",
+        "                else:",
+        "                    executor.submit(self, slot, f, value)",
+        "",
+        "    def set_executor(self, executor):",
+        "        self._executor = executor",
+        "",
+        "    def set_profiler(self, profiler):",
+        "        self._profiler = profiler",
+        "",
+        "    def add_listener(self, listener):",
+        "        self._listeners = self._listeners + (listener,)",
+        "",
+        "    def remove_listener(self, listener):",
+        "        self._listeners = tuple(",
+        "            f for f in self._listeners if f is not listener",
+        "        )",
+        "",
+        "    def clear(self):",
+    ]
+    lines += ["        self._v%s = None" % slot for slot in rslots]
+    lines += [
+        "        self._message = None",
+        "",
+        "",
+        "def _write_bind_property(slot, slug, doc):",
+        "    def attr_get(self):",
+        "        return self._wbinds[slot]",
+        "",
+        "    def attr_set(self, f):",
+        "        if not callable(f):",
+        "            raise TypeError(",
+        "                \"value for attribute 'on_%s_update' must be a function, got %s\"",
+        "                % (slug, type(f).__name__)",
+        "            )",
+        "        self._wbinds[slot] = f",
+        "",
+        "    def attr_del(self):",
+        "        self._wbinds[slot] = None",
+        "",
+        "    return property(attr_get, attr_set, attr_del, doc)",
+        "",
+        "",
+    ]
+    for slot in rslots:
+        lines.append(
+            "setattr(%s, %r, property(%s._get_%s, %s._set_%s, %s._del_%s, %r))"
+            % (
+                (class_name, table.slugs[slot])
+                + (class_name, slot) * 3
+                + (make_attr_doc(schema.attributes[slot]),)
+            )
+        )
+    for slot in wslots:
+        slug = table.slugs[slot]
+        lines.append(
+            "setattr(%s, %r, _write_bind_property(%r, %r, %r))"
+            % (
+                class_name,
+                "on_" + slug + "_update",
+                slot,
+                slug,
+                make_attr_doc(schema.attributes[slot]),
+            )
+        )
+    # incoming keyed values are wrapped by their setter, like local ones
+    stores = [
+        "%r: %s._set_%s" % (s, class_name, s)
+        if s in table.keyed
+        else "%r: %s._v%s.__set__" % (s, class_name, s)
+        for s in rslots
+    ]
+    lines += [
+        "",
+        "_GETTERS = {%s}"
+        % ", ".join("%s: %s._get_%s" % (s, class_name, s) for s in rslots),
+        "_SETTERS = {%s}"
+        % ", ".join("%s: %s._set_%s" % (s, class_name, s) for s in rslots),
+        "_STORE = {%s}" % ", ".join(stores),
+        "",
+        "DEVICE_CLASS = %s" % class_name,
+        "",
+    ]
+    return "\n".join(lines)
+
+
+def _write_module(path, source):
+    (fd, tmp_path) = tempfile.mkstemp(dir=os.path.dirname(path), suffix=".tmp")
+    try:
+        with os.fdopen(fd, "w", encoding="utf-8") as f:
+            f.write(source)
+        os.replace(tmp_path, path)
+    except BaseException:
+        os.unlink(tmp_path)
+        raise
+
+
+def _load_module(name, schema, cache_dir):
+    path = os.path.join(cache_dir, name + ".py")
+    try:
+        if not os.path.exists(path):
+            os.makedirs(cache_dir, exist_ok=True)
+            _write_module(path, generate_source(schema))
+    except OSError:
+        # read-only file systems: compile the class without caching it
+        module = type(sys)(name)
+        exec(compile(generate_source(schema), "<%s>" % name, "exec"), module.__dict__)
+        return module
+    spec = importlib.util.spec_from_file_location(name, path)
+    module = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(module)
+    sys.modules[name] = module
+    return module
+
+
+def compile_schema(schema, cache_dir=None):
+    """
+    Returns the compiled device class of a schema, generating and caching its
+    source if needed. Devices are created with `cls(vendor_device_id)`.
+    """
+    name = module_name(schema)
+    cls = _classes.get(name)
+    if cls is None:
+        module = sys.modules.get(name)
+        if module is None:
+            if cache_dir is None:
+                cache_dir = os.environ.get("HYPER_CODEGEN_DIR", DEFAULT_CACHE_DIR)
+            module = _load_module(name, schema, cache_dir)
+        cls = module.DEVICE_CLASS
+        cls.schema = schema
+        cls._table = get_schema_table(schema)
+        _classes[name] = cls
+    return cls
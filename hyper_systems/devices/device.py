@@ -6,6 +6,7 @@ import json
 import uuid
 from datetime import datetime
 from . import device_schema_gen
+from .keyed import KeyedArray, KeyedValues, make_value_check
 
 
 class Schema(device_schema_gen.DeviceSchema):
@@ -73,6 +74,54 @@ def get_valid_type_for_attr(attr):
     return (attr_py_type, valid_values)
 
 
+class SchemaTable(object):
+    """
+    Lookup tables derived from a schema: the slot <-> slug maps and the valid
+    python types of every attribute.
+
+    Use `get_schema_table` to get the table of a schema, it is computed once
+    and cached on the schema object.
+    """
+
+    def __init__(self, schema):
+        self.slugs = {
+            slot: make_attr_slug(slot, attr)
+            for (slot, attr) in schema.attributes.items()
+        }
+        self.slots = {slug: int(slot) for (slot, slug) in self.slugs.items()}
+        self.types = {
+            slot: get_valid_type_for_attr(attr)
+            for (slot, attr) in schema.attributes.items()
+        }
+        self.keyed = {
+            slot: attr.format.value.value
+            for (slot, attr) in schema.attributes.items()
+            if attr.format.kind == "Keyed"
+        }
+        self.writable = {
+            slot: attr.access.write for (slot, attr) in schema.attributes.items()
+        }
+        self.validators = {
+            slot: make_incoming_validator(
+                self.slugs[slot],
+                *self.types[slot],
+                self.writable[slot],
+                make_value_check(slot, self.slugs[slot], self.keyed[slot])[1]
+                if slot in self.keyed
+                else None
+            )
+            for slot in schema.attributes
+        }
+
+
+def get_schema_table(schema):
+    table = schema.__dict__.get("_table")
+    if table is None:
+        table = SchemaTable(schema)
+        schema._table = table
+    return table
+
+
 def get_attr_from_slot(self, slot):
     if not isinstance(slot, int):
         raise TypeError("the attribute slot must be an int value")
@@ -89,9 +138,43 @@ def get_attr_from_slot(self, slot):
     return attr
 
 
+def make_keyed_value(self, slot_key, value):
+    """
+    Wraps a dict assigned to a keyed attribute in a validated `KeyedValues`,
+    owned by the device.
+    """
+    if not isinstance(value, (KeyedValues, KeyedArray)):
+        table = self._table
+        value = KeyedValues(
+            slot_key, table.slugs[slot_key], table.keyed[slot_key], value
+        )
+    # generic devices cache their message in their class
+    cls = type(self)
+    value.owner = cls if isinstance(cls.__dict__.get("_rvalues"), dict) else self
+    return value
+
+
+def copy_keyed_value(value):
+    """
+    Returns a plain dict copy of the value of a keyed attribute.
+    """
+    return value.to_dict() if type(value) is KeyedArray else dict(value)
+
+
 def set_slot_value(self, slot, value):
-    attr = get_attr_from_slot(self, slot)
-    attr_py_type, valid_rvalues = get_valid_type_for_attr(attr)
+    get_attr_from_slot(self, slot)
+    attr_py_type, valid_rvalues = self._table.types[str(slot)]
+    if isinstance(attr_py_type, list):
+        if not isinstance(value, (dict, KeyedArray)):
+            raise TypeError(
+                "value '%s' for attribute slot %d has an invalid type: expected %s, got %s"
+                % (value, slot, dict.__name__, type(value).__name__)
+            )
+        self._rvalues[str(slot)] = make_keyed_value(self, str(slot), value)
+        type(self)._message = None
+        if self._profiler is not None:
+            self._profiler.count_set(self, slot)
+        return
     if not isinstance(value, attr_py_type):
         raise TypeError(
             "value '%s' for attribute slot %d has an invalid type: expected %s, got %s"
@@ -104,49 +187,47 @@ def set_slot_value(self, slot, value):
         )
 
     self._rvalues[str(slot)] = value
+    type(self)._message = None
+    if self._profiler is not None:
+        self._profiler.count_set(self, slot)
 
 
 def get_slot_value(self, slot):
-    attr = get_attr_from_slot(self, slot)
-    attr_py_type, _valid_rvalues = get_valid_type_for_attr(attr)
-
-    # check if keyed
-    if isinstance(attr_py_type, list):
-        if attr_py_type[0] == str:
-            if not self._rvalues[str(slot)]:
-                # create special keyed dict that raises TypeError if key is not a str
-                class KeyedDict(dict):
-                    def __setitem__(self, key, value):
-                        if not isinstance(key, str):
-                            slug = make_attr_slug(slot, attr)
-                            raise TypeError(
-                                f"keyed attribute slot `{slot}` (`{slug}`) must be a dict[string, float]"
-                            )
-                        super().__setitem__(key, value)
-
-                self._rvalues[str(slot)] = KeyedDict()
+    get_attr_from_slot(self, slot)
+    slot_key = str(slot)
+    if self._profiler is not None:
+        self._profiler.count_get(self, slot_key)
+    value = self._rvalues[slot_key]
 
-    if not isinstance(slot, int):
-        raise TypeError("the attribute slot must be an int value")
-    return self._rvalues[str(slot)]
+    if slot_key in self._table.keyed:
+        # keyed attributes get an empty validated dict on first access, and
+        # can be modified in place through the returned container
+        if value is None:
+            value = self._rvalues[slot_key] = make_keyed_value(self, slot_key, None)
+        type(self)._message = None
+    return value
 
 
-def make_read_attr_property(slot, attr):
-    slug = make_attr_slug(slot, attr)
-    attr_py_type, valid_rvalues = get_valid_type_for_attr(attr)
+def make_read_attr_property(slot, attr, table):
+    slug = table.slugs[slot]
+    attr_py_type, valid_rvalues = table.types[slot]
 
     def attr_get(self):
         return get_slot_value(self, int(slot))
 
     def attr_set(self, value):
         if isinstance(attr_py_type, list):
-            if attr_py_type[0] == str:
-                if not isinstance(value, dict):
-                    raise TypeError(
-                        "value '%s' for attribute '%s' has an invalid type: expected %s, got %s"
-                        % (value, slug, dict.__name__, type(value).__name__)
-                    )
-        elif not isinstance(value, attr_py_type):
+            if not isinstance(value, (dict, KeyedArray)):
+                raise TypeError(
+                    "value '%s' for attribute '%s' has an invalid type: expected %s, got %s"
+                    % (value, slug, dict.__name__, type(value).__name__)
+                )
+            self._rvalues[slot] = make_keyed_value(self, slot, value)
+            type(self)._message = None
+            if self._profiler is not None:
+                self._profiler.count_set(self, slot)
+            return
+        if not isinstance(value, attr_py_type):
             raise TypeError(
                 "value '%s' for attribute '%s' has an invalid type: expected %s, got %s"
                 % (value, slug, attr_py_type.__name__, type(value).__name__)
@@ -157,9 +238,13 @@ def make_read_attr_property(slot, attr):
                 % (value, slug, list(valid_rvalues))
             )
         self._rvalues[slot] = value
+        type(self)._message = None
+        if self._profiler is not None:
+            self._profiler.count_set(self, slot)
 
     def attr_del(self):
         self._rvalues[slot] = None
+        type(self)._message = None
 
     prop = property(
         fget=attr_get, fset=attr_set, fdel=attr_del, doc=make_attr_doc(attr)
@@ -167,8 +252,8 @@ def make_read_attr_property(slot, attr):
     return (slug, prop)
 
 
-def make_write_attr_property(slot, attr):
-    slug = make_attr_slug(slot, attr)
+def make_write_attr_property(slot, attr, table):
+    slug = table.slugs[slot]
 
     def attr_get(self):
         return self._wbinds[slot]
@@ -193,37 +278,79 @@ def make_write_attr_property(slot, attr):
 def get_device_message(self):
     """
     Produces a dict with the final message.
+
+    The message is cached until a value of the device changes, so reading it
+    again (e.g. to retry publishing) gives the same `message_uuid` and
+    `created_time`; `MessageEncoder` encodes devices with them too. To
+    publish an unchanged device again as a new message, copy the message
+    with a new `message_uuid` and `created_time`, as `PublishScheduler` does.
     """
+    message = self._message
+    if message is not None:
+        return message
+    profiler = self._profiler
+    start = profiler.start() if profiler is not None else None
+    keyed = self._table.keyed
     message_uuid = str(uuid.uuid4())
     collected_time = datetime.utcnow().strftime("%Y-%m-%dT%H:%M:%SZ")
-    return {
+    message = {
         "message_uuid": message_uuid,
         "created_time": collected_time,
         "vendor_device_id": self.vendor_device_id,
         "device_class_id": self.device_class_id,
         "values": {
-            slot: value for (slot, value) in self._rvalues.items() if value is not None
+            # keyed values are copied, the message does not change with them
+            slot: (copy_keyed_value(value) if slot in keyed else value)
+            for (slot, value) in self._rvalues.items()
+            if value is not None
         },
     }
+    type(self)._message = message
+    if start is not None:
+        profiler.observe_message_build(self, start)
+    return message
 
 
 def get_device_values(self):
     """
     Produces the dict of all set attribute values.
     """
+    slugs = self._table.slugs
     values = dict()
-    for attr in self.attributes:
-        try:
-            val = getattr(self, attr)
-            # ignore unset attribute attralues (None)
-            if val:
-                values[attr] = val
-        except AttributeError:
-            pass
+    for (slot, val) in self._rvalues.items():
+        # ignore unset attribute values (None)
+        if val:
+            values[slugs[slot]] = val
 
     return values
 
 
+def slot_of(self, slug):
+    """
+    Returns the slot of the attribute with the given name.
+    """
+    try:
+        return self._table.slots[slug]
+    except KeyError:
+        raise AttributeError(
+            "no attribute '%s' found in device with schema %d"
+            % (slug, self.device_class_id)
+        ) from None
+
+
+def slug_of(self, slot):
+    """
+    Returns the attribute name of the given slot.
+    """
+    try:
+        return self._table.slugs[str(slot)]
+    except KeyError:
+        raise TypeError(
+            "no attribute for slot %s found in device with schema %d"
+            % (slot, self.device_class_id)
+        ) from None
+
+
 def device_repr(self):
     return repr("<%s: %s>" % (type(self).__name__, self.vendor_device_id))
 
@@ -234,40 +361,166 @@ def clear_values(self):
     """
     for slot in self._rvalues.keys():
         self._rvalues[slot] = None
+    type(self)._message = None
 
 
-def dispatch(self, message):
-    if message["vendor_device_id"] != self.vendor_device_id:
-        raise ValueError(
-            "tried to dispatch a message for a wrong device, expected message for id '%s', but got a message for '%s'"
-            % (self.vendor_device_id, message["vendor_device_id"])
-        )
-    for (slot, value) in message["values"].items():
-        attr = self.schema.attributes[slot]
-        attr_py_type, valid_rvalues = get_valid_type_for_attr(attr)
-        slug = make_attr_slug(slot, attr)
+def make_incoming_validator(slug, attr_py_type, valid_rvalues, writable, check=None):
+    """
+    Produces a function that checks an incoming value for an attribute, and
+    the keys and values of keyed attributes with their `check` function (see
+    `hyper_systems.devices.keyed.make_value_check`).
+    """
+    if isinstance(attr_py_type, list):
+        # keyed attributes are received as dicts
+        attr_py_type = dict
+    valid_set = frozenset(valid_rvalues) if valid_rvalues is not None else None
 
+    def validate(value):
         if not isinstance(value, attr_py_type):
             raise TypeError(
                 "incoming value '%s' for attribute '%s' has an invalid type: expected %s, got %s"
                 % (value, slug, attr_py_type.__name__, type(value).__name__)
             )
-        if valid_rvalues is not None and value not in valid_rvalues:
+        if valid_set is not None and value not in valid_set:
             raise TypeError(
                 "incoming value %s for enum attribute '%s' is invalid: expected one of: %s"
                 % (value, slug, list(valid_rvalues))
             )
-        if not attr.access.write:
+        if not writable:
             raise TypeError(
                 "received incoming value %s for read-only attribute '%s'"
                 % (value, slug)
             )
+        if check is not None:
+            for (key, inner) in value.items():
+                if not isinstance(key, str):
+                    raise TypeError(
+                        "incoming key %r for keyed attribute '%s' must be a string"
+                        % (key, slug)
+                    )
+                check(key, inner)
 
-        if slot in self._rvalues:
-            self._rvalues[slot] = value
-        if slot in self._wbinds and self._wbinds[slot] is not None:
-            f = self._wbinds[slot]
-            f(value)
+    return validate
+
+
+def apply_incoming_values(self, values):
+    """
+    Stores already validated incoming values and calls the write bindings.
+    Keyed values are stored in validated `KeyedValues`, as when set locally.
+    """
+    rvalues = self._rvalues
+    keyed = self._table.keyed
+    wbinds = self._wbinds
+    executor = self._executor
+    profiler = self._profiler
+    for (slot, value) in values.items():
+        if slot in rvalues:
+            if slot in keyed:
+                value = make_keyed_value(self, slot, value)
+            rvalues[slot] = value
+            type(self)._message = None
+    if profiler is not None:
+        profiler.count_incoming(self, values)
+    for listener in self._listeners:
+        listener(self, values)
+    for (slot, value) in values.items():
+        f = wbinds.get(slot)
+        if f is not None:
+            if profiler is not None:
+                f = profiler.wrap_callback(self, slot, f)
+            if executor is None:
+                f(value)
+            else:
+                executor.submit(self, slot, f, value)
+
+
+def add_listener(self, listener):
+    """
+    Registers a `listener(device, values)` function called with the values
+    applied by `dispatch` and `dispatch_many`, before the write bindings.
+    """
+    type(self)._listeners = self._listeners + (listener,)
+
+
+def remove_listener(self, listener):
+    type(self)._listeners = tuple(f for f in self._listeners if f is not listener)
+
+
+def set_profiler(self, profiler):
+    """
+    Sets the profiler collecting the access counters and timings of the
+    device (see `hyper_systems.devices.profiling`), or None to stop profiling.
+    """
+    type(self)._profiler = profiler
+
+
+def set_executor(self, executor):
+    """
+    Sets the executor used to run the write bindings of the device, or None to
+    run them inline during `dispatch`.
+    """
+    type(self)._executor = executor
+
+
+def dispatch(self, message):
+    if message["vendor_device_id"] != self.vendor_device_id:
+        raise ValueError(
+            "tried to dispatch a message for a wrong device, expected message for id '%s', but got a message for '%s'"
+            % (self.vendor_device_id, message["vendor_device_id"])
+        )
+    validators = self._table.validators
+    values = message["values"]
+    profiler = self._profiler
+    start = profiler.start() if profiler is not None else None
+    for (slot, value) in values.items():
+        validators[slot](value)
+    if start is not None:
+        profiler.observe_validation(self, start)
+    self._apply_incoming(values)
+
+
+def dispatch_many(devices, messages):
+    """
+    Applies a list of incoming messages to a set of devices in one call.
+
+    `devices` is a mapping of vendor device ids to devices (or an iterable of
+    devices). The whole batch is validated before any value is applied.
+    Messages for the same device are coalesced, so only the last value of every
+    slot is applied and each write binding is called at most once per device.
+
+    Returns the dict of applied values per vendor device id.
+    """
+    if hasattr(messages, "to_json"):
+        messages = messages.to_json()
+    if not hasattr(devices, "get"):
+        devices = {device.vendor_device_id: device for device in devices}
+
+    pending = {}
+    for message in messages:
+        vendor_device_id = message["vendor_device_id"]
+        values = pending.get(vendor_device_id)
+        if values is None:
+            device = devices.get(vendor_device_id)
+            if device is None:
+                raise ValueError(
+                    "tried to dispatch a message for an unknown device '%s'"
+                    % vendor_device_id
+                )
+            values = pending[vendor_device_id] = {}
+        else:
+            device = devices[vendor_device_id]
+        validators = device._table.validators
+        profiler = device._profiler
+        start = profiler.start() if profiler is not None else None
+        for (slot, value) in message["values"].items():
+            validators[slot](value)
+            values[slot] = value
+        if start is not None:
+            profiler.observe_validation(device, start)
+
+    for (vendor_device_id, values) in pending.items():
+        devices[vendor_device_id]._apply_incoming(values)
+    return pending
 
 
 def validate_vendor_device_id(vendor_device_id_format, id):
@@ -283,11 +536,23 @@ class Device:
         )
 
     @classmethod
-    def from_schema(cls, schema, device_id):
+    def from_schema(cls, schema, device_id, executor=None, compiled=False):
         """
         A smart constructor function for a device described by a given schema.
+
+        Write bindings are called inline during `dispatch`, unless an
+        `executor` (see `hyper_systems.devices.executor`) is given.
+
+        With `compiled=True` the device is an instance of a class generated
+        from the schema source (see `hyper_systems.devices.codegen`), shared by
+        all the compiled devices of the schema.
         """
         validate_vendor_device_id(schema.vendor_device_id_format, device_id)
+        if compiled:
+            from .codegen import compile_schema
+
+            return compile_schema(schema)(device_id.upper(), executor)
+        table = get_schema_table(schema)
 
         rattrs = {
             slot: attr for (slot, attr) in schema.attributes.items() if attr.access.read
@@ -298,10 +563,12 @@ class Device:
             if attr.access.write
         }
         rattrs_props = dict(
-            make_read_attr_property(slot, attr) for (slot, attr) in rattrs.items()
+            make_read_attr_property(slot, attr, table)
+            for (slot, attr) in rattrs.items()
         )
         wattrs_props = dict(
-            make_write_attr_property(slot, attr) for (slot, attr) in wattrs.items()
+            make_write_attr_property(slot, attr, table)
+            for (slot, attr) in wattrs.items()
         )
         schema_attrs = {
             "vendor_device_id": device_id.upper(),
@@ -313,11 +580,21 @@ class Device:
             "clear": clear_values,
             "__setitem__": set_slot_value,
             "__getitem__": get_slot_value,
-            "attributes": [
-                make_attr_slug(slot, attr) for (slot, attr) in schema.attributes.items()
-            ],
+            "slot_of": slot_of,
+            "slug_of": slug_of,
+            "attributes": list(table.slugs.values()),
             "_rvalues": {slot: None for slot in rattrs},
             "_wbinds": {slot: None for slot in wattrs},
+            "_table": table,
+            "_executor": executor,
+            "_message": None,
+            "_profiler": None,
+            "_listeners": (),
+            "_apply_incoming": apply_incoming_values,
+            "set_executor": set_executor,
+            "set_profiler": set_profiler,
+            "add_listener": add_listener,
+            "remove_listener": remove_listener,
             "__repr__": device_repr,
             "__doc__": (schema.name + "\n" + schema.description),
             "__slots__": (),
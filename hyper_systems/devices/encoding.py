@@ -0,0 +1,319 @@
+"""
+encoding
+
+JSON encoding of device messages from pre-serialised fragments.
+
+The envelope of a message (`vendor_device_id`, `device_class_id` and the
+field names) never changes for a device, and slot keys repeat in every
+message. `MessageEncoder` caches those as bytes and assembles message bodies
+by joining them with the freshly encoded values in a `bytearray`. The result
+can be passed directly to `Client.publish_device_message_list`.
+
+Devices are encoded with the `message_uuid` and `created_time` of their
+cached `message`, so encoding an unchanged device again gives the same
+message, exactly like reading its `message` again (see `PublishScheduler`
+for publishing unchanged devices periodically).
+
+`Quantizer` optionally rounds float slot values before they are encoded:
+`Float32` slots to float32 precision and, where known, to a number of
+decimals derived from the attribute unit or quantity.
+"""
+import json
+import struct
+
+from .keyed import KeyedArray, KeyedValues
+
+_encode_json = json.JSONEncoder(separators=(",", ":")).encode
+_float32 = struct.Struct("<f")
+
+# decimals kept for attributes measured in a given unit
+UNIT_PRECISION = {
+    "degree Celsius": 2,
+    "degree Fahrenheit": 2,
+    "kelvin": 2,
+    "percent": 1,
+    "lux": 1,
+    "pascal": 0,
+    "hectopascal": 2,
+    "volt": 3,
+    "ampere": 3,
+    "watt": 1,
+    "second": 3,
+    "millisecond": 0,
+}
+
+# decimals kept for attributes of a given quantity, when the unit is unknown
+QUANTITY_PRECISION = {
+    "Temperature": 2,
+    "Humidity": 1,
+    "Illuminance": 1,
+}
+
+_slot_keys = {}
+
+
+def encode_value(value):
+    """
+    Encodes a single slot value as JSON bytes.
+    """
+    value_type = type(value)
+    if value_type is int:
+        return str(value).encode()
+    if value_type is float and value - value == 0.0:
+        # finite floats have the same repr in python and JSON
+        return repr(value).encode()
+    if value_type is bool:
+        return b"true" if value else b"false"
+    if value_type is KeyedArray:
+        value = value.to_dict()
+    return _encode_json(value).encode()
+
+
+def slot_key(slot):
+    """
+    Returns the cached `"<slot>":` fragment of a slot.
+    """
+    key = _slot_keys.get(slot)
+    if key is None:
+        key = _slot_keys[slot] = _encode_json(str(slot)).encode() + b":"
+    return key
+
+
+def float32_round(value):
+    """
+    Rounds a float to float32 precision, returning the shortest float that
+    maps back to the same float32 value.
+    """
+    try:
+        f32 = _float32.unpack(_float32.pack(value))[0]
+    except (OverflowError, struct.error):
+        return value
+    if f32 != f32 or f32 in (float("inf"), float("-inf")):
+        return value
+    for digits in range(1, 10):
+        shortest = float("%.*g" % (digits, f32))
+        if _float32.unpack(_float32.pack(shortest))[0] == f32:
+            return shortest
+    return f32
+
+
+def _make_round(kind, digits):
+    if digits is not None:
+        if kind == "Float32":
+            return lambda value: float32_round(round(value, digits))
+        return lambda value: round(value, digits)
+    if kind == "Float32":
+        return float32_round
+    return None
+
+
+class Quantizer(object):
+    """
+    Schema-driven rounding of float slot values.
+
+    `Float32` slots are rounded to float32 precision. Float slots whose
+    `unit` (or `quantity`) has an entry in `unit_precision` (or
+    `quantity_precision`) are also rounded to that many decimals, `precision`
+    maps slots to decimals and takes precedence over the metadata.
+
+    Rounded values have a short repr, so both `json.dumps` and the
+    `MessageEncoder` produce smaller payloads for them.
+    """
+
+    def __init__(
+        self,
+        precision=None,
+        unit_precision=UNIT_PRECISION,
+        quantity_precision=QUANTITY_PRECISION,
+    ):
+        self.precision = {str(slot): d for (slot, d) in (precision or {}).items()}
+        self.unit_precision = unit_precision or {}
+        self.quantity_precision = quantity_precision or {}
+        self._schemas = {}
+
+    def _slot_digits(self, slot, attr):
+        if slot in self.precision:
+            return self.precision[slot]
+        if attr.unit in self.unit_precision:
+            return self.unit_precision[attr.unit]
+        return self.quantity_precision.get(attr.quantity)
+
+    def functions(self, schema):
+        """
+        Returns the {slot: rounding function} dict of a schema, keyed slots
+        map to the rounding function of their values.
+        """
+        functions = self._schemas.get(id(schema))
+        if functions is None:
+            functions = {}
+            for (slot, attr) in schema.attributes.items():
+                kind = attr.format.kind
+                if kind == "Keyed":
+                    kind = attr.format.value.value.kind
+                f = _make_round(kind, self._slot_digits(slot, attr))
+                if f is not None:
+                    functions[slot] = f
+            # the schema is kept referenced so that its id is not reused
+            self._schemas[id(schema)] = functions = (schema, functions)
+        return functions[1]
+
+    def quantize_values(self, schema, values):
+        """
+        Returns a copy of a {slot: value} dict with rounded float values.
+        """
+        functions = self.functions(schema)
+        quantized = {}
+        for (slot, value) in values.items():
+            f = functions.get(slot)
+            if f is not None and value is not None:
+                if isinstance(value, (KeyedValues, KeyedArray, dict)):
+                    value = {k: f(v) for (k, v) in value.items()}
+                elif type(value) is float:
+                    value = f(value)
+            quantized[slot] = value
+        return quantized
+
+    def quantize_message(self, schema, message):
+        """
+        Returns a copy of a message dict with rounded float values.
+        """
+        return dict(
+            message,
+            values=self.quantize_values(schema, message["values"]),
+        )
+
+
+class EncodedMessages(bytearray):
+    """
+    A JSON array of encoded device messages, with the `message_uuids` of its
+    messages so that publishing it can be deduplicated and rate limited
+    without decoding it again.
+    """
+
+    def __init__(self, data=b""):
+        super().__init__(data)
+        self.message_uuids = []
+
+
+class MessageTemplate(object):
+    """
+    The constant fragments of the messages of a single device.
+    """
+
+    __slots__ = ("vendor_device_id", "device_class_id", "envelope")
+
+    def __init__(self, vendor_device_id, device_class_id):
+        self.vendor_device_id = vendor_device_id
+        self.device_class_id = device_class_id
+        self.envelope = (
+            b'","vendor_device_id":'
+            + _encode_json(vendor_device_id).encode()
+            + b',"device_class_id":'
+            + _encode_json(device_class_id).encode()
+            + b',"values":{'
+        )
+
+    def encode_into(self, buf, message_uuid, created_time, values):
+        """
+        Appends the encoded message to the `buf` bytearray.
+        """
+        buf += b'{"message_uuid":"'
+        buf += message_uuid.encode()
+        buf += b'","created_time":"'
+        buf += created_time.encode()
+        buf += self.envelope
+        first = True
+        for (slot, value) in values:
+            if value is None:
+                continue
+            if not first:
+                buf += b","
+            first = False
+            buf += slot_key(slot)
+            buf += encode_value(value)
+        buf += b"}}"
+
+
+class MessageEncoder(object):
+    """
+    Encodes device messages, caching the constant fragments per device.
+
+    With a `quantizer`, float values are rounded first. Message dicts are only
+    quantized if the schema of their `device_class_id` is found in `schemas`.
+    """
+
+    def __init__(self, quantizer=None, schemas=None):
+        self.quantizer = quantizer
+        self.schemas = {schema.id: schema for schema in (schemas or ())}
+        self._templates = {}
+
+    def template(self, vendor_device_id, device_class_id):
+        template = self._templates.get(vendor_device_id)
+        if template is None or template.device_class_id != device_class_id:
+            template = MessageTemplate(vendor_device_id, device_class_id)
+            self._templates[vendor_device_id] = template
+        return template
+
+    def encode_device_into(self, buf, device, message_uuid=None, created_time=None):
+        """
+        Appends the current message of `device` to the `buf` bytearray, and
+        returns its `message_uuid`. The uuid and the created time default to
+        those of the cached `device.message`.
+        """
+        template = self.template(device.vendor_device_id, device.device_class_id)
+        if message_uuid is None or created_time is None:
+            message = device.message
+            message_uuid = message_uuid or message["message_uuid"]
+            created_time = created_time or message["created_time"]
+        values = device._rvalues
+        if self.quantizer is not None:
+            values = self.quantizer.quantize_values(device.schema, values)
+        template.encode_into(buf, message_uuid, created_time, values.items())
+        return message_uuid
+
+    def encode_message_into(self, buf, message):
+        """
+        Appends an already built message dict to the `buf` bytearray, and
+        returns its `message_uuid`.
+        """
+        template = self.template(
+            message["vendor_device_id"], message["device_class_id"]
+        )
+        values = message["values"]
+        schema = self.schemas.get(message["device_class_id"])
+        if self.quantizer is not None and schema is not None:
+            values = self.quantizer.quantize_values(schema, values)
+        template.encode_into(
+            buf,
+            message["message_uuid"],
+            message["created_time"],
+            values.items(),
+        )
+        return message["message_uuid"]
+
+    def encode_device(self, device):
+        """
+        Encodes the current message of a device.
+        """
+        buf = bytearray()
+        self.encode_device_into(buf, device)
+        return bytes(buf)
+
+    def encode_list(self, items):
+        """
+        Encodes a list of devices and/or message dicts as a JSON array, ready
+        to be published. Returns an `EncodedMessages`.
+        """
+        buf = EncodedMessages(b"[")
+        message_uuids = buf.message_uuids
+        first = True
+        for item in items:
+            if not first:
+                buf += b","
+            first = False
+            if isinstance(item, dict):
+                message_uuids.append(self.encode_message_into(buf, item))
+            else:
+                message_uuids.append(self.encode_device_into(buf, item))
+        buf += b"]"
+        return buf
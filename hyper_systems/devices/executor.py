@@ -0,0 +1,270 @@
+"""
+executor
+
+Execution models for device write bindings (`on_<attribute>_update`).
+
+By default `dispatch` calls write bindings inline. A device can instead hand
+them to an executor with `device.set_executor(executor)`. Executors keep the
+callbacks of a single device in submission order, bound the number of pending
+callbacks and collect the errors raised by callbacks instead of propagating
+them to the dispatching code.
+"""
+import asyncio
+import queue
+import threading
+import time
+from collections import deque
+
+
+class CallbackError(Exception):
+    """
+    An error raised (or a timeout hit) by a write binding.
+    """
+
+    def __init__(self, vendor_device_id, slot, value, error):
+        super().__init__(
+            "write binding for slot %s of device '%s' failed with value %r: %r"
+            % (slot, vendor_device_id, value, error)
+        )
+        self.vendor_device_id = vendor_device_id
+        self.slot = slot
+        self.value = value
+        self.error = error
+
+
+class CallbackExecutor(object):
+    """
+    Base class of the callback executors, running callbacks inline and
+    collecting their errors. Subclasses override `submit` to run them
+    elsewhere.
+    """
+
+    def __init__(self, max_pending=1024, timeout=None, max_errors=1000):
+        self.max_pending = max_pending
+        self.timeout = timeout
+        self._errors = deque(maxlen=max_errors)
+        self._lock = threading.Lock()
+        self._idle = threading.Condition(self._lock)
+        self._slots = threading.BoundedSemaphore(max_pending)
+        self._pending = 0
+
+    @property
+    def pending(self):
+        return self._pending
+
+    @property
+    def errors(self):
+        """
+        The list of collected callback errors.
+        """
+        with self._lock:
+            return list(self._errors)
+
+    def pop_errors(self):
+        """
+        Returns and clears the list of collected callback errors.
+        """
+        with self._lock:
+            errors = list(self._errors)
+            self._errors.clear()
+        return errors
+
+    def _acquire(self, block, timeout):
+        if not self._slots.acquire(block, timeout if block else None):
+            raise queue.Full(
+                "too many pending write binding callbacks (%d)" % self.max_pending
+            )
+        with self._lock:
+            self._pending += 1
+
+    def _release(self, error=None):
+        with self._lock:
+            if error is not None:
+                self._errors.append(error)
+            self._pending -= 1
+            if self._pending == 0:
+                self._idle.notify_all()
+        self._slots.release()
+
+    def join(self, timeout=None):
+        """
+        Waits until all the submitted callbacks have run. Returns False if the
+        timeout expired first.
+        """
+        with self._idle:
+            return self._idle.wait_for(lambda: self._pending == 0, timeout)
+
+    def submit(self, device, slot, f, value):
+        self._acquire(True, None)
+        error = None
+        start = time.monotonic()
+        try:
+            f(value)
+            if self.timeout is not None and time.monotonic() - start > self.timeout:
+                raise TimeoutError("callback took longer than %ss" % self.timeout)
+        except Exception as e:
+            error = CallbackError(device.vendor_device_id, slot, value, e)
+        self._release(error)
+
+
+class InlineExecutor(CallbackExecutor):
+    """
+    Runs callbacks inline, collecting errors instead of raising them.
+    """
+
+
+class ThreadPoolExecutor(CallbackExecutor):
+    """
+    Runs callbacks on a pool of worker threads.
+
+    Callbacks of the same device run one at a time in submission order,
+    callbacks of different devices run concurrently. `submit` blocks for up to
+    `submit_timeout` seconds when `max_pending` callbacks are already queued
+    and raises `queue.Full` after that.
+
+    Threads cannot be interrupted: callbacks running longer than `timeout`
+    seconds are reported as errors once they complete.
+    """
+
+    def __init__(
+        self,
+        workers=4,
+        max_pending=1024,
+        timeout=None,
+        submit_timeout=None,
+        max_errors=1000,
+    ):
+        super().__init__(
+            max_pending=max_pending, timeout=timeout, max_errors=max_errors
+        )
+        self.submit_timeout = submit_timeout
+        self._queues = {}
+        self._ready = queue.Queue()
+        self._threads = [
+            threading.Thread(target=self._work, daemon=True) for _ in range(workers)
+        ]
+        for thread in self._threads:
+            thread.start()
+
+    def submit(self, device, slot, f, value):
+        self._acquire(True, self.submit_timeout)
+        key = device.vendor_device_id
+        task = (key, slot, f, value)
+        with self._lock:
+            tasks = self._queues.get(key)
+            if tasks is None:
+                self._queues[key] = deque([task])
+                self._ready.put(key)
+            else:
+                tasks.append(task)
+
+    def _work(self):
+        while True:
+            key = self._ready.get()
+            if key is None:
+                return
+            with self._lock:
+                (vendor_device_id, slot, f, value) = self._queues[key][0]
+            error = None
+            start = time.monotonic()
+            try:
+                f(value)
+                if self.timeout is not None and time.monotonic() - start > self.timeout:
+                    raise TimeoutError("callback took longer than %ss" % self.timeout)
+            except Exception as e:
+                error = CallbackError(vendor_device_id, slot, value, e)
+            with self._lock:
+                tasks = self._queues[key]
+                tasks.popleft()
+                if tasks:
+                    self._ready.put(key)
+                else:
+                    del self._queues[key]
+            self._release(error)
+
+    def shutdown(self, wait=True):
+        """
+        Stops the worker threads once the pending callbacks have run.
+        """
+        if wait:
+            self.join()
+        for _ in self._threads:
+            self._ready.put(None)
+        if wait:
+            for thread in self._threads:
+                thread.join()
+
+
+class AsyncioExecutor(CallbackExecutor):
+    """
+    Runs callbacks on an asyncio event loop.
+
+    Coroutine functions are awaited on the loop and cancelled after `timeout`
+    seconds, plain functions are called on the loop. Callbacks of the same
+    device run one at a time in submission order.
+
+    `submit` can be called from any thread. From the loop thread it never
+    blocks and raises `queue.Full` immediately when `max_pending` callbacks
+    are already queued.
+    """
+
+    def __init__(
+        self,
+        loop,
+        max_pending=1024,
+        timeout=None,
+        submit_timeout=None,
+        max_errors=1000,
+    ):
+        super().__init__(
+            max_pending=max_pending, timeout=timeout, max_errors=max_errors
+        )
+        self.loop = loop
+        self.submit_timeout = submit_timeout
+        self._tails = {}
+
+    def submit(self, device, slot, f, value):
+        try:
+            in_loop = asyncio.get_running_loop() is self.loop
+        except RuntimeError:
+            in_loop = False
+        self._acquire(not in_loop, self.submit_timeout)
+        task = (device.vendor_device_id, slot, f, value)
+        if in_loop:
+            self._schedule(task)
+        else:
+            self.loop.call_soon_threadsafe(self._schedule, task)
+
+    def _schedule(self, task):
+        key = task[0]
+        previous = self._tails.get(key)
+        self._tails[key] = self.loop.create_task(self._run(previous, task))
+
+    async def _run(self, previous, task):
+        (vendor_device_id, slot, f, value) = task
+        if previous is not None:
+            await asyncio.wait([previous])
+        error = None
+        try:
+            result = f(value)
+            if asyncio.iscoroutine(result):
+                await asyncio.wait_for(result, self.timeout)
+        except asyncio.TimeoutError:
+            error = CallbackError(
+                vendor_device_id,
+                slot,
+                value,
+                TimeoutError("callback took longer than %ss" % self.timeout),
+            )
+        except Exception as e:
+            error = CallbackError(vendor_device_id, slot, value, e)
+        if self._tails.get(vendor_device_id) is asyncio.current_task():
+            del self._tails[vendor_device_id]
+        self._release(error)
+
+    async def drain(self):
+        """
+        Waits, on the loop, until all the submitted callbacks have run.
+        """
+        while self._tails:
+            await asyncio.wait(list(self._tails.values()))
@@ -0,0 +1,75 @@
+"""
+fleet
+"""
+from .device import dispatch_many
+from .encoding import MessageEncoder
+
+
+class Fleet(object):
+    """
+    A collection of devices indexed by their vendor device id.
+    """
+
+    def __init__(self, devices=()):
+        self._devices = {}
+        for device in devices:
+            self.add(device)
+
+    def add(self, device):
+        if device.vendor_device_id in self._devices:
+            raise ValueError(
+                "a device with id '%s' is already part of the fleet"
+                % device.vendor_device_id
+            )
+        self._devices[device.vendor_device_id] = device
+
+    def remove(self, vendor_device_id):
+        return self._devices.pop(vendor_device_id)
+
+    def get(self, vendor_device_id, default=None):
+        return self._devices.get(vendor_device_id, default)
+
+    def __getitem__(self, vendor_device_id):
+        return self._devices[vendor_device_id]
+
+    def __contains__(self, vendor_device_id):
+        return vendor_device_id in self._devices
+
+    def __iter__(self):
+        return iter(self._devices.values())
+
+    def __len__(self):
+        return len(self._devices)
+
+    def dispatch_many(self, messages):
+        """
+        Applies a list of incoming messages (or a `DeviceMessageList`) to the
+        devices of the fleet, see `device.dispatch_many`.
+        """
+        return dispatch_many(self._devices, messages)
+
+    def set_profiler(self, profiler):
+        """
+        Sets the profiler of all the devices of the fleet, see
+        `hyper_systems.devices.profiling`.
+        """
+        for device in self:
+            device.set_profiler(profiler)
+
+    def messages(self, quantizer=None):
+        """
+        Produces the current messages of all the devices of the fleet,
+        optionally with float values rounded by a `Quantizer`.
+        """
+        if quantizer is None:
+            return [device.message for device in self]
+        return [
+            quantizer.quantize_message(device.schema, device.message) for device in self
+        ]
+
+    def encode(self, encoder=None):
+        """
+        Encodes the current messages of all the devices of the fleet as a JSON
+        array, ready to be published.
+        """
+        return (encoder or MessageEncoder()).encode_list(self)
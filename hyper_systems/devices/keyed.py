@@ -0,0 +1,369 @@
+"""
+keyed
+
+Containers for the values of `Keyed` attributes, e.g. `["Keyed", "Float32"]`.
+
+`KeyedValues` is the dict used by default for keyed attributes. `KeyedArray`
+is a compact alternative for numeric inner formats that stores the keys in a
+list and the values in an `array.array`.
+"""
+import sys
+from array import array
+
+_INT_FORMATS = (
+    "Int8",
+    "Int16",
+    "Int32",
+    "Int64",
+    "Uint8",
+    "Uint16",
+    "Uint32",
+    "Uint64",
+)
+
+_INT_RANGES = {
+    "Int8": (-(2**7), 2**7 - 1),
+    "Int16": (-(2**15), 2**15 - 1),
+    "Int32": (-(2**31), 2**31 - 1),
+    "Int64": (-(2**63), 2**63 - 1),
+    "Uint8": (0, 2**8 - 1),
+    "Uint16": (0, 2**16 - 1),
+    "Uint32": (0, 2**32 - 1),
+    "Uint64": (0, 2**64 - 1),
+}
+
+# largest finite float32
+_FLOAT32_MAX = 3.4028234663852886e38
+
+ARRAY_TYPECODES = {
+    "Int8": "b",
+    "Int16": "h",
+    "Int32": "i",
+    "Int64": "q",
+    "Uint8": "B",
+    "Uint16": "H",
+    "Uint32": "I",
+    "Uint64": "Q",
+    "Float32": "f",
+    "Float64": "d",
+}
+
+
+def make_value_check(slot, slug, inner_format):
+    """
+    Produces the (python type, check function) pair for the values of a keyed
+    attribute with the given inner format.
+
+    The check function returns the value to store, ints are accepted and
+    converted for float formats.
+    """
+    kind = inner_format.kind
+
+    def invalid(key, value, expected):
+        return TypeError(
+            "value '%s' for key '%s' of keyed attribute slot `%s` (`%s`) has an invalid type: expected %s, got %s"
+            % (value, key, slot, slug, expected.__name__, type(value).__name__)
+        )
+
+    def out_of_range(key, value, low, high):
+        return TypeError(
+            "value %s for key '%s' of keyed attribute slot `%s` (`%s`) is out of range: expected %s to %s"
+            % (value, key, slot, slug, low, high)
+        )
+
+    if kind in _INT_FORMATS:
+        (low, high) = _INT_RANGES[kind]
+
+        def check(key, value):
+            if not isinstance(value, int):
+                raise invalid(key, value, int)
+            if not low <= value <= high:
+                raise out_of_range(key, value, low, high)
+            return value
+
+        return (int, check)
+    if kind in ("Float32", "Float64"):
+        high = _FLOAT32_MAX if kind == "Float32" else sys.float_info.max
+
+        def check(key, value):
+            if isinstance(value, int) and not isinstance(value, bool):
+                if not -high <= value <= high:
+                    raise out_of_range(key, value, -high, high)
+                return float(value)
+            if not isinstance(value, float):
+                raise invalid(key, value, float)
+            if not -high <= value <= high and value - value == 0.0:
+                # finite values too large for a float32
+                raise out_of_range(key, value, -high, high)
+            return value
+
+        return (float, check)
+    if kind == "Bool":
+
+        def check(key, value):
+            if not isinstance(value, bool):
+                raise invalid(key, value, bool)
+            return value
+
+        return (bool, check)
+    if kind == "Data":
+
+        def check(key, value):
+            if not isinstance(value, str):
+                raise invalid(key, value, str)
+            return value
+
+        return (str, check)
+    if kind == "Enum":
+        valid_values = list(map(int, inner_format.value.value.keys()))
+        valid_set = frozenset(valid_values)
+
+        def check(key, value):
+            if not isinstance(value, int):
+                raise invalid(key, value, int)
+            if value not in valid_set:
+                raise TypeError(
+                    "value %s for key '%s' of keyed attribute slot `%s` (`%s`) is invalid: expected one of: %s"
+                    % (value, key, slot, slug, valid_values)
+                )
+            return value
+
+        return (int, check)
+    raise Exception("Invalid keyed attribute format " + str(inner_format))
+
+
+def _key_error(slot, slug, py_type):
+    return TypeError(
+        "keyed attribute slot `%s` (`%s`) must be a dict[string, %s]"
+        % (slot, slug, py_type.__name__)
+    )
+
+
+def _items(args, kwargs):
+    if len(args) > 1:
+        raise TypeError("update expected at most 1 argument, got %d" % len(args))
+    items = []
+    if args:
+        other = args[0]
+        if hasattr(other, "keys"):
+            items.extend((key, other[key]) for key in other.keys())
+        else:
+            items.extend(other)
+    items.extend(kwargs.items())
+    return items
+
+
+def _changed(container):
+    owner = container.owner
+    if owner is not None:
+        owner._message = None
+
+
+class KeyedValues(dict):
+    """
+    A dict of keyed attribute values that validates keys and values.
+
+    Keys must be strings and are interned, values must match the inner format
+    of the keyed attribute.
+
+    `owner` is the object whose cached `_message` is cleared by changes (the
+    device holding the values, or its class), so that a changed container is
+    published in a new message.
+    """
+
+    __slots__ = ("slot", "slug", "owner", "_py_type", "_check")
+
+    def __init__(self, slot, slug, inner_format, values=None):
+        super().__init__()
+        self.slot = slot
+        self.slug = slug
+        self.owner = None
+        (self._py_type, self._check) = make_value_check(slot, slug, inner_format)
+        if values:
+            self.update(values)
+
+    def __setitem__(self, key, value):
+        if not isinstance(key, str):
+            raise _key_error(self.slot, self.slug, self._py_type)
+        dict.__setitem__(self, sys.intern(key), self._check(key, value))
+        _changed(self)
+
+    def __delitem__(self, key):
+        dict.__delitem__(self, key)
+        _changed(self)
+
+    def setdefault(self, key, default=None):
+        if key not in self:
+            self[key] = default
+        return self[key]
+
+    def pop(self, *args):
+        value = dict.pop(self, *args)
+        _changed(self)
+        return value
+
+    def popitem(self):
+        item = dict.popitem(self)
+        _changed(self)
+        return item
+
+    def clear(self):
+        dict.clear(self)
+        _changed(self)
+
+    def update(self, *args, **kwargs):
+        """
+        Validates all the given items first and then stores them in one pass.
+        """
+        check = self._check
+        validated = {}
+        for (key, value) in _items(args, kwargs):
+            if not isinstance(key, str):
+                raise _key_error(self.slot, self.slug, self._py_type)
+            validated[sys.intern(key)] = check(key, value)
+        dict.update(self, validated)
+        _changed(self)
+
+    def to_dict(self):
+        return dict(self)
+
+    def __reduce__(self):
+        # the value check is a closure, pickle as a plain dict
+        return (dict, (dict(self),))
+
+
+class KeyedArray(object):
+    """
+    A compact mapping of keyed attribute values for numeric inner formats.
+
+    Keys are kept in a list with a key -> position index, values in an
+    `array.array` of the inner format, e.g. 4 bytes per value for `Float32`.
+    Values read back from a `Float32` store have float32 precision. Changes
+    clear the cached message of `owner`, see `KeyedValues`.
+    """
+
+    __slots__ = (
+        "slot",
+        "slug",
+        "owner",
+        "_py_type",
+        "_check",
+        "_index",
+        "_keys",
+        "_values",
+    )
+
+    def __init__(self, slot, slug, inner_format, values=None):
+        typecode = ARRAY_TYPECODES.get(inner_format.kind)
+        if typecode is None:
+            raise TypeError(
+                "keyed attribute slot `%s` (`%s`) with format %s cannot be stored in an array"
+                % (slot, slug, inner_format.kind)
+            )
+        self.slot = slot
+        self.slug = slug
+        self.owner = None
+        (self._py_type, self._check) = make_value_check(slot, slug, inner_format)
+        self._index = {}
+        self._keys = []
+        self._values = array(typecode)
+        if values:
+            self.update(values)
+
+    def __len__(self):
+        return len(self._keys)
+
+    def __iter__(self):
+        return iter(self._keys)
+
+    def __contains__(self, key):
+        return key in self._index
+
+    def __getitem__(self, key):
+        return self._values[self._index[key]]
+
+    def get(self, key, default=None):
+        i = self._index.get(key)
+        return default if i is None else self._values[i]
+
+    def __setitem__(self, key, value):
+        if not isinstance(key, str):
+            raise _key_error(self.slot, self.slug, self._py_type)
+        value = self._check(key, value)
+        i = self._index.get(key)
+        if i is None:
+            # store the value first, so that a failure leaves no key behind
+            self._values.append(value)
+            key = sys.intern(key)
+            self._index[key] = len(self._keys)
+            self._keys.append(key)
+        else:
+            self._values[i] = value
+        _changed(self)
+
+    def __delitem__(self, key):
+        i = self._index.pop(key)
+        last_key = self._keys.pop()
+        last_value = self._values.pop()
+        if i < len(self._keys):
+            # move the last entry into the freed position
+            self._keys[i] = last_key
+            self._values[i] = last_value
+            self._index[last_key] = i
+        _changed(self)
+
+    def keys(self):
+        return list(self._keys)
+
+    def values(self):
+        return self._values.tolist()
+
+    def items(self):
+        return list(zip(self._keys, self._values.tolist()))
+
+    def update(self, *args, **kwargs):
+        """
+        Validates all the given items first and then stores them in one pass.
+        """
+        check = self._check
+        validated = []
+        for (key, value) in _items(args, kwargs):
+            if not isinstance(key, str):
+                raise _key_error(self.slot, self.slug, self._py_type)
+            validated.append((key, check(key, value)))
+        # fails before any change if a value does not fit the array
+        array(self._values.typecode, [value for (_key, value) in validated])
+        index = self._index
+        keys = self._keys
+        values = self._values
+        new_values = []
+        for (key, value) in validated:
+            i = index.get(key)
+            if i is None:
+                key = sys.intern(key)
+                index[key] = len(keys)
+                keys.append(key)
+                new_values.append(value)
+            elif i < len(values):
+                values[i] = value
+            else:
+                new_values[i - len(values)] = value
+        values.extend(new_values)
+        _changed(self)
+
+    def clear(self):
+        self._index.clear()
+        del self._keys[:]
+        del self._values[:]
+        _changed(self)
+
+    def to_dict(self):
+        return dict(zip(self._keys, self._values.tolist()))
+
+    def __eq__(self, other):
+        if isinstance(other, KeyedArray):
+            other = other.to_dict()
+        return self.to_dict() == other
+
+    def __repr__(self):
+        return repr(self.to_dict())
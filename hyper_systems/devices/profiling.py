@@ -0,0 +1,315 @@
+"""
+profiling
+
+Opt-in profiling of devices: per-slot access counters and timing histograms
+per device class, exportable as a dict or in the Prometheus text format.
+
+A profiler is attached to a device with `device.set_profiler(profiler)` (or
+to all the devices of a fleet with `fleet.set_profiler(profiler)`). It then
+counts:
+
+- the reads and writes of every slot, and the values received through
+  `dispatch` / `dispatch_many`, per device class and slot,
+- the values received per device,
+
+and times, for a sample of the operations:
+
+- the validation of incoming messages, per device class,
+- the building of device messages, per device class,
+- the write binding callbacks, per device class and slot, and their total
+  time per device.
+"""
+import random
+import threading
+import time
+from bisect import bisect_left
+
+# upper bounds (in seconds) of the timing histogram buckets
+DEFAULT_BUCKETS = (
+    1e-6,
+    5e-6,
+    1e-5,
+    5e-5,
+    1e-4,
+    5e-4,
+    1e-3,
+    5e-3,
+    1e-2,
+    5e-2,
+    0.1,
+    0.5,
+    1.0,
+    5.0,
+)
+
+
+class Histogram(object):
+    """
+    A fixed-bucket histogram of durations in seconds.
+    """
+
+    __slots__ = ("buckets", "counts", "count", "sum")
+
+    def __init__(self, buckets=DEFAULT_BUCKETS):
+        self.buckets = buckets
+        self.counts = [0] * (len(buckets) + 1)
+        self.count = 0
+        self.sum = 0.0
+
+    def observe(self, seconds):
+        self.counts[bisect_left(self.buckets, seconds)] += 1
+        self.count += 1
+        self.sum += seconds
+
+    def to_dict(self):
+        cumulative = []
+        total = 0
+        for count in self.counts[:-1]:
+            total += count
+            cumulative.append(total)
+        return {
+            "buckets": dict(zip(self.buckets, cumulative)),
+            "count": self.count,
+            "sum": self.sum,
+        }
+
+
+def _labels(**labels):
+    return ",".join(
+        '%s="%s"' % (name, str(value).replace("\\", "\\\\").replace('"', '\\"'))
+        for (name, value) in labels.items()
+    )
+
+
+class Profiler(object):
+    """
+    Collects the profiling data of the devices it is attached to.
+
+    Counters are exact. Timings are only measured for a `sample_rate`
+    fraction of the operations, to keep the overhead low.
+    """
+
+    def __init__(self, sample_rate=1.0, buckets=DEFAULT_BUCKETS, clock=None):
+        if not 0.0 <= sample_rate <= 1.0:
+            raise ValueError("the sample rate must be between 0 and 1")
+        self.sample_rate = sample_rate
+        self.buckets = buckets
+        self.clock = clock or time.perf_counter
+        self._random = random.random
+        self._lock = threading.Lock()
+        self.reset()
+
+    def reset(self):
+        """
+        Clears all the collected data.
+        """
+        with self._lock:
+            self.gets = {}
+            self.sets = {}
+            self.incoming = {}
+            self.device_incoming = {}
+            self.device_callback_time = {}
+            self.validation = {}
+            self.message_build = {}
+            self.callbacks = {}
+
+    def start(self):
+        """
+        Returns the start time of a timed operation, or None if the operation
+        is not sampled.
+        """
+        if self.sample_rate >= 1.0 or self._random() < self.sample_rate:
+            return self.clock()
+        return None
+
+    def _observe(self, histograms, key, start):
+        seconds = self.clock() - start
+        with self._lock:
+            histogram = histograms.get(key)
+            if histogram is None:
+                histogram = histograms[key] = Histogram(self.buckets)
+            histogram.observe(seconds)
+        return seconds
+
+    def count_get(self, device, slot):
+        key = (device.device_class_id, str(slot))
+        with self._lock:
+            self.gets[key] = self.gets.get(key, 0) + 1
+
+    def count_set(self, device, slot):
+        key = (device.device_class_id, str(slot))
+        with self._lock:
+            self.sets[key] = self.sets.get(key, 0) + 1
+
+    def count_incoming(self, device, values):
+        device_class_id = device.device_class_id
+        incoming = self.incoming
+        with self._lock:
+            for slot in values:
+                key = (device_class_id, slot)
+                incoming[key] = incoming.get(key, 0) + 1
+            key = device.vendor_device_id
+            self.device_incoming[key] = self.device_incoming.get(key, 0) + len(values)
+
+    def observe_validation(self, device, start):
+        self._observe(self.validation, device.device_class_id, start)
+
+    def observe_message_build(self, device, start):
+        self._observe(self.message_build, device.device_class_id, start)
+
+    def observe_callback(self, device, slot, start):
+        seconds = self._observe(self.callbacks, (device.device_class_id, slot), start)
+        with self._lock:
+            key = device.vendor_device_id
+            self.device_callback_time[key] = (
+                self.device_callback_time.get(key, 0.0) + seconds
+            )
+
+    def wrap_callback(self, device, slot, f):
+        """
+        Returns a write binding that times `f`, for callbacks run by an
+        executor.
+        """
+
+        def timed(value):
+            start = self.start()
+            try:
+                return f(value)
+            finally:
+                if start is not None:
+                    self.observe_callback(device, slot, start)
+
+        return timed
+
+    def top_devices(self, n=10):
+        """
+        Returns the `n` devices that received the most values, as a list of
+        (vendor device id, values received, sampled callback seconds).
+        """
+        with self._lock:
+            device_incoming = dict(self.device_incoming)
+            callback_time = dict(self.device_callback_time)
+        devices = set(device_incoming) | set(callback_time)
+        ranked = sorted(
+            devices,
+            key=lambda d: (device_incoming.get(d, 0), callback_time.get(d, 0.0)),
+            reverse=True,
+        )
+        return [
+            (d, device_incoming.get(d, 0), callback_time.get(d, 0.0))
+            for d in ranked[:n]
+        ]
+
+    def to_dict(self):
+        """
+        Returns the collected data as a JSON-serialisable dict.
+        """
+        with self._lock:
+            slots = {}
+            for (name, counters) in (
+                ("gets", self.gets),
+                ("sets", self.sets),
+                ("incoming", self.incoming),
+            ):
+                for ((device_class_id, slot), count) in counters.items():
+                    entry = slots.setdefault(str(device_class_id), {}).setdefault(
+                        slot, {"gets": 0, "sets": 0, "incoming": 0}
+                    )
+                    entry[name] = count
+            return {
+                "sample_rate": self.sample_rate,
+                "slots": slots,
+                "devices": {
+                    d: {
+                        "incoming": self.device_incoming.get(d, 0),
+                        "callback_seconds": self.device_callback_time.get(d, 0.0),
+                    }
+                    for d in set(self.device_incoming) | set(self.device_callback_time)
+                },
+                "validation": {
+                    str(k): h.to_dict() for (k, h) in self.validation.items()
+                },
+                "message_build": {
+                    str(k): h.to_dict() for (k, h) in self.message_build.items()
+                },
+                "callbacks": {
+                    "%s/%s" % k: h.to_dict() for (k, h) in self.callbacks.items()
+                },
+            }
+
+    def to_prometheus(self, prefix="hyper_devices", max_devices=20):
+        """
+        Returns the collected data in the Prometheus text exposition format.
+
+        Only the `max_devices` devices that received the most values are
+        exported, to bound the number of series.
+        """
+        lines = []
+
+        def counter(name, doc, counters, label_names):
+            lines.append("# HELP %s_%s %s" % (prefix, name, doc))
+            lines.append("# TYPE %s_%s counter" % (prefix, name))
+            for (key, value) in sorted(counters.items(), key=lambda kv: str(kv[0])):
+                labels = _labels(**dict(zip(label_names, key)))
+                lines.append("%s_%s{%s} %s" % (prefix, name, labels, value))
+
+        def histogram(name, doc, histograms, label_names):
+            lines.append("# HELP %s_%s %s" % (prefix, name, doc))
+            lines.append("# TYPE %s_%s histogram" % (prefix, name))
+            for (key, h) in sorted(histograms.items(), key=lambda kv: str(kv[0])):
+                labels = _labels(**dict(zip(label_names, key)))
+                total = 0
+                for (bound, count) in zip(h.buckets, h.counts):
+                    total += count
+                    lines.append(
+                        '%s_%s_bucket{%s,le="%r"} %d'
+                        % (prefix, name, labels, bound, total)
+                    )
+                lines.append(
+                    '%s_%s_bucket{%s,le="+Inf"} %d' % (prefix, name, labels, h.count)
+                )
+                lines.append("%s_%s_sum{%s} %r" % (prefix, name, labels, h.sum))
+                lines.append("%s_%s_count{%s} %d" % (prefix, name, labels, h.count))
+
+        slot_labels = ("device_class_id", "slot")
+        top = self.top_devices(max_devices)
+        with self._lock:
+            counter("slot_gets_total", "Slot reads.", self.gets, slot_labels)
+            counter("slot_sets_total", "Slot writes.", self.sets, slot_labels)
+            counter(
+                "slot_incoming_total",
+                "Values received through dispatch.",
+                self.incoming,
+                slot_labels,
+            )
+            counter(
+                "device_incoming_total",
+                "Values received through dispatch per device.",
+                {(d,): incoming for (d, incoming, _seconds) in top},
+                ("vendor_device_id",),
+            )
+            counter(
+                "device_callback_seconds_total",
+                "Sampled write binding time per device.",
+                {(d,): seconds for (d, _incoming, seconds) in top},
+                ("vendor_device_id",),
+            )
+            histogram(
+                "validation_seconds",
+                "Sampled validation time of incoming messages.",
+                {(k,): h for (k, h) in self.validation.items()},
+                ("device_class_id",),
+            )
+            histogram(
+                "message_build_seconds",
+                "Sampled device message build time.",
+                {(k,): h for (k, h) in self.message_build.items()},
+                ("device_class_id",),
+            )
+            histogram(
+                "callback_seconds",
+                "Sampled write binding time.",
+                self.callbacks,
+                slot_labels,
+            )
+        return "\n".join(lines) + "\n"
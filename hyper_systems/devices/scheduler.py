@@ -0,0 +1,260 @@
+"""
+scheduler
+
+Periodic publishing of device messages, following each device's publish
+interval attribute.
+"""
+import heapq
+import threading
+import time
+import uuid
+from datetime import datetime
+
+# seconds per unit of the publish interval attributes
+INTERVAL_UNITS = {
+    None: 1.0,
+    "None": 1.0,
+    "second": 1.0,
+    "millisecond": 0.001,
+    "minute": 60.0,
+}
+
+
+def publish_interval_slot(schema):
+    """
+    Returns the (slot, seconds per unit) of the publish interval attribute of
+    a schema, or None if the schema has none.
+    """
+    for (slot, attr) in schema.attributes.items():
+        if (attr.name or "").lower().startswith("publish interval"):
+            return (slot, INTERVAL_UNITS.get(attr.unit, 1.0))
+    return None
+
+
+class PublishScheduler(object):
+    """
+    Publishes the messages of many devices, each at its own interval.
+
+    The interval of a device is read from its publish interval attribute (e.g.
+    `publish_interval_s_6` of schema 12), or is `default_interval` seconds
+    when the schema has none or the value is unset. Changes of the interval
+    received through `dispatch` are applied immediately.
+
+    Due times are kept in a heap, with stale entries skipped when popped, so a
+    `tick` costs O(log n) per due device and nothing for the others. All the
+    devices due in the same tick are published with a single call to
+    `publish(messages)` (e.g. `client.publish_device_message_list`), split in
+    lists of at most `max_batch` messages.
+
+    A device whose message did not change since its last publication is
+    published again with a new `message_uuid` and `created_time`.
+    """
+
+    def __init__(
+        self, publish, default_interval=None, max_batch=1000, clock=time.monotonic
+    ):
+        self.publish = publish
+        self.default_interval = default_interval
+        self.max_batch = max_batch
+        self.clock = clock
+        self.published = 0
+        self.last_error = None
+        self._heap = []
+        self._entries = {}
+        self._last_messages = {}
+        self._interval_slots = {}
+        self._lock = threading.Lock()
+        self._wakeup = threading.Condition(self._lock)
+        self._thread = None
+        self._stopped = False
+
+    def __len__(self):
+        return len(self._entries)
+
+    def __contains__(self, vendor_device_id):
+        return vendor_device_id in self._entries
+
+    def _interval_slot(self, device):
+        schema = device.schema
+        found = self._interval_slots.get(schema.id)
+        if found is None or found[0] is not schema:
+            found = self._interval_slots[schema.id] = (
+                schema,
+                publish_interval_slot(schema),
+            )
+        return found[1]
+
+    def interval(self, device):
+        """
+        Returns the current publish interval of a device in seconds, or None.
+        """
+        found = self._interval_slot(device)
+        if found is not None:
+            (slot, unit) = found
+            value = device._rvalues.get(slot)
+            if value is not None:
+                return value * unit
+        return self.default_interval
+
+    def _schedule(self, device, due, interval):
+        # called with the lock held
+        vendor_device_id = device.vendor_device_id
+        if interval is None or interval <= 0:
+            self._entries[vendor_device_id] = (device, None, None)
+            return
+        self._entries[vendor_device_id] = (device, due, interval)
+        heapq.heappush(self._heap, (due, vendor_device_id))
+        if self._heap[0][1] == vendor_device_id:
+            self._wakeup.notify()
+
+    def add(self, device, now=None):
+        """
+        Schedules a device, its first message is due after one interval.
+        """
+        now = self.clock() if now is None else now
+        interval = self.interval(device)
+        with self._lock:
+            if device.vendor_device_id in self._entries:
+                raise ValueError(
+                    "device '%s' is already scheduled" % device.vendor_device_id
+                )
+            self._schedule(
+                device, None if interval is None else now + interval, interval
+            )
+        device.add_listener(self._on_update)
+
+    def remove(self, vendor_device_id):
+        """
+        Stops publishing the messages of a device.
+        """
+        with self._lock:
+            (device, _due, _interval) = self._entries.pop(vendor_device_id)
+            self._last_messages.pop(vendor_device_id, None)
+        device.remove_listener(self._on_update)
+
+    def _on_update(self, device, values):
+        found = self._interval_slot(device)
+        if found is None or found[0] not in values:
+            return
+        interval = self.interval(device)
+        now = self.clock()
+        with self._lock:
+            entry = self._entries.get(device.vendor_device_id)
+            if entry is None or entry[2] == interval:
+                return
+            (_device, due, previous) = entry
+            # keep the time of the last publication as the reference
+            last = now if due is None else due - previous
+            if interval is not None:
+                due = max(now, last + interval)
+            self._schedule(device, due, interval)
+
+    def next_due(self):
+        """
+        Returns the time the next device is due, or None.
+        """
+        with self._lock:
+            self._discard_stale()
+            return self._heap[0][0] if self._heap else None
+
+    def _discard_stale(self):
+        heap = self._heap
+        entries = self._entries
+        while heap:
+            (due, vendor_device_id) = heap[0]
+            entry = entries.get(vendor_device_id)
+            if entry is not None and entry[1] == due:
+                return
+            heapq.heappop(heap)
+
+    def _message(self, device, created_time):
+        message = device.message
+        vendor_device_id = device.vendor_device_id
+        if self._last_messages.get(vendor_device_id) is message:
+            message = dict(
+                message, message_uuid=str(uuid.uuid4()), created_time=created_time
+            )
+        else:
+            self._last_messages[vendor_device_id] = message
+        return message
+
+    def due(self, now=None):
+        """
+        Pops the devices due at `now` and schedules their next publication.
+        """
+        now = self.clock() if now is None else now
+        devices = []
+        with self._lock:
+            heap = self._heap
+            entries = self._entries
+            while heap and heap[0][0] <= now:
+                (due, vendor_device_id) = heapq.heappop(heap)
+                entry = entries.get(vendor_device_id)
+                if entry is None or entry[1] != due:
+                    continue
+                (device, _due, interval) = entry
+                devices.append(device)
+                due += interval
+                if due <= now:
+                    # too far behind, do not publish the missed periods
+                    due = now + interval
+                entries[vendor_device_id] = (device, due, interval)
+                heapq.heappush(heap, (due, vendor_device_id))
+        return devices
+
+    def tick(self, now=None):
+        """
+        Publishes the messages of all the devices due at `now`. Returns the
+        number of published messages.
+        """
+        devices = self.due(now)
+        if not devices:
+            return 0
+        created_time = datetime.utcnow().strftime("%Y-%m-%dT%H:%M:%SZ")
+        with self._lock:
+            messages = [self._message(device, created_time) for device in devices]
+        for start in range(0, len(messages), self.max_batch):
+            batch = messages[start : start + self.max_batch]
+            self.publish(batch)
+            self.published += len(batch)
+        return len(messages)
+
+    def start(self):
+        """
+        Starts a background thread publishing the due messages. Publishing
+        errors are kept in `last_error`.
+        """
+
+        def loop():
+            while True:
+                with self._lock:
+                    while not self._stopped:
+                        self._discard_stale()
+                        timeout = (
+                            self._heap[0][0] - self.clock() if self._heap else None
+                        )
+                        if timeout is not None and timeout <= 0:
+                            break
+                        self._wakeup.wait(timeout)
+                    if self._stopped:
+                        return
+                try:
+                    self.tick()
+                except Exception as e:
+                    self.last_error = e
+
+        with self._lock:
+            self._stopped = False
+        self._thread = threading.Thread(target=loop, daemon=True)
+        self._thread.start()
+
+    def stop(self):
+        """
+        Stops the background thread.
+        """
+        with self._lock:
+            self._stopped = True
+            self._wakeup.notify_all()
+        if self._thread is not None:
+            self._thread.join()
+            self._thread = None
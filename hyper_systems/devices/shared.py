@@ -0,0 +1,371 @@
+"""
+shared
+
+Device values in a shared memory segment, written by one process and read
+by any number of processes of the host without serialising them.
+
+A segment holds the devices of one schema in fixed size records, whose
+layout is derived from the read slots of the schema:
+
+    header  magic "HYSH", version (u16), capacity (u32), device count (u32),
+            record size (u32), schema digest (32 bytes)
+    record  sequence number (u32), vendor device id (u8 length, 63 bytes),
+            presence bitmap of the read slots, then one field per read slot:
+            integers, enums and bools with their own size, floats as doubles,
+            data as a u16 length and twice the data size in bytes, keyed
+            values as a u16 length and `keyed_size` bytes of JSON
+
+Records are updated with a seqlock: the writer makes the sequence number odd
+before changing a record, and even again afterwards. Readers copy a record
+and retry while the sequence number was odd or changed during the copy, so
+they never see a partly written record. Requires python >= 3.8.
+"""
+import hashlib
+import json
+import struct
+import time
+
+MAGIC = b"HYSH"
+VERSION = 1
+ID_SIZE = 63
+
+_header = struct.Struct("<4sHxxIII32s")
+_seq = struct.Struct("<I")
+_HEADER_SIZE = 64
+_COUNT_OFFSET = struct.calcsize("<4sHxxI")
+# seconds a reader waits for a record being written
+READ_TIMEOUT = 1.0
+
+_FORMATS = {
+    "Int8": "b",
+    "Int16": "h",
+    "Int32": "i",
+    "Int64": "q",
+    "Uint8": "B",
+    "Uint16": "H",
+    "Uint32": "I",
+    "Uint64": "Q",
+    "Float32": "d",
+    "Float64": "d",
+    "Enum": "q",
+    "Bool": "?",
+}
+
+
+def schema_digest(schema):
+    """
+    Returns the digest identifying a schema and the store format.
+    """
+    digest = hashlib.sha256(b"HYSH:%d:" % VERSION)
+    digest.update(json.dumps(schema.to_json(), sort_keys=True).encode())
+    return digest.digest()
+
+
+class SharedLayout(object):
+    """
+    The record layout of a schema: the read slots, their kinds and the
+    struct of the record fields after the sequence number.
+    """
+
+    def __init__(self, schema, keyed_size=256):
+        self.slots = sorted(
+            (slot for (slot, attr) in schema.attributes.items() if attr.access.read),
+            key=int,
+        )
+        self.kinds = [schema.attributes[slot].format.kind for slot in self.slots]
+        self.bitmap_size = (len(self.slots) + 7) // 8
+        fields = ["B%ds%ds" % (ID_SIZE, self.bitmap_size)]
+        self.sizes = []
+        for (slot, kind) in zip(self.slots, self.kinds):
+            if kind == "Data":
+                size = 2 * max(1, schema.attributes[slot].format.value.value)
+            elif kind == "Keyed":
+                size = keyed_size
+            else:
+                fields.append(_FORMATS[kind])
+                self.sizes.append(None)
+                continue
+            fields.append("H%ds" % size)
+            self.sizes.append(size)
+        self.struct = struct.Struct("<" + "".join(fields))
+        # records are aligned on 8 bytes
+        self.record_size = (_seq.size + self.struct.size + 7) // 8 * 8
+
+    def pack(self, vendor_device_id, values):
+        """
+        Returns the bytes of a record, without its sequence number.
+        """
+        device_id = vendor_device_id.encode()
+        if len(device_id) > ID_SIZE:
+            raise ValueError(
+                "the vendor device id '%s' is longer than %d bytes"
+                % (vendor_device_id, ID_SIZE)
+            )
+        bitmap = 0
+        fields = []
+        for (i, (slot, kind, size)) in enumerate(
+            zip(self.slots, self.kinds, self.sizes)
+        ):
+            value = values.get(slot)
+            if value is not None:
+                bitmap |= 1 << i
+            if size is None:
+                fields.append(
+                    (0.0 if kind.startswith("Float") else 0) if value is None else value
+                )
+                continue
+            if value is None:
+                data = b""
+            elif kind == "Keyed":
+                if type(value) is not dict:
+                    value = value.to_dict()
+                data = json.dumps(value, separators=(",", ":")).encode()
+            else:
+                data = value.encode()
+            if len(data) > size:
+                raise ValueError(
+                    "the value of slot %s does not fit in its %d bytes" % (slot, size)
+                )
+            fields += [len(data), data]
+        try:
+            return self.struct.pack(
+                len(device_id),
+                device_id,
+                bitmap.to_bytes(self.bitmap_size, "little"),
+                *fields
+            )
+        except struct.error as e:
+            raise ValueError(
+                "the values of '%s' do not fit in their slots: %s"
+                % (vendor_device_id, e)
+            )
+
+    def unpack(self, record):
+        """
+        Returns the (vendor device id, {slot: value}) of the bytes of a
+        record, without its sequence number.
+        """
+        fields = self.struct.unpack(record)
+        vendor_device_id = fields[1][: fields[0]].decode()
+        bitmap = int.from_bytes(fields[2], "little")
+        values = {}
+        i = 3
+        for (n, (slot, kind, size)) in enumerate(
+            zip(self.slots, self.kinds, self.sizes)
+        ):
+            present = bitmap >> n & 1
+            if size is None:
+                value = fields[i]
+                i += 1
+            else:
+                data = fields[i + 1][: fields[i]]
+                i += 2
+                if present:
+                    value = json.loads(data) if kind == "Keyed" else data.decode()
+            values[slot] = value if present else None
+        return (vendor_device_id, values)
+
+
+class SharedDeviceStore(object):
+    """
+    The read values of up to `capacity` devices of a schema, in the shared
+    memory segment `name`.
+
+    The writing process creates the segment with `create=True` and a
+    `capacity`, and updates it with `write` or `write_device`. Reading
+    processes attach to it by name with the same schema, and get consistent
+    copies of the records with `read` and `read_all`. Only one process (and
+    one thread) may write to a segment.
+
+    Keyed values are stored as JSON in `keyed_size` bytes, data values in
+    twice their size (their hex string), a `ValueError` is raised for
+    larger values and for numbers out of the range of their format.
+
+    Readers wait up to `read_timeout` seconds for a record being written,
+    then raise `TimeoutError` (e.g. when the writer died during a write).
+    """
+
+    def __init__(
+        self,
+        schema,
+        name=None,
+        capacity=None,
+        create=False,
+        keyed_size=256,
+        read_timeout=READ_TIMEOUT,
+    ):
+        from multiprocessing import shared_memory
+
+        self.schema = schema
+        self.layout = layout = SharedLayout(schema, keyed_size)
+        self.read_timeout = read_timeout
+        digest = schema_digest(schema)
+        if create:
+            if not capacity:
+                raise ValueError("a capacity is needed to create a shared store")
+            self._shm = shared_memory.SharedMemory(
+                name=name,
+                create=True,
+                size=_HEADER_SIZE + capacity * layout.record_size,
+            )
+            _header.pack_into(
+                self._shm.buf,
+                0,
+                MAGIC,
+                VERSION,
+                capacity,
+                0,
+                layout.record_size,
+                digest,
+            )
+        else:
+            self._shm = shared_memory.SharedMemory(name=name)
+            # only the creating process should unlink the segment
+            from multiprocessing import resource_tracker
+
+            resource_tracker.unregister(self._shm._name, "shared_memory")
+            (
+                magic,
+                version,
+                capacity,
+                _count,
+                record_size,
+                stored,
+            ) = _header.unpack_from(self._shm.buf, 0)
+            if (magic, version) != (MAGIC, VERSION):
+                self._shm.close()
+                raise ValueError("'%s' is not a shared device store" % name)
+            if stored != digest or record_size != layout.record_size:
+                self._shm.close()
+                raise ValueError(
+                    "the shared device store '%s' holds another schema than %d"
+                    % (name, schema.id)
+                )
+        self.name = self._shm.name
+        self.capacity = capacity
+        self.created = create
+        self.retries = 0
+        self._indexes = {}
+
+    def __len__(self):
+        return _seq.unpack_from(self._shm.buf, _COUNT_OFFSET)[0]
+
+    def _offset(self, index):
+        return _HEADER_SIZE + index * self.layout.record_size
+
+    def index(self, vendor_device_id):
+        """
+        Returns the record index of a device, or None.
+        """
+        index = self._indexes.get(vendor_device_id)
+        if index is None and len(self._indexes) < len(self):
+            # devices were added by the writer since the last lookup
+            for i in range(len(self._indexes), len(self)):
+                self._indexes[self._read(i)[0]] = i
+            index = self._indexes.get(vendor_device_id)
+        return index
+
+    def write(self, vendor_device_id, values):
+        """
+        Writes the values ({slot: value}) of a device, adding the device if
+        needed.
+        """
+        record = self.layout.pack(vendor_device_id, values)
+        index = self.index(vendor_device_id)
+        count = None
+        if index is None:
+            index = len(self)
+            if index >= self.capacity:
+                raise ValueError(
+                    "the shared device store '%s' is full (%d devices)"
+                    % (self.name, self.capacity)
+                )
+            count = index + 1
+        buf = self._shm.buf
+        offset = self._offset(index)
+        start = offset + _seq.size
+        # the record is packed first, so that the sequence number is only
+        # odd while copying it
+        seq = _seq.unpack_from(buf, offset)[0]
+        _seq.pack_into(buf, offset, (seq + 1) & 0xFFFFFFFF)
+        buf[start : start + len(record)] = record
+        _seq.pack_into(buf, offset, (seq + 2) & 0xFFFFFFFF)
+        if count is not None:
+            # publish the new device once its record is complete
+            _seq.pack_into(buf, _COUNT_OFFSET, count)
+            self._indexes[vendor_device_id] = index
+
+    def write_device(self, device):
+        """
+        Writes the current values of a device.
+        """
+        self.write(device.vendor_device_id, device._rvalues)
+
+    def _read(self, index):
+        buf = self._shm.buf
+        offset = self._offset(index)
+        start = offset + _seq.size
+        end = start + self.layout.struct.size
+        deadline = None
+        while True:
+            seq = _seq.unpack_from(buf, offset)[0]
+            if not seq & 1:
+                record = bytes(buf[start:end])
+                if _seq.unpack_from(buf, offset)[0] == seq:
+                    return self.layout.unpack(record)
+            self.retries += 1
+            if deadline is None:
+                deadline = time.monotonic() + self.read_timeout
+            elif time.monotonic() > deadline:
+                raise TimeoutError(
+                    "the record %d of the shared device store '%s' is still "
+                    "being written after %ss" % (index, self.name, self.read_timeout)
+                )
+            time.sleep(0)
+
+    def version(self, vendor_device_id):
+        """
+        Returns the sequence number of a device record, which changes with
+        every write, or None for unknown devices.
+        """
+        index = self.index(vendor_device_id)
+        if index is None:
+            return None
+        return _seq.unpack_from(self._shm.buf, self._offset(index))[0]
+
+    def read(self, vendor_device_id):
+        """
+        Returns a consistent copy of the values ({slot: value}) of a device,
+        or None for unknown devices.
+        """
+        index = self.index(vendor_device_id)
+        if index is None:
+            return None
+        return self._read(index)[1]
+
+    def read_all(self):
+        """
+        Returns the {vendor_device_id: {slot: value}} of all the devices.
+        """
+        return dict(self._read(i) for i in range(len(self)))
+
+    def update_device(self, device):
+        """
+        Sets the values of a local device to the shared ones, returns False
+        for unknown devices.
+        """
+        values = self.read(device.vendor_device_id)
+        if values is None:
+            return False
+        for (slot, value) in values.items():
+            if value is None:
+                delattr(device, device.slug_of(slot))
+            else:
+                device[int(slot)] = value
+        return True
+
+    def close(self):
+        self._shm.close()
+
+    def unlink(self):
+        self._shm.unlink()
@@ -0,0 +1,371 @@
+"""
+simulator
+
+Synthetic devices generating plausible values for any schema, and a paced
+load generator publishing their messages.
+"""
+import json
+import random
+import threading
+import time
+
+from .device import Device
+from .profiling import Histogram
+
+_INT_RANGES = {
+    "Int8": (-(2**7), 2**7 - 1),
+    "Int16": (-(2**15), 2**15 - 1),
+    "Int32": (-(2**31), 2**31 - 1),
+    "Int64": (-(2**63), 2**63 - 1),
+    "Uint8": (0, 2**8 - 1),
+    "Uint16": (0, 2**16 - 1),
+    "Uint32": (0, 2**32 - 1),
+    "Uint64": (0, 2**64 - 1),
+}
+
+# (start, step, low, high) of the float random walks, per quantity
+_FLOAT_WALKS = {
+    "Temperature": (20.0, 0.05, -40.0, 85.0),
+    "Humidity": (50.0, 0.2, 0.0, 100.0),
+    "Illuminance": (300.0, 5.0, 0.0, 120000.0),
+    "Pressure": (1013.0, 0.1, 300.0, 1100.0),
+    "Voltage": (3.3, 0.005, 0.0, 5.0),
+}
+_DEFAULT_FLOAT_WALK = (0.0, 1.0, -1e6, 1e6)
+
+# milliseconds per unit of the time counters
+_TIME_UNITS = {"millisecond": 1, "second": 1000, "minute": 60000}
+
+
+def _float_walk(attr, rng):
+    (start, step, low, high) = _FLOAT_WALKS.get(attr.quantity, _DEFAULT_FLOAT_WALK)
+    state = [start + rng.uniform(-10, 10) * step]
+
+    def generate(elapsed_ms):
+        value = state[0] + rng.gauss(0.0, step)
+        state[0] = value = min(high, max(low, value))
+        return value
+
+    return generate
+
+
+def _int_walk(attr, rng):
+    (low, high) = _INT_RANGES[attr.format.kind]
+    state = [min(high, max(low, rng.randint(0, 100)))]
+
+    def generate(elapsed_ms):
+        state[0] = min(high, max(low, state[0] + rng.randint(-1, 1)))
+        return state[0]
+
+    return generate
+
+
+def _counter(attr, rng):
+    high = _INT_RANGES[attr.format.kind][1]
+    per_ms = 1.0 / _TIME_UNITS.get(attr.unit, 1)
+    state = [rng.randint(0, 3600000) * per_ms]
+
+    def generate(elapsed_ms):
+        state[0] += elapsed_ms * per_ms
+        if state[0] > high:
+            state[0] = 0.0
+        return int(state[0])
+
+    return generate
+
+
+def _constant(value):
+    def generate(elapsed_ms):
+        return value
+
+    return generate
+
+
+def _flip(rng, initial, choices, probability=0.01):
+    state = [initial]
+
+    def generate(elapsed_ms):
+        if rng.random() < probability:
+            state[0] = rng.choice(choices)
+        return state[0]
+
+    return generate
+
+
+def _keyed(attr, rng, keys):
+    inner = attr.format.value.value
+    inner_attr = type(
+        "KeyedAttribute",
+        (object,),
+        {
+            "format": inner,
+            "name": attr.name,
+            "quantity": attr.quantity,
+            "unit": attr.unit,
+            "access": attr.access,
+        },
+    )
+    if inner.kind == "Keyed":
+        raise ValueError("nested keyed attributes cannot be simulated")
+    generators = {
+        "k%04x" % rng.getrandbits(16): make_generator(inner_attr, rng)
+        for _ in range(keys)
+    }
+
+    def generate(elapsed_ms):
+        return {key: f(elapsed_ms) for (key, f) in generators.items()}
+
+    return generate
+
+
+def make_generator(attr, rng=None, keys=3):
+    """
+    Returns a function generating the successive values of an attribute,
+    given the milliseconds elapsed since the previous value:
+
+    - floats follow a bounded random walk, around typical values of their
+      quantity,
+    - read-only time integers (e.g. `uptime_ms_5`) are counters following
+      the elapsed time, other writable integers are constant (configuration)
+      and read-only integers follow a random walk,
+    - enums and bools change to a random valid value from time to time,
+    - data attributes are a constant random hex string,
+    - keyed attributes have `keys` random keys, each with its own generator.
+    """
+    rng = rng or random.Random()
+    kind = attr.format.kind
+    if kind in ("Float32", "Float64"):
+        return _float_walk(attr, rng)
+    if kind in _INT_RANGES:
+        if attr.quantity == "Time" and not attr.access.write:
+            return _counter(attr, rng)
+        if attr.access.write:
+            (low, high) = _INT_RANGES[kind]
+            return _constant(min(high, max(low, 60)))
+        return _int_walk(attr, rng)
+    if kind == "Bool":
+        return _flip(rng, False, [False, True])
+    if kind == "Enum":
+        choices = sorted(map(int, attr.format.value.value.keys()))
+        return _flip(rng, rng.choice(choices), choices)
+    if kind == "Data":
+        size = max(1, attr.format.value.value)
+        return _constant("%0*x" % (size * 2, rng.getrandbits(size * 8)))
+    if kind == "Keyed":
+        return _keyed(attr, rng, keys)
+    raise ValueError("invalid attribute format " + str(attr.format))
+
+
+def simulated_device_id(schema, n):
+    """
+    Returns the `n`th vendor device id of simulated devices of a schema: a
+    locally administered MAC address for `Macaddr` schemas, `SIM-<n>`
+    otherwise.
+    """
+    if schema.vendor_device_id_format.kind == "Macaddr":
+        return "02:%02X:%02X:%02X:%02X:%02X" % (
+            schema.id & 0xFF,
+            (n >> 24) & 0xFF,
+            (n >> 16) & 0xFF,
+            (n >> 8) & 0xFF,
+            n & 0xFF,
+        )
+    return "SIM-%d-%08d" % (schema.id, n)
+
+
+class SimulatedDevice(object):
+    """
+    A device of a schema with a value generator per read attribute.
+    """
+
+    def __init__(self, device, rng=None, keys=3):
+        rng = rng or random.Random()
+        self.device = device
+        schema = device.schema
+        self._generators = [
+            (int(slot), make_generator(attr, rng, keys))
+            for (slot, attr) in schema.attributes.items()
+            if attr.access.read
+        ]
+        self._last = None
+
+    def step(self, now_ms):
+        """
+        Sets the next value of every read attribute and returns the device
+        message.
+        """
+        elapsed_ms = 0 if self._last is None else now_ms - self._last
+        self._last = now_ms
+        device = self.device
+        for (slot, generate) in self._generators:
+            device[slot] = generate(elapsed_ms)
+        return device.message
+
+
+class LocalSink(object):
+    """
+    A sink counting the published messages, encoding them to JSON like a
+    `Client` would unless `encode` is False.
+    """
+
+    def __init__(self, encode=True):
+        self.encode = encode
+        self.messages = 0
+        self.requests = 0
+        self.bytes = 0
+        self._lock = threading.Lock()
+
+    def publish_device_message_list(self, messages):
+        size = len(json.dumps(messages).encode()) if self.encode else 0
+        with self._lock:
+            self.messages += len(messages)
+            self.requests += 1
+            self.bytes += size
+
+    __call__ = publish_device_message_list
+
+
+class Simulator(object):
+    """
+    Generates the messages of `count` simulated devices of a schema at an
+    aggregate `rate` of messages per second, and publishes them to `sink`: a
+    `Client` (or anything with `publish_device_message_list`) or a function
+    taking a list of messages.
+
+    Devices are updated round-robin. Pacing follows an absolute schedule
+    (message `i` is due at `start + i / rate`), so the rate does not drift
+    with the time spent generating and publishing: the messages due at a
+    given time are published together in lists of at most `batch_size`, and
+    the simulator sleeps until the next message is due.
+
+    `stats` reports the sent messages and batches, the achieved rate, the
+    publishing errors and a histogram of the latency between the time a
+    message was due and the time the sink accepted it.
+    """
+
+    def __init__(
+        self,
+        schema,
+        sink,
+        count=100,
+        rate=100.0,
+        batch_size=100,
+        seed=None,
+        keys=3,
+        compiled=False,
+        clock=time.perf_counter,
+        sleep=None,
+    ):
+        if rate <= 0:
+            raise ValueError("the rate must be positive")
+        self.schema = schema
+        self.publish = getattr(sink, "publish_device_message_list", sink)
+        self.rate = rate
+        self.batch_size = batch_size
+        self.clock = clock
+        self._stopped = threading.Event()
+        # waiting on the stop event lets `stop` interrupt slow rates
+        self.sleep = sleep or self._stopped.wait
+        rng = random.Random(seed)
+        self.devices = [
+            SimulatedDevice(
+                Device.from_schema(
+                    schema, simulated_device_id(schema, n), compiled=compiled
+                ),
+                rng,
+                keys,
+            )
+            for n in range(count)
+        ]
+        self.latency = Histogram()
+        self.sent = 0
+        self.batches = 0
+        self.errors = 0
+        self.last_error = None
+        self.started = None
+        self.elapsed = 0.0
+        self._next_device = 0
+        self._thread = None
+
+    def generate(self, n, now_ms=None):
+        """
+        Returns the next `n` messages, updating the devices round-robin.
+        """
+        now_ms = self.clock() * 1000.0 if now_ms is None else now_ms
+        devices = self.devices
+        i = self._next_device
+        messages = []
+        for _ in range(n):
+            messages.append(devices[i].step(now_ms))
+            i = (i + 1) % len(devices)
+        self._next_device = i
+        return messages
+
+    def run(self, duration=None, messages=None):
+        """
+        Publishes messages until `duration` seconds passed, `messages` were
+        sent or `stop` is called. Returns the stats.
+        """
+        if duration is None and messages is None and self._thread is None:
+            raise ValueError("run needs a duration or a number of messages")
+        clock = self.clock
+        rate = self.rate
+        start = clock()
+        self.started = start
+        end = None if duration is None else start + duration
+        limit = messages
+        sent = 0
+        while not self._stopped.is_set():
+            now = clock()
+            due = int((now - start) * rate) + 1
+            if end is not None and now >= end:
+                break
+            if limit is not None:
+                due = min(due, limit)
+                if sent >= limit:
+                    break
+            if due <= sent:
+                self.sleep(max(0.0, start + sent / rate - clock()))
+                continue
+            n = min(due - sent, self.batch_size)
+            batch = self.generate(n, now * 1000.0)
+            try:
+                self.publish(batch)
+            except Exception as e:
+                self.errors += 1
+                self.last_error = e
+            else:
+                self.sent += n
+                self.batches += 1
+                done = clock()
+                # latency of the first (oldest) message of the batch
+                self.latency.observe(done - (start + sent / rate))
+            sent += n
+        self.elapsed = clock() - start
+        return self.stats
+
+    @property
+    def stats(self):
+        return {
+            "devices": len(self.devices),
+            "sent": self.sent,
+            "batches": self.batches,
+            "errors": self.errors,
+            "elapsed": self.elapsed,
+            "rate": self.sent / self.elapsed if self.elapsed > 0 else 0.0,
+            "latency": self.latency.to_dict(),
+        }
+
+    def start(self):
+        """
+        Runs the simulator in a background thread until `stop` is called.
+        """
+        self._stopped.clear()
+        self._thread = threading.Thread(target=self.run, daemon=True)
+        self._thread.start()
+
+    def stop(self):
+        self._stopped.set()
+        if self._thread is not None:
+            self._thread.join()
+            self._thread = None
@@ -0,0 +1,11 @@
+from .._lazy import lazy_exports
+
+_exports = {
+    "IngestServer": ".ingest",
+    "RelayQueue": ".relay",
+    "RelayServer": ".relay",
+}
+
+__all__ = ["IngestServer", "RelayQueue", "RelayServer"]
+
+(__getattr__, __dir__) = lazy_exports(globals(), _exports)
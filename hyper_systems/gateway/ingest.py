@@ -0,0 +1,465 @@
+"""
+ingest
+
+An asyncio server receiving raw sensor readings on an edge gateway, applying
+them to the devices and publishing the resulting device messages.
+
+Readings are received over TCP or UDP, in one of two formats:
+
+- newline-delimited JSON objects, either one reading per object
+  (`{"vendor_device_id": ..., "slot": 5, "value": 1000}`) or several values
+  of a device (`{"vendor_device_id": ..., "values": {"5": 1000}}`),
+- compact binary records, see `encode_reading`.
+
+The format of a TCP connection is detected from its first byte, UDP
+datagrams are detected one by one.
+"""
+import asyncio
+import json
+import struct
+import time
+
+RECORD_MAGIC = 0xB1
+
+_record_header = struct.Struct("<BB")
+_kinds = {
+    ord("i"): struct.Struct("<q"),
+    ord("u"): struct.Struct("<Q"),
+    ord("f"): struct.Struct("<d"),
+    ord("?"): struct.Struct("<?"),
+}
+_str_length = struct.Struct("<H")
+
+
+def encode_reading(vendor_device_id, slot, value):
+    """
+    Encodes a reading as a binary record:
+
+        magic (0xB1) | id length (u8) | vendor device id | slot (u8) |
+        kind (u8) | value
+
+    where kind is `i` (int64), `u` (uint64), `f` (float64), `?` (bool) or
+    `s` (u16 length and utf-8 string).
+    """
+    device_id = vendor_device_id.encode()
+    header = _record_header.pack(RECORD_MAGIC, len(device_id)) + device_id
+    if isinstance(value, bool):
+        body = b"?" + _kinds[ord("?")].pack(value)
+    elif isinstance(value, int):
+        kind = "i" if value < 0 else "u"
+        body = kind.encode() + _kinds[ord(kind)].pack(value)
+    elif isinstance(value, float):
+        body = b"f" + _kinds[ord("f")].pack(value)
+    elif isinstance(value, str):
+        data = value.encode()
+        body = b"s" + _str_length.pack(len(data)) + data
+    else:
+        raise TypeError("cannot encode a reading of type %s" % type(value).__name__)
+    return header + bytes([slot]) + body
+
+
+class ReadingParser(object):
+    """
+    Incrementally parses readings from a byte stream, as (vendor device id,
+    slot, value) tuples.
+    """
+
+    def __init__(self):
+        self.binary = None
+        self.errors = 0
+        self._buffer = b""
+
+    def feed(self, data):
+        buffer = self._buffer + data
+        if self.binary is None:
+            stripped = buffer.lstrip()
+            if not stripped:
+                self._buffer = b""
+                return []
+            self.binary = stripped[0] == RECORD_MAGIC
+        if self.binary:
+            (readings, pos) = self._parse_records(buffer)
+        else:
+            (readings, pos) = self._parse_lines(buffer)
+        self._buffer = buffer[pos:]
+        return readings
+
+    def _parse_lines(self, buffer):
+        readings = []
+        pos = 0
+        while True:
+            end = buffer.find(b"\n", pos)
+            if end == -1:
+                return (readings, pos)
+            line = buffer[pos:end].strip()
+            pos = end + 1
+            if not line:
+                continue
+            try:
+                item = json.loads(line)
+                vendor_device_id = item["vendor_device_id"]
+                if "values" in item:
+                    for (slot, value) in item["values"].items():
+                        readings.append((vendor_device_id, str(slot), value))
+                else:
+                    readings.append(
+                        (vendor_device_id, str(item["slot"]), item["value"])
+                    )
+            except (ValueError, KeyError, TypeError, AttributeError):
+                self.errors += 1
+
+    def _parse_records(self, buffer):
+        readings = []
+        pos = 0
+        end = len(buffer)
+        while pos < end:
+            if buffer[pos] != RECORD_MAGIC:
+                # resynchronise on the next record
+                self.errors += 1
+                next_pos = buffer.find(bytes([RECORD_MAGIC]), pos + 1)
+                pos = end if next_pos == -1 else next_pos
+                continue
+            if end - pos < 2:
+                break
+            id_end = pos + 2 + buffer[pos + 1]
+            if end < id_end + 2:
+                break
+            slot = buffer[id_end]
+            kind = buffer[id_end + 1]
+            value_pos = id_end + 2
+            if kind == ord("s"):
+                if end < value_pos + 2:
+                    break
+                length = _str_length.unpack_from(buffer, value_pos)[0]
+                if end < value_pos + 2 + length:
+                    break
+                try:
+                    value = buffer[value_pos + 2 : value_pos + 2 + length].decode()
+                except UnicodeDecodeError:
+                    value = None
+                record_end = value_pos + 2 + length
+            elif kind in _kinds:
+                fmt = _kinds[kind]
+                if end < value_pos + fmt.size:
+                    break
+                value = fmt.unpack_from(buffer, value_pos)[0]
+                record_end = value_pos + fmt.size
+            else:
+                self.errors += 1
+                pos += 1
+                continue
+            try:
+                vendor_device_id = buffer[pos + 2 : id_end].decode()
+            except UnicodeDecodeError:
+                value = None
+            if value is None:
+                self.errors += 1
+            else:
+                readings.append((vendor_device_id, str(slot), value))
+            pos = record_end
+        return (readings, pos)
+
+
+class ConnectionStats(object):
+    """
+    Throughput counters of a connection (or of a UDP endpoint).
+    """
+
+    def __init__(self, peer, clock=time.monotonic):
+        self.peer = peer
+        self.clock = clock
+        self.opened = clock()
+        self.closed = None
+        self.bytes = 0
+        self.readings = 0
+        self.errors = 0
+        self.dropped = 0
+
+    @property
+    def rate(self):
+        """
+        Readings received per second.
+        """
+        elapsed = (self.closed or self.clock()) - self.opened
+        return self.readings / elapsed if elapsed > 0 else 0.0
+
+    def to_dict(self):
+        return {
+            "peer": self.peer,
+            "bytes": self.bytes,
+            "readings": self.readings,
+            "errors": self.errors,
+            "dropped": self.dropped,
+            "rate": self.rate,
+        }
+
+
+class _DatagramProtocol(asyncio.DatagramProtocol):
+    def __init__(self, server, stats):
+        self.server = server
+        self.stats = stats
+
+    def datagram_received(self, data, addr):
+        parser = ReadingParser()
+        readings = parser.feed(data)
+        if not parser.binary:
+            # the last line of a datagram may not end with a newline
+            readings += parser.feed(b"\n")
+        self.stats.bytes += len(data)
+        self.stats.errors += parser.errors + (1 if parser._buffer else 0)
+        if readings:
+            self.server._put_nowait(self.stats, readings)
+
+
+class IngestServer(object):
+    """
+    Receives readings, validates them against the device schemas, applies
+    them to `devices` (a `Fleet` or a mapping of vendor device ids to
+    devices) and publishes the updated device messages with
+    `publish(messages)`, e.g. `client.publish_device_message_list` or
+    `AdaptivePublisher.publish`.
+
+    Readings of unknown devices are dropped, unless `device_factory` returns
+    a device for their vendor device id (it is then added to `devices`).
+    Int readings of float slots are converted to floats.
+
+    Parsed readings go through a queue of at most `max_pending` chunks, and
+    the updated devices are published every `flush_interval` seconds or
+    once `batch_size` devices changed; readings of a device between two
+    publications are merged into one message, and devices whose message
+    could not be published are published again with the next batch.
+    Publishing runs in the default executor and the queue is not consumed
+    meanwhile, so a slow API slows down the TCP senders (back-pressure)
+    while UDP readings are dropped and counted once the queue is full.
+    """
+
+    def __init__(
+        self,
+        devices,
+        publish=None,
+        device_factory=None,
+        max_pending=1024,
+        batch_size=500,
+        flush_interval=1.0,
+        read_size=65536,
+    ):
+        self.devices = devices
+        self.publish = publish
+        self.device_factory = device_factory
+        self.max_pending = max_pending
+        self.batch_size = batch_size
+        self.flush_interval = flush_interval
+        self.read_size = read_size
+        self.published = 0
+        self.last_error = None
+        self.connections = set()
+        self._closed = ConnectionStats("closed")
+        self._writers = {}
+        self._queue = None
+        self._dirty = {}
+        self._servers = []
+        self._worker = None
+
+    def _ensure_started(self):
+        if self._queue is None:
+            self._queue = asyncio.Queue(self.max_pending)
+            self._worker = asyncio.get_running_loop().create_task(self._work())
+
+    async def start_tcp(self, host="0.0.0.0", port=0):
+        """
+        Listens for TCP connections and returns the `asyncio.Server`.
+        """
+        self._ensure_started()
+        server = await asyncio.start_server(self._handle, host, port)
+        self._servers.append(server)
+        return server
+
+    async def start_udp(self, host="0.0.0.0", port=0):
+        """
+        Listens for UDP datagrams and returns the transport.
+        """
+        self._ensure_started()
+        stats = ConnectionStats("udp")
+        self.connections.add(stats)
+        (
+            transport,
+            _protocol,
+        ) = await asyncio.get_running_loop().create_datagram_endpoint(
+            lambda: _DatagramProtocol(self, stats), local_addr=(host, port)
+        )
+        self._servers.append(transport)
+        return transport
+
+    async def _handle(self, reader, writer):
+        stats = ConnectionStats(writer.get_extra_info("peername"))
+        self.connections.add(stats)
+        self._writers[writer] = asyncio.current_task()
+        parser = ReadingParser()
+        try:
+            while True:
+                data = await reader.read(self.read_size)
+                if not data:
+                    break
+                stats.bytes += len(data)
+                readings = parser.feed(data)
+                stats.errors += parser.errors
+                parser.errors = 0
+                if readings:
+                    # waits while the queue is full
+                    await self._queue.put((stats, readings))
+        except ConnectionError:
+            pass
+        finally:
+            stats.closed = stats.clock()
+            self.connections.discard(stats)
+            self._writers.pop(writer, None)
+            closed = self._closed
+            closed.bytes += stats.bytes
+            closed.readings += stats.readings
+            closed.errors += stats.errors
+            closed.dropped += stats.dropped
+            writer.close()
+
+    @property
+    def totals(self):
+        """
+        The counters of all the connections, open and closed.
+        """
+        totals = ConnectionStats("total", clock=self._closed.clock)
+        totals.opened = self._closed.opened
+        for stats in [self._closed] + list(self.connections):
+            totals.bytes += stats.bytes
+            totals.readings += stats.readings
+            totals.errors += stats.errors
+            totals.dropped += stats.dropped
+        return totals
+
+    def _put_nowait(self, stats, readings):
+        try:
+            self._queue.put_nowait((stats, readings))
+        except asyncio.QueueFull:
+            stats.dropped += len(readings)
+
+    def _device(self, vendor_device_id):
+        device = self.devices.get(vendor_device_id)
+        if device is None and self.device_factory is not None:
+            device = self.device_factory(vendor_device_id)
+            if device is not None:
+                if hasattr(self.devices, "add"):
+                    self.devices.add(device)
+                else:
+                    self.devices[vendor_device_id] = device
+        return device
+
+    def apply(self, stats, readings):
+        """
+        Validates and applies readings to the devices.
+        """
+        dirty = self._dirty
+        (applied, errors, dropped) = (0, 0, 0)
+        for (vendor_device_id, slot, value) in readings:
+            device = self._device(vendor_device_id)
+            if device is None:
+                dropped += 1
+                continue
+            types = device._table.types.get(slot)
+            if types is not None and types[0] is float and type(value) is int:
+                value = float(value)
+            try:
+                device[int(slot)] = value
+            except (TypeError, ValueError):
+                errors += 1
+                continue
+            applied += 1
+            dirty[vendor_device_id] = device
+        targets = (stats,) if stats.closed is None else (stats, self._closed)
+        for target in targets:
+            target.readings += applied
+            target.errors += errors
+            target.dropped += dropped
+
+    async def _work(self):
+        loop = asyncio.get_running_loop()
+        queue = self._queue
+        deadline = loop.time() + self.flush_interval
+        while True:
+            timeout = deadline - loop.time()
+            try:
+                if timeout <= 0:
+                    raise asyncio.TimeoutError()
+                (stats, readings) = await asyncio.wait_for(queue.get(), timeout)
+            except asyncio.TimeoutError:
+                pass
+            else:
+                self.apply(stats, readings)
+                queue.task_done()
+                if len(self._dirty) < self.batch_size:
+                    continue
+            await self.flush()
+            deadline = loop.time() + self.flush_interval
+
+    async def flush(self):
+        """
+        Publishes the messages of the devices updated since the last flush.
+        When publishing fails, the devices are published again with the next
+        flush.
+        """
+        if not self._dirty:
+            return 0
+        (dirty, self._dirty) = (self._dirty, {})
+        messages = [device.message for device in dirty.values()]
+        if self.publish is not None:
+            try:
+                await asyncio.get_running_loop().run_in_executor(
+                    None, self.publish, messages
+                )
+            except Exception as e:
+                self.last_error = e
+                # publish the devices again with the next flush, but those of
+                # a partly accepted list
+                failed = list(dirty.items())[getattr(e, "accepted", 0) :]
+                dirty = dict(failed)
+                dirty.update(self._dirty)
+                self._dirty = dirty
+                return 0
+        self.published += len(messages)
+        return len(messages)
+
+    async def drain(self):
+        """
+        Waits until all the queued readings are applied, and publishes them.
+        """
+        await self._queue.join()
+        return await self.flush()
+
+    @property
+    def stats(self):
+        """
+        The throughput counters of the open connections and the totals.
+        """
+        return {
+            "connections": [stats.to_dict() for stats in self.connections],
+            "totals": self.totals.to_dict(),
+            "pending": self._queue.qsize() if self._queue is not None else 0,
+            "published": self.published,
+        }
+
+    async def close(self):
+        """
+        Stops listening, and publishes the readings received so far.
+        """
+        for server in self._servers:
+            server.close()
+        handlers = list(self._writers.values())
+        for writer in list(self._writers):
+            writer.close()
+        # the handlers end once they read the end of their closed connection
+        await asyncio.gather(*handlers, return_exceptions=True)
+        for server in self._servers:
+            if hasattr(server, "wait_closed"):
+                await server.wait_closed()
+        self._servers = []
+        if self._queue is not None:
+            await self.drain()
+            self._worker.cancel()
+            self._queue = None
@@ -0,0 +1,466 @@
+"""
+relay
+
+A local relay speaking the incoming device messages API, that merges the
+lists posted by many collectors into large batches per site and forwards
+them upstream.
+"""
+import hmac
+import json
+import os
+import re
+import tempfile
+import threading
+from collections import deque
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+_incoming_path = re.compile(r"/sites/([A-Za-z0-9_-]+)/device_messages/v3/incoming$")
+_log_name = re.compile(r"site_([A-Za-z0-9_-]+)\.log$")
+_MESSAGE_KEYS = frozenset(
+    ("message_uuid", "created_time", "vendor_device_id", "device_class_id", "values")
+)
+
+
+def _check_message(message):
+    """
+    Raises a `ValueError` for messages that are not device messages.
+    """
+    if not isinstance(message, dict) or not _MESSAGE_KEYS.issubset(message):
+        raise ValueError("expected a list of device messages")
+    for key in ("message_uuid", "created_time", "vendor_device_id"):
+        if not isinstance(message[key], str):
+            raise ValueError("the %s of a device message must be a string" % key)
+    device_class_id = message["device_class_id"]
+    if type(device_class_id) is not int or not 0 <= device_class_id <= 0xFFFFFFFF:
+        raise ValueError("invalid device_class_id %r" % (device_class_id,))
+    values = message["values"]
+    if not isinstance(values, dict):
+        raise ValueError("the values of a device message must be a dict")
+    for slot in values:
+        if not slot.isdecimal() or int(slot) > 0xFFFF:
+            raise ValueError("invalid slot %r" % (slot,))
+
+
+class _MemorySiteQueue(object):
+    def __init__(self):
+        self._messages = deque()
+
+    def __len__(self):
+        return len(self._messages)
+
+    def put(self, messages):
+        self._messages.extend(messages)
+
+    def peek(self, n):
+        messages = self._messages
+        return [messages[i] for i in range(min(n, len(messages)))]
+
+    def commit(self, n):
+        for _ in range(n):
+            self._messages.popleft()
+
+    def close(self):
+        pass
+
+
+class _LogSiteQueue(object):
+    """
+    The messages of a site in a `MessageLog`, with the sequence number of the
+    first message not forwarded yet kept in a cursor file.
+    """
+
+    def __init__(self, path, sync, compact_after):
+        from ..storage.log import MessageLog
+
+        self._log_class = MessageLog
+        self.path = path
+        self.cursor_path = path + ".cursor"
+        self.sync = sync
+        self.compact_after = compact_after
+        self.log = MessageLog(path)
+        try:
+            with open(self.cursor_path) as f:
+                self.cursor = min(int(f.read()), len(self.log))
+        except (OSError, ValueError):
+            self.cursor = 0
+
+    def __len__(self):
+        return len(self.log) - self.cursor
+
+    def put(self, messages):
+        self.log.extend(messages)
+        if self.sync:
+            self.log.sync()
+        else:
+            self.log.flush()
+
+    def peek(self, n):
+        return [
+            view.to_message() for view in self.log.iter(self.cursor, self.cursor + n)
+        ]
+
+    def _write_cursor(self):
+        (fd, tmp_path) = tempfile.mkstemp(
+            dir=os.path.dirname(self.path) or ".", suffix=".tmp"
+        )
+        with os.fdopen(fd, "w") as f:
+            f.write(str(self.cursor))
+            if self.sync:
+                f.flush()
+                os.fsync(f.fileno())
+        os.replace(tmp_path, self.cursor_path)
+
+    def commit(self, n):
+        self.cursor += n
+        if self.cursor == len(self.log) and self.cursor >= self.compact_after:
+            # everything was forwarded, start over with empty files
+            self.log.close()
+            for path in (self.path, self.log.index_path, self.cursor_path):
+                if os.path.exists(path):
+                    os.unlink(path)
+            self.log = self._log_class(self.path)
+            self.cursor = 0
+        else:
+            self._write_cursor()
+
+    def close(self):
+        self.log.close()
+
+
+class RelayQueue(object):
+    """
+    Per-site queues of the device messages waiting to be forwarded.
+
+    With a `directory` every site has a message log (`site_<id>.log`) and a
+    cursor file there, so that queued messages survive restarts; appends are
+    flushed to the OS, and fsynced too with `sync`. Logs are removed and
+    started over once at least `compact_after` messages were all forwarded.
+    Without a `directory` messages are kept in memory.
+    """
+
+    def __init__(self, directory=None, sync=False, compact_after=10000):
+        self.directory = directory
+        self.sync = sync
+        self.compact_after = compact_after
+        self._sites = {}
+        self._lock = threading.Lock()
+        if directory is not None:
+            os.makedirs(directory, exist_ok=True)
+            for name in sorted(os.listdir(directory)):
+                match = _log_name.match(name)
+                if match:
+                    self._site(match.group(1))
+
+    def _site(self, site_id):
+        queue = self._sites.get(site_id)
+        if queue is None:
+            if self.directory is None:
+                queue = _MemorySiteQueue()
+            else:
+                path = os.path.join(self.directory, "site_%s.log" % site_id)
+                queue = _LogSiteQueue(path, self.sync, self.compact_after)
+            self._sites[site_id] = queue
+        return queue
+
+    def put(self, site_id, messages):
+        with self._lock:
+            self._site(str(site_id)).put(messages)
+
+    def pending(self, site_id=None):
+        """
+        Returns the number of messages waiting to be forwarded, for a site or
+        for all the sites.
+        """
+        with self._lock:
+            if site_id is not None:
+                queue = self._sites.get(str(site_id))
+                return len(queue) if queue is not None else 0
+            return sum(len(queue) for queue in self._sites.values())
+
+    def sizes(self):
+        """
+        Returns the {site_id: pending messages} of the sites with queued
+        messages.
+        """
+        with self._lock:
+            return {
+                site_id: len(queue)
+                for (site_id, queue) in self._sites.items()
+                if len(queue)
+            }
+
+    def batches(self, batch_size):
+        """
+        Returns the {site_id: messages} of the first `batch_size` messages of
+        every site with queued messages.
+        """
+        with self._lock:
+            return {
+                site_id: queue.peek(batch_size)
+                for (site_id, queue) in self._sites.items()
+                if len(queue)
+            }
+
+    def commit(self, site_id, n):
+        """
+        Removes the first `n` messages of a site, once forwarded.
+        """
+        with self._lock:
+            self._sites[str(site_id)].commit(n)
+
+    def close(self):
+        with self._lock:
+            for queue in self._sites.values():
+                queue.close()
+            self._sites = {}
+
+
+class _RelayHandler(BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"
+    # headers and body are written separately, do not wait for delayed acks
+    disable_nagle_algorithm = True
+
+    def _reply(self, status, body=b""):
+        self.send_response(status)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def do_POST(self):
+        match = _incoming_path.search(self.path.split("?", 1)[0])
+        length = int(self.headers.get("Content-Length") or 0)
+        body = self.rfile.read(length)
+        if match is None:
+            self._reply(404, b'{"error": "not found"}')
+            return
+        try:
+            messages = json.loads(body)
+            if not isinstance(messages, list):
+                raise ValueError("expected a list of device messages")
+            for message in messages:
+                _check_message(message)
+        except ValueError as e:
+            self._reply(400, json.dumps({"error": str(e)}).encode())
+            return
+        relay = self.server.relay
+        site_id = match.group(1)
+        authorization = self.headers.get("Authorization") or ""
+        if not relay.authorized(
+            site_id, authorization[7:] if authorization.startswith("Bearer ") else None
+        ):
+            self._reply(401, b'{"error": "unauthorized"}')
+            return
+        try:
+            relay.accept(site_id, messages)
+        except ValueError as e:
+            # messages that cannot be queued, e.g. with an invalid created_time
+            self._reply(400, json.dumps({"error": str(e)}).encode())
+            return
+        except Exception as e:
+            self._reply(503, json.dumps({"error": str(e)}).encode())
+            return
+        self._reply(200, b"{}")
+
+    def log_message(self, *args):
+        pass
+
+
+class _RelayHTTPServer(ThreadingHTTPServer):
+    daemon_threads = True
+
+
+class RelayServer(object):
+    """
+    Accepts device message lists on
+    `POST http://<host>:<port>/sites/<site_id>/device_messages/v3/incoming`,
+    so that collectors only need their `Client` to point at the relay, and
+    acknowledges them once they are queued.
+
+    A forwarding thread publishes the queued messages upstream with a
+    `MultiSiteClient` (pooled connections, one worker per site at a time)
+    every `flush_interval` seconds, or as soon as a site has `batch_size`
+    messages, in lists of at most `batch_size` messages. Lists that could
+    not be forwarded because of a network error, throttling or a server
+    error stay queued and are retried after `retry_interval` seconds with
+    their message uuids unchanged. Lists refused for good (e.g. with a 400
+    status) are removed from the queue: their messages are counted in
+    `rejected`, and the last `max_dead_letters` of them are kept in
+    `dead_letters` as `(site_id, messages, error)`.
+
+    A site is forwarded with its API key of `api_keys`, or else with
+    `api_key`. Collectors must post with a bearer token of `tokens` (a
+    token for every site, or a dict of tokens by site id), or else with the
+    API key of the site; other requests, and requests for sites without an
+    API key, are refused with a 401 status.
+    """
+
+    def __init__(
+        self,
+        api_url,
+        api_key=None,
+        api_keys=None,
+        tokens=None,
+        host="127.0.0.1",
+        port=0,
+        directory=None,
+        sync=False,
+        batch_size=1000,
+        flush_interval=0.5,
+        retry_interval=5.0,
+        workers=4,
+        retries=0,
+        client=None,
+        max_dead_letters=100,
+    ):
+        if client is None:
+            from ..http.multisite import MultiSiteClient
+
+            client = MultiSiteClient(
+                api_url,
+                api_key=api_key,
+                api_keys=api_keys,
+                workers=workers,
+                retries=retries,
+            )
+        self.client = client
+        self.tokens = tokens
+        self.queue = RelayQueue(directory, sync=sync)
+        self.batch_size = batch_size
+        self.flush_interval = flush_interval
+        self.retry_interval = retry_interval
+        self.received = 0
+        self.forwarded = 0
+        self.rejected = 0
+        self.dead_letters = deque(maxlen=max_dead_letters)
+        self.last_error = None
+        self._httpd = _RelayHTTPServer((host, port), _RelayHandler)
+        self._httpd.relay = self
+        self._threads = []
+        self._wakeup = threading.Condition()
+        self._stopped = False
+
+    @property
+    def address(self):
+        return self._httpd.server_address
+
+    @property
+    def url(self):
+        """
+        The API url to give to the collectors' `Client`.
+        """
+        return "http://%s:%d" % self.address[:2]
+
+    def authorized(self, site_id, token):
+        """
+        Returns whether a collector may post messages for a site with a
+        bearer token.
+        """
+        site_id = str(site_id)
+        client = self.client
+        if client.api_keys.get(site_id, client.api_key) is None or token is None:
+            return False
+        expected = self.tokens
+        if isinstance(expected, dict):
+            expected = expected.get(site_id)
+        elif expected is None:
+            expected = client.api_keys.get(site_id, client.api_key)
+        return expected is not None and hmac.compare_digest(
+            token.encode(), expected.encode()
+        )
+
+    def accept(self, site_id, messages):
+        """
+        Queues a list of messages posted for a site. A `ValueError` is raised
+        for messages that cannot be queued, and none of them is queued.
+        """
+        self.queue.put(site_id, messages)
+        with self._wakeup:
+            self.received += len(messages)
+            if self.queue.pending(site_id) >= self.batch_size:
+                self._wakeup.notify()
+
+    def _forward(self):
+        from ..http.breaker import is_failure
+
+        batches = self.queue.batches(self.batch_size)
+        if not batches:
+            return (0, {})
+        failed = dict(self.client.publish_many(batches))
+        count = 0
+        for (site_id, messages) in batches.items():
+            error = failed.get(site_id)
+            done = sent = len(messages)
+            if error is not None:
+                self.last_error = error
+                # messages accepted before the failure are not sent again
+                done = sent = getattr(error, "accepted", 0)
+                if not is_failure(error):
+                    # refused for good, retrying would stall the site
+                    del failed[site_id]
+                    self.rejected += len(messages) - sent
+                    self.dead_letters.append((site_id, messages[sent:], error))
+                    done = len(messages)
+            if done:
+                self.queue.commit(site_id, done)
+            count += sent
+        self.forwarded += count
+        return (count, failed)
+
+    def forward(self):
+        """
+        Forwards one batch of every site with queued messages and waits for
+        them. Returns the number of forwarded messages, errors are kept in
+        `last_error`.
+        """
+        return self._forward()[0]
+
+    def _forward_loop(self):
+        while True:
+            with self._wakeup:
+                if self._stopped:
+                    return
+                sizes = self.queue.sizes()
+                if max(sizes.values(), default=0) < self.batch_size:
+                    self._wakeup.wait(self.flush_interval)
+                if self._stopped:
+                    return
+            try:
+                failed = self._forward()[1]
+            except Exception as e:
+                self.last_error = failed = e
+            if failed:
+                with self._wakeup:
+                    self._wakeup.wait_for(lambda: self._stopped, self.retry_interval)
+
+    def start(self):
+        """
+        Starts serving and forwarding in background threads.
+        """
+        self._stopped = False
+        self._threads = [
+            threading.Thread(target=self._httpd.serve_forever, daemon=True),
+            threading.Thread(target=self._forward_loop, daemon=True),
+        ]
+        for thread in self._threads:
+            thread.start()
+
+    def stop(self, flush=True):
+        """
+        Stops serving, forwards the queued messages if `flush` is set, and
+        closes the upstream client and the queue.
+        """
+        if self._threads:
+            self._httpd.shutdown()
+        self._httpd.server_close()
+        with self._wakeup:
+            self._stopped = True
+            self._wakeup.notify_all()
+        for thread in self._threads:
+            thread.join()
+        self._threads = []
+        if flush:
+            while self.queue.pending() and not self._forward()[1]:
+                pass
+        self.client.close()
+        self.queue.close()
@@ -1,5 +1,15 @@
-from .client import Client
+from .._lazy import lazy_exports
+
+_exports = {
+  "AsyncClient": ".client",
+  "Client": ".client",
+  "PublishError": ".client",
+}
 
 __all__ = [
-  "Client"
+  "AsyncClient",
+  "Client",
+  "PublishError"
 ]
+
+(__getattr__, __dir__) = lazy_exports(globals(), _exports)
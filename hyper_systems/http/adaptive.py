@@ -0,0 +1,338 @@
+"""
+adaptive
+
+Adaptive batch sizing and concurrency for publishing device messages.
+
+`AdaptiveController` adjusts the batch size and the number of concurrent
+requests with AIMD feedback (additive increase, multiplicative decrease) from
+the observed latency, error rate and throttling responses. `AdaptivePublisher`
+publishes message lists through a `Client` following those setpoints.
+"""
+import threading
+import time
+from collections import deque
+from http.client import HTTPException
+
+from .client import RETRY_STATUSES, PublishError
+
+
+class AdaptiveController(object):
+    """
+    AIMD controller of the publishing batch size and concurrency.
+
+    - A successful request faster than `target_latency` grows the batch size
+      by `batch_increase`, and every `concurrency` such requests in a row grow
+      the concurrency by one.
+    - A request slower than `target_latency` shrinks the batch size by
+      `decrease`.
+    - A throttled request (429) shrinks the concurrency by `decrease`.
+    - Other failures shrink both. If the error rate over the last `window`
+      requests is above `max_error_rate`, nothing is increased.
+    """
+
+    def __init__(
+        self,
+        batch_size=100,
+        min_batch_size=1,
+        max_batch_size=5000,
+        concurrency=1,
+        max_concurrency=16,
+        target_latency=1.0,
+        batch_increase=50,
+        decrease=0.5,
+        window=50,
+        max_error_rate=0.1,
+    ):
+        self.batch_size = batch_size
+        self.min_batch_size = min_batch_size
+        self.max_batch_size = max_batch_size
+        self.concurrency = concurrency
+        self.max_concurrency = max_concurrency
+        self.target_latency = target_latency
+        self.batch_increase = batch_increase
+        self.decrease = decrease
+        self.max_error_rate = max_error_rate
+        self.latency = None
+        self.throttled = 0
+        self._outcomes = deque(maxlen=window)
+        self._streak = 0
+        self._lock = threading.Lock()
+
+    @property
+    def error_rate(self):
+        outcomes = self._outcomes
+        return (outcomes.count(False) / len(outcomes)) if outcomes else 0.0
+
+    @property
+    def setpoints(self):
+        """
+        The current setpoints and the observations they are based on.
+        """
+        return {
+            "batch_size": self.batch_size,
+            "concurrency": self.concurrency,
+            "latency": self.latency,
+            "error_rate": self.error_rate,
+            "throttled": self.throttled,
+        }
+
+    def _shrink_batch(self):
+        self.batch_size = max(self.min_batch_size, int(self.batch_size * self.decrease))
+
+    def _shrink_concurrency(self):
+        self.concurrency = max(1, int(self.concurrency * self.decrease))
+        self._streak = 0
+
+    def record(self, latency, status):
+        """
+        Records the outcome of a request: its latency in seconds and its HTTP
+        status (None for network errors).
+        """
+        with self._lock:
+            self.latency = (
+                latency if self.latency is None else 0.8 * self.latency + 0.2 * latency
+            )
+            self._outcomes.append(status == 200)
+            if status == 429:
+                self.throttled += 1
+                self._shrink_concurrency()
+            elif status != 200:
+                self._shrink_concurrency()
+                self._shrink_batch()
+            elif latency > self.target_latency:
+                self._shrink_batch()
+            elif self.error_rate <= self.max_error_rate:
+                self.batch_size = min(
+                    self.max_batch_size, self.batch_size + self.batch_increase
+                )
+                self._streak += 1
+                if self._streak >= self.concurrency:
+                    self.concurrency = min(self.max_concurrency, self.concurrency + 1)
+                    self._streak = 0
+
+
+class AdaptivePublisher(object):
+    """
+    Publishes device messages in batches following an `AdaptiveController`.
+
+    Batches are sent by a fixed pool of `max_concurrency` worker threads of
+    the controller, at most `concurrency` at a time. Batches that failed
+    with a retryable status or a network error are put back in the queue
+    and retried up to `max_attempts` times, after their Retry-After time or
+    else `retry_backoff * 2 ** attempt` seconds. Messages can be published
+    directly with `publish`, or buffered with `submit` and published with
+    `flush` (or periodically from a background thread, see `start`).
+    """
+
+    def __init__(
+        self,
+        client,
+        controller=None,
+        max_attempts=5,
+        retry_backoff=0.5,
+        clock=time.monotonic,
+    ):
+        self.client = client
+        self.controller = controller or AdaptiveController()
+        self.max_attempts = max_attempts
+        self.retry_backoff = retry_backoff
+        self.clock = clock
+        self.published = 0
+        self.last_error = None
+        self._buffer = []
+        self._buffer_lock = threading.Lock()
+        self._thread = None
+        self._stopped = threading.Event()
+        self._jobs = deque()
+        self._jobs_ready = threading.Condition()
+        self._workers = []
+
+    def _send(self, batch):
+        start = self.clock()
+        try:
+            self.client.publish_device_message_list(batch)
+            status = 200
+            error = None
+        except PublishError as e:
+            status = e.status
+            error = e
+        except Exception as e:
+            # network errors, or anything else raised by the client
+            status = None
+            error = e
+        self.controller.record(self.clock() - start, status)
+        return (status, error)
+
+    def _retryable(self, status, error):
+        if status is None:
+            return isinstance(error, (OSError, HTTPException))
+        return status in RETRY_STATUSES
+
+    def _retry_delay(self, error, attempt):
+        seconds = getattr(error, "retry_after", None)
+        if seconds is None:
+            seconds = self.retry_backoff * (2**attempt)
+        return seconds
+
+    def _work(self):
+        jobs = self._jobs
+        while True:
+            with self._jobs_ready:
+                self._jobs_ready.wait_for(lambda: jobs)
+                job = jobs.popleft()
+            if job is None:
+                return
+            (run, batch, attempt) = job
+            try:
+                run(batch, attempt)
+            except Exception as e:
+                self.last_error = e
+
+    def _start_workers(self):
+        with self._jobs_ready:
+            if not self._workers:
+                self._workers = [
+                    threading.Thread(target=self._work, daemon=True)
+                    for _ in range(self.controller.max_concurrency)
+                ]
+                for thread in self._workers:
+                    thread.start()
+
+    def _submit_job(self, job):
+        with self._jobs_ready:
+            self._jobs.append(job)
+            self._jobs_ready.notify()
+
+    def publish(self, messages):
+        """
+        Publishes a list of messages and returns the number of published
+        messages. Raises the last error if some batches could not be published.
+        """
+        controller = self.controller
+        pending = deque()
+        position = 0
+        inflight = [0]
+        errors = []
+        published = [0]
+        cond = threading.Condition()
+
+        def run(batch, attempt):
+            (status, error) = (None, None)
+            try:
+                (status, error) = self._send(batch)
+            except Exception as e:
+                error = e
+            finally:
+                with cond:
+                    inflight[0] -= 1
+                    if error is not None and getattr(error, "accepted", 0):
+                        # only retry the messages the API did not accept
+                        published[0] += error.accepted
+                        batch = batch[error.accepted :]
+                    if error is None:
+                        published[0] += len(batch)
+                    elif (
+                        self._retryable(status, error)
+                        and attempt + 1 < self.max_attempts
+                    ):
+                        ready = self.clock() + self._retry_delay(error, attempt)
+                        pending.append((ready, batch, attempt + 1))
+                    else:
+                        errors.append(error)
+                    cond.notify_all()
+
+        self._start_workers()
+        with cond:
+            while True:
+                cond.wait_for(
+                    lambda: inflight[0] < controller.concurrency
+                    and (pending or position < len(messages) or inflight[0] == 0)
+                )
+                if pending:
+                    (ready, batch, attempt) = pending[0]
+                    wait = ready - self.clock()
+                    if wait > 0:
+                        # retries wait for their backoff before new batches
+                        cond.wait(wait)
+                        continue
+                    pending.popleft()
+                elif position < len(messages):
+                    batch = messages[position : position + controller.batch_size]
+                    position += len(batch)
+                    attempt = 0
+                else:
+                    break
+                inflight[0] += 1
+                self._submit_job((run, batch, attempt))
+
+        self.published += published[0]
+        if errors:
+            raise errors[-1]
+        return published[0]
+
+    def submit(self, message):
+        """
+        Buffers a message to be published by the next `flush`.
+        """
+        with self._buffer_lock:
+            self._buffer.append(message)
+
+    def flush(self):
+        """
+        Publishes all the buffered messages.
+        """
+        with self._buffer_lock:
+            (messages, self._buffer) = (self._buffer, [])
+        if messages:
+            return self.publish(messages)
+        return 0
+
+    def start(self, interval=1.0):
+        """
+        Starts a background thread that flushes the buffer every `interval`
+        seconds, or as soon as it holds a full batch.
+        """
+
+        def loop():
+            last = self.clock()
+            while not self._stopped.wait(min(interval, 0.05)):
+                if (
+                    len(self._buffer) >= self.controller.batch_size
+                    or self.clock() - last >= interval
+                ):
+                    last = self.clock()
+                    try:
+                        self.flush()
+                    except Exception as e:
+                        # failed messages are dropped, the controller backs off
+                        self.last_error = e
+
+        self._stopped.clear()
+        self._thread = threading.Thread(target=loop, daemon=True)
+        self._thread.start()
+
+    def stop(self):
+        """
+        Stops the background thread, flushes the remaining messages and
+        stops the workers.
+        """
+        self._stopped.set()
+        if self._thread is not None:
+            self._thread.join()
+            self._thread = None
+        try:
+            return self.flush()
+        finally:
+            self.close()
+
+    def close(self):
+        """
+        Stops the worker threads, they are started again by the next
+        `publish`.
+        """
+        with self._jobs_ready:
+            (workers, self._workers) = (self._workers, [])
+            self._jobs.extend([None] * len(workers))
+            self._jobs_ready.notify_all()
+        for thread in workers:
+            thread.join()
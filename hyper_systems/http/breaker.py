@@ -0,0 +1,364 @@
+"""
+breaker
+
+Circuit breakers and failover between API endpoints for the publish path.
+"""
+import json
+import threading
+import time
+import urllib.error
+from collections import deque
+
+from .client import RETRY_STATUSES, Client, PublishError
+
+CLOSED = "closed"
+OPEN = "open"
+HALF_OPEN = "half_open"
+
+
+class CircuitOpenError(Exception):
+    """
+    Raised when no endpoint could take a message list, because their
+    circuits are open or their requests failed. `remaining` is the part of
+    the list that was not published.
+    """
+
+    def __init__(self, urls, last_error=None, remaining=None):
+        ctx = {"urls": urls, "last_error": last_error}
+        super().__init__("all endpoints are unavailable: " + str(ctx))
+        self.urls = urls
+        self.last_error = last_error
+        self.remaining = remaining
+
+
+def is_failure(error):
+    """
+    Returns whether an error means that the endpoint is unhealthy: network
+    errors and timeouts, throttling and server errors. Other statuses (e.g.
+    400 or 413) are answers of a healthy endpoint.
+    """
+    from http.client import HTTPException
+
+    if isinstance(error, PublishError):
+        return error.status in RETRY_STATUSES
+    return isinstance(error, (urllib.error.URLError, OSError, HTTPException))
+
+
+class CircuitBreaker(object):
+    """
+    A circuit breaker with a failure-rate window.
+
+    - closed: calls are allowed, and their outcomes are kept for the last
+      `window` calls. Once at least `min_calls` were made and the share of
+      failures reaches `failure_rate`, the circuit opens.
+    - open: calls are refused for `reset_timeout` seconds, then the circuit
+      is half-open.
+    - half-open: up to `half_open_calls` probe calls are allowed at a time.
+      A successful probe closes the circuit, a failed one opens it again.
+    """
+
+    def __init__(
+        self,
+        failure_rate=0.5,
+        window=20,
+        min_calls=5,
+        reset_timeout=30.0,
+        half_open_calls=1,
+        clock=time.monotonic,
+    ):
+        self.failure_rate = failure_rate
+        self.min_calls = min_calls
+        self.reset_timeout = reset_timeout
+        self.half_open_calls = half_open_calls
+        self.clock = clock
+        self.opened = 0
+        self._state = CLOSED
+        self._outcomes = deque(maxlen=window)
+        self._failures = 0
+        self._opened_at = None
+        self._probes = 0
+        self._lock = threading.Lock()
+
+    @property
+    def state(self):
+        with self._lock:
+            return self._current_state()
+
+    def _current_state(self):
+        # called with the lock held
+        if self._state == OPEN and self.clock() - self._opened_at >= self.reset_timeout:
+            self._state = HALF_OPEN
+            self._probes = 0
+        return self._state
+
+    def allow(self):
+        """
+        Returns whether a call can be made now. Every allowed call must be
+        followed by a `record` of its outcome.
+        """
+        with self._lock:
+            state = self._current_state()
+            if state == CLOSED:
+                return True
+            if state == HALF_OPEN and self._probes < self.half_open_calls:
+                self._probes += 1
+                return True
+            return False
+
+    def _open(self):
+        self._state = OPEN
+        self._opened_at = self.clock()
+        self._outcomes.clear()
+        self._failures = 0
+        self.opened += 1
+
+    def record(self, success):
+        """
+        Records the outcome of an allowed call.
+        """
+        with self._lock:
+            state = self._current_state()
+            if state == HALF_OPEN:
+                self._probes -= 1
+                if success:
+                    self._state = CLOSED
+                else:
+                    self._open()
+                return
+            if state == OPEN:
+                # a call allowed before the circuit opened
+                return
+            outcomes = self._outcomes
+            if len(outcomes) == outcomes.maxlen and not outcomes[0]:
+                self._failures -= 1
+            outcomes.append(success)
+            if not success:
+                self._failures += 1
+                if len(
+                    outcomes
+                ) >= self.min_calls and self._failures >= self.failure_rate * len(
+                    outcomes
+                ):
+                    self._open()
+
+    @property
+    def failure_ratio(self):
+        with self._lock:
+            outcomes = self._outcomes
+            return self._failures / len(outcomes) if outcomes else 0.0
+
+
+class LocalBuffer(object):
+    """
+    A bounded in-memory buffer of message lists. Once more than
+    `max_messages` messages are buffered, the oldest lists are dropped and
+    counted in `dropped`.
+    """
+
+    def __init__(self, max_messages=100000):
+        self.max_messages = max_messages
+        self.messages = 0
+        self.dropped = 0
+        self._batches = deque()
+        self._lock = threading.Lock()
+
+    def __len__(self):
+        return len(self._batches)
+
+    @staticmethod
+    def _count(batch):
+        return len(batch) if isinstance(batch, list) else 1
+
+    def put(self, batch):
+        with self._lock:
+            self._batches.append(batch)
+            self.messages += self._count(batch)
+            while self.messages > self.max_messages and len(self._batches) > 1:
+                dropped = self._count(self._batches.popleft())
+                self.messages -= dropped
+                self.dropped += dropped
+
+    def peek(self):
+        with self._lock:
+            return self._batches[0] if self._batches else None
+
+    def pop(self, batch):
+        """
+        Removes `batch` if it is still the oldest buffered list.
+        """
+        with self._lock:
+            if self._batches and self._batches[0] is batch:
+                self._batches.popleft()
+                self.messages -= self._count(batch)
+
+    def replace(self, batch, remaining):
+        """
+        Replaces `batch` with `remaining`, the part of it that was not
+        published, if it is still the oldest buffered list.
+        """
+        with self._lock:
+            if self._batches and self._batches[0] is batch:
+                self._batches[0] = remaining
+                self.messages += self._count(remaining) - self._count(batch)
+
+
+class FailoverClient(object):
+    """
+    Publishes message lists to the first healthy endpoint of `api_urls`.
+
+    Every endpoint has a `Client`, whose requests time out after `timeout`
+    seconds, and a circuit breaker made by `breaker_factory()`. Endpoints
+    are tried in order, those with an open circuit are skipped without any
+    request, and the part of a list that failed on an endpoint (see
+    `is_failure`) is tried on the next one. Other errors, e.g. a 400 status,
+    are raised.
+
+    When no endpoint could take a list, its unpublished part is put in
+    `buffer` (a `LocalBuffer` or anything with the same methods, including
+    `replace`) and the call returns
+    right away, or `CircuitOpenError` is raised without a buffer. Buffered
+    lists are published again, oldest first and at most `flush_batches` per
+    call, before the next lists once an endpoint is healthy again. Buffered
+    lists refused by a healthy endpoint (e.g. with a 400 status) are not
+    buffered again: their messages are counted in `rejected`, and the last
+    `max_dead_letters` of them are kept with their error in `dead_letters`.
+
+    Other keyword arguments are passed to the clients.
+    """
+
+    def __init__(
+        self,
+        api_urls,
+        api_key,
+        site_id,
+        timeout=10.0,
+        buffer=None,
+        breaker_factory=CircuitBreaker,
+        transport_factory=None,
+        flush_batches=10,
+        max_dead_letters=100,
+        **client_kwargs
+    ):
+        if isinstance(api_urls, str):
+            api_urls = [api_urls]
+        if not api_urls:
+            raise ValueError("a failover client needs at least one api url")
+        if transport_factory is None:
+            from .transport import HTTPTransport
+
+            def transport_factory(api_url):
+                return HTTPTransport(timeout=timeout)
+
+        self.api_urls = list(api_urls)
+        self.buffer = buffer
+        self.flush_batches = flush_batches
+        self.diverted = 0
+        self.rejected = 0
+        self.dead_letters = deque(maxlen=max_dead_letters)
+        self.last_error = None
+        self.endpoints = [
+            (
+                Client(
+                    api_url,
+                    api_key,
+                    site_id,
+                    transport=transport_factory(api_url),
+                    **client_kwargs
+                ),
+                breaker_factory(),
+            )
+            for api_url in self.api_urls
+        ]
+
+    @property
+    def states(self):
+        """
+        The circuit state of every endpoint, by api url.
+        """
+        return {client.api_url: breaker.state for (client, breaker) in self.endpoints}
+
+    def _publish(self, device_message_list):
+        # messages accepted by an endpoint are not sent to the next ones,
+        # errors report the positions in the list given to _publish
+        last_error = None
+        offset = 0
+        for (client, breaker) in self.endpoints:
+            if not breaker.allow():
+                continue
+            try:
+                client.publish_device_message_list(device_message_list)
+            except Exception as e:
+                failed = is_failure(e)
+                breaker.record(not failed)
+                if not failed:
+                    if offset and isinstance(e, PublishError):
+                        e.accepted += offset
+                    raise
+                self.last_error = last_error = e
+                accepted = getattr(e, "accepted", 0)
+                if accepted:
+                    if not isinstance(device_message_list, list):
+                        device_message_list = json.loads(bytes(device_message_list))
+                    device_message_list = device_message_list[accepted:]
+                    offset += accepted
+                continue
+            breaker.record(True)
+            return
+        raise CircuitOpenError(self.api_urls, last_error, device_message_list)
+
+    def flush_buffer(self, max_batches=None):
+        """
+        Publishes buffered lists until the buffer is empty, `max_batches`
+        were published or no endpoint is available. Returns the number of
+        published or rejected lists.
+        """
+        count = 0
+        buffer = self.buffer
+        while buffer is not None and (max_batches is None or count < max_batches):
+            batch = buffer.peek()
+            if batch is None:
+                break
+            try:
+                self._publish(batch)
+            except CircuitOpenError as e:
+                if e.remaining is not batch:
+                    buffer.replace(batch, e.remaining)
+                break
+            except Exception as e:
+                # the list would block the buffer forever
+                self.last_error = e
+                rejected = batch
+                if isinstance(batch, list):
+                    rejected = batch[getattr(e, "accepted", 0) :]
+                self.rejected += LocalBuffer._count(rejected)
+                self.dead_letters.append((rejected, e))
+            buffer.pop(batch)
+            count += 1
+        return count
+
+    def publish_device_message_list(self, device_message_list):
+        """
+        Publishes a list of device messages, see the class documentation.
+        """
+        buffer = self.buffer
+        if buffer is not None and len(buffer):
+            self.flush_buffer(self.flush_batches)
+            if len(buffer):
+                # keep the order of the messages while the API recovers
+                buffer.put(device_message_list)
+                self.diverted += LocalBuffer._count(device_message_list)
+                return
+        try:
+            self._publish(device_message_list)
+        except CircuitOpenError as e:
+            if buffer is None:
+                raise
+            buffer.put(e.remaining)
+            self.diverted += LocalBuffer._count(e.remaining)
+
+    def publish_device_message(self, device_message):
+        self.publish_device_message_list([device_message])
+
+    def close(self):
+        for (client, _breaker) in self.endpoints:
+            client.transport.close()
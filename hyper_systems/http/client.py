@@ -1,38 +1,293 @@
 import json
-from .pysimpleurl import request
+import time
+
+RETRY_STATUSES = (429, 500, 502, 503, 504)
+
+_encode_json = json.JSONEncoder(separators=(",", ":")).encode
+
+
+class PublishError(Exception):
+    """
+    Raised when the API does not accept a list of device messages.
+
+    When a list was published in several requests, `accepted` is the number
+    of messages at the start of the list that were published before the
+    failure. `retry_after` is the Retry-After time of the response in
+    seconds, or None.
+    """
+
+    def __init__(self, url, status, body, accepted=0, retry_after=None):
+        ctx = {"url": url, "status": status, "body": body}
+        super().__init__("could not publish message: " + str(ctx))
+        self.url = url
+        self.status = status
+        self.body = body
+        self.accepted = accepted
+        self.retry_after = retry_after
+
+
+def retry_after(response):
+    """
+    Returns the Retry-After time of a response in seconds, or None.
+    """
+    value = response.headers.get("Retry-After") if response.headers else None
+    try:
+        return float(value)
+    except (TypeError, ValueError):
+        return None
 
 
 class Client(object):
-    def __init__(self, api_url, api_key, site_id):
+    def __init__(
+        self,
+        api_url,
+        api_key,
+        site_id,
+        deduplicator=None,
+        retries=0,
+        retry_backoff=0.5,
+        rate_limiter=None,
+        pool=None,
+        max_body_bytes=None,
+        transport=None,
+    ):
+        """
+        Client for the device messages API of a site.
+
+        With a `deduplicator` (see `hyper_systems.http.dedup`) messages whose
+        `message_uuid` is already in flight or was recently acknowledged are
+        dropped before publishing. Failed requests are retried up to `retries`
+        times with exponential backoff, resending the same body (and so the
+        same message uuids).
+
+        With a `rate_limiter` (see `hyper_systems.http.ratelimit`) every
+        request first waits for the tokens of its site and API key, and 429
+        responses pause the site for their Retry-After time.
+
+        With a `pool` (see `hyper_systems.http.pool`) requests reuse the
+        pool's persistent connections. More generally requests are sent with
+        `transport.request` when a `transport` is given (see
+        `hyper_systems.http.transport`), e.g. to publish over a Unix socket or
+        to a file.
+
+        With `max_body_bytes` message lists are split into requests whose
+        body is at most that many bytes long. A list rejected with a 413
+        status is split in two and the halves are sent separately, down to
+        single messages: the limit (`body_limit`) is lowered to the size of
+        the first half, for this and the following requests.
+        """
         self.api_url = api_url[:-1] if api_url.endswith("/") else api_url
         self.api_key = api_key
         self.site_id = site_id
+        self.deduplicator = deduplicator
+        self.retries = retries
+        self.retry_backoff = retry_backoff
+        self.rate_limiter = rate_limiter
+        self.pool = pool
+        self.transport = transport if transport is not None else pool
+        self.max_body_bytes = max_body_bytes
+        self.body_limit = max_body_bytes
+        self._incoming_url = (None, None)
 
     def _get_incoming_url(self):
-        return (
-            self.api_url
-            + "/sites/"
-            + str(self.site_id)
-            + "/device_messages/v3/incoming"
-        )
+        (key, url) = self._incoming_url
+        if key != (self.api_url, self.site_id):
+            key = (self.api_url, self.site_id)
+            url = (
+                self.api_url
+                + "/sites/"
+                + str(self.site_id)
+                + "/device_messages/v3/incoming"
+            )
+            self._incoming_url = (key, url)
+        return url
+
+    def _throttle(self, data, message_count, response):
+        rate_limiter = self.rate_limiter
+        if response is None:
+            rate_limiter.acquire(self.site_id, self.api_key, message_count or 1)
+        elif response.status == 429:
+            seconds = retry_after(response)
+            if seconds is None:
+                seconds = 1.0
+            rate_limiter.penalize(self.site_id, self.api_key, seconds)
+
+    def _post(self, incoming_url, data, message_count=None):
+        import urllib.error
+
+        if self.transport is not None:
+            send = self.transport.request
+        else:
+            # urllib.request is slow to import, load it on the first publish
+            from .pysimpleurl import request as send
+
+        if not isinstance(data, (bytes, bytearray, memoryview)):
+            message_count = len(data)
+            # encode once, so that retries resend the same body
+            data = json.dumps(data).encode()
+        headers = {"Authorization": "Bearer %s" % self.api_key}
+
+        attempt = 0
+        while True:
+            if self.rate_limiter is not None:
+                self._throttle(data, message_count, None)
+            try:
+                response = send(incoming_url, headers=headers, data=data, method="post")
+            except urllib.error.URLError:
+                if attempt >= self.retries:
+                    raise
+            else:
+                if self.rate_limiter is not None:
+                    self._throttle(data, message_count, response)
+                if response.status not in RETRY_STATUSES or attempt >= self.retries:
+                    return response
+            time.sleep(self.retry_backoff * (2**attempt))
+            attempt += 1
+
+    def _claim(self, device_message_list):
+        # returns the (messages or body to send, claimed messages,
+        # deduplicator)
+        deduplicator = self.deduplicator
+        if deduplicator is None:
+            return (device_message_list, None, None)
+        if not isinstance(device_message_list, list):
+            message_uuids = getattr(device_message_list, "message_uuids", None)
+            if message_uuids is not None:
+                # encoded with their uuids, sent as is without duplicates
+                refs = [
+                    {"message_uuid": message_uuid} for message_uuid in message_uuids
+                ]
+                claimed = deduplicator.claim(refs)
+                if len(claimed) == len(refs):
+                    return (device_message_list, claimed, deduplicator)
+                # decoded to send only the claimed messages
+                message_uuids = set(ref["message_uuid"] for ref in claimed)
+                claimed = []
+                for message in json.loads(bytes(device_message_list)):
+                    if message["message_uuid"] in message_uuids:
+                        message_uuids.discard(message["message_uuid"])
+                        claimed.append(message)
+                return (claimed, claimed, deduplicator)
+            device_message_list = json.loads(bytes(device_message_list))
+        claimed = deduplicator.claim(device_message_list)
+        return (claimed, claimed, deduplicator)
+
+    @staticmethod
+    def _caller_error(error, device_message_list, messages):
+        # `accepted` counts the sent messages, make it a position in the list
+        # of the caller, whose duplicates were not sent
+        accepted = getattr(error, "accepted", None)
+        if accepted is None or messages is device_message_list:
+            return
+        if accepted >= len(messages):
+            return
+        if not isinstance(device_message_list, list):
+            device_message_list = json.loads(bytes(device_message_list))
+        message_uuid = messages[accepted]["message_uuid"]
+        for (i, message) in enumerate(device_message_list):
+            if message["message_uuid"] == message_uuid:
+                error.accepted = i
+                break
+
+    def _message_count(self, messages):
+        # the number of messages of a body, encoded bodies are only decoded
+        # when a rate limiter counts messages
+        if isinstance(messages, list):
+            return len(messages)
+        message_uuids = getattr(messages, "message_uuids", None)
+        if message_uuids is not None:
+            return len(message_uuids)
+        rate_limiter = self.rate_limiter
+        if rate_limiter is None or rate_limiter.unit != "messages":
+            return None
+        return len(json.loads(bytes(messages)))
+
+    def _bodies(self, incoming_url, messages, accepted):
+        # yields the (body, message count) of the requests publishing the
+        # messages and receives their responses, so that the same logic
+        # drives the sync and async clients
+        if not isinstance(messages, list) or not messages:
+            response = yield (messages, self._message_count(messages))
+            if response.status != 200:
+                raise PublishError(
+                    incoming_url,
+                    response.status,
+                    response.body,
+                    retry_after=retry_after(response),
+                )
+            return
+
+        # once there is a body limit the messages are encoded one by one, so
+        # that requests can be cut at message boundaries
+        parts = None
+        pos = 0
+        while pos < len(messages):
+            limit = self.body_limit
+            if limit is None:
+                end = len(messages)
+                data = json.dumps(messages).encode()
+            else:
+                if parts is None:
+                    parts = [_encode_json(m).encode() for m in messages]
+                end = pos + 1
+                size = len(parts[pos]) + 2
+                while end < len(messages) and size + len(parts[end]) + 1 <= limit:
+                    size += len(parts[end]) + 1
+                    end += 1
+                data = b"[" + b",".join(parts[pos:end]) + b"]"
+            response = yield (data, end - pos)
+            if response.status == 413 and end - pos > 1:
+                # bisect: the size of the first half becomes the limit
+                if parts is None:
+                    parts = [_encode_json(m).encode() for m in messages]
+                half = pos + (end - pos) // 2
+                self.body_limit = sum(len(part) + 1 for part in parts[pos:half]) + 1
+                continue
+            if response.status != 200:
+                raise PublishError(
+                    incoming_url,
+                    response.status,
+                    response.body,
+                    accepted=pos,
+                    retry_after=retry_after(response),
+                )
+            accepted.extend(messages[pos:end])
+            pos = end
 
     def publish_device_message_list(self, device_message_list):
         """
         Publishes a list of device messages
+
+        The list can also be given already encoded as JSON bytes, for example
+        with `hyper_systems.devices.encoding.MessageEncoder.encode_list`.
+        With a deduplicator, bytes are decoded to drop duplicates, unless they
+        carry the `message_uuids` of their messages and none is a duplicate.
+
+        When publishing fails after part of the list was accepted, the
+        `accepted` attribute of the `PublishError` is the position in
+        `device_message_list` of the first message that was not published.
         """
 
         incoming_url = self._get_incoming_url()
-        data = device_message_list
-        headers = {"Authorization": "Bearer %s" % self.api_key}
-
-        response = request(incoming_url, headers=headers, data=data, method="post")
-        if response.status != 200:
-            ctx = {
-                "url": incoming_url,
-                "status": response.status,
-                "body": response.body,
-            }
-            raise Exception("could not publish message: " + str(ctx))
+        (messages, claimed, deduplicator) = self._claim(device_message_list)
+        if deduplicator is not None and not claimed:
+            return
+        accepted = []
+        bodies = self._bodies(incoming_url, messages, accepted)
+        try:
+            request = next(bodies)
+            while True:
+                request = bodies.send(self._post(incoming_url, *request))
+        except StopIteration:
+            pass
+        except BaseException as e:
+            if deduplicator is not None:
+                deduplicator.ack(accepted)
+                deduplicator.release(claimed[len(accepted) :])
+            self._caller_error(e, device_message_list, messages)
+            raise
+        if deduplicator is not None:
+            deduplicator.ack(claimed)
 
     def publish_device_message(self, device_message):
         """
@@ -40,3 +295,108 @@ class Client(object):
         """
         device_message_list = [device_message]
         self.publish_device_message_list(device_message_list)
+
+
+class AsyncClient(Client):
+    """
+    Client for the device messages API of a site, for asyncio code.
+
+    Requests are sent with an asynchronous transport, `AsyncHTTPTransport`
+    by default (see `hyper_systems.http.transport`), and `pool` is used as
+    the transport when no `transport` is given. Deduplication, retries, rate
+    limiters and body limits work as with `Client`, rate limiters wait for
+    their tokens without blocking the event loop.
+    """
+
+    def __init__(
+        self,
+        api_url,
+        api_key,
+        site_id,
+        deduplicator=None,
+        retries=0,
+        retry_backoff=0.5,
+        rate_limiter=None,
+        pool=None,
+        max_body_bytes=None,
+        transport=None,
+    ):
+        if transport is None and pool is None:
+            from .transport import AsyncHTTPTransport
+
+            transport = AsyncHTTPTransport()
+        super().__init__(
+            api_url,
+            api_key,
+            site_id,
+            deduplicator=deduplicator,
+            retries=retries,
+            retry_backoff=retry_backoff,
+            rate_limiter=rate_limiter,
+            pool=pool,
+            max_body_bytes=max_body_bytes,
+            transport=transport,
+        )
+
+    async def _post(self, incoming_url, data, message_count=None):
+        import asyncio
+        import urllib.error
+
+        if not isinstance(data, (bytes, bytearray, memoryview)):
+            message_count = len(data)
+            data = json.dumps(data).encode()
+        headers = {"Authorization": "Bearer %s" % self.api_key}
+
+        attempt = 0
+        while True:
+            rate_limiter = self.rate_limiter
+            if rate_limiter is not None:
+                await rate_limiter.acquire_async(
+                    self.site_id, self.api_key, message_count or 1
+                )
+            try:
+                response = await self.transport.request(
+                    incoming_url, headers=headers, data=data, method="post"
+                )
+            except urllib.error.URLError:
+                if attempt >= self.retries:
+                    raise
+            else:
+                if rate_limiter is not None:
+                    self._throttle(data, message_count, response)
+                if response.status not in RETRY_STATUSES or attempt >= self.retries:
+                    return response
+            await asyncio.sleep(self.retry_backoff * (2**attempt))
+            attempt += 1
+
+    async def publish_device_message_list(self, device_message_list):
+        """
+        Publishes a list of device messages, see
+        `Client.publish_device_message_list`.
+        """
+        incoming_url = self._get_incoming_url()
+        (messages, claimed, deduplicator) = self._claim(device_message_list)
+        if deduplicator is not None and not claimed:
+            return
+        accepted = []
+        bodies = self._bodies(incoming_url, messages, accepted)
+        try:
+            request = next(bodies)
+            while True:
+                request = bodies.send(await self._post(incoming_url, *request))
+        except StopIteration:
+            pass
+        except BaseException as e:
+            if deduplicator is not None:
+                deduplicator.ack(accepted)
+                deduplicator.release(claimed[len(accepted) :])
+            self._caller_error(e, device_message_list, messages)
+            raise
+        if deduplicator is not None:
+            deduplicator.ack(claimed)
+
+    async def publish_device_message(self, device_message):
+        await self.publish_device_message_list([device_message])
+
+    async def close(self):
+        await self.transport.close()
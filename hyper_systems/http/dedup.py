@@ -0,0 +1,90 @@
+"""
+dedup
+
+Publisher-side deduplication of device messages by `message_uuid`.
+"""
+import threading
+import time
+from collections import OrderedDict
+
+IN_FLIGHT = 0
+ACKNOWLEDGED = 1
+
+
+class MessageDeduplicator(object):
+    """
+    Tracks the `message_uuid`s of in-flight and acknowledged messages in a
+    bounded, time-windowed set.
+
+    A message is dropped by `claim` if a message with the same uuid is being
+    published or was acknowledged less than `window` seconds ago. At most
+    `max_size` uuids are tracked, the oldest ones are forgotten first.
+    """
+
+    def __init__(self, window=600.0, max_size=100000, clock=time.monotonic):
+        self.window = window
+        self.max_size = max_size
+        self.clock = clock
+        self.dropped = 0
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+
+    def __len__(self):
+        return len(self._entries)
+
+    def __contains__(self, message_uuid):
+        return message_uuid in self._entries
+
+    def _expire(self, now):
+        entries = self._entries
+        deadline = now - self.window
+        while entries:
+            (message_uuid, (_state, seen)) = next(iter(entries.items()))
+            if seen > deadline and len(entries) <= self.max_size:
+                break
+            entries.popitem(last=False)
+
+    def claim(self, messages):
+        """
+        Returns the messages that are not duplicates and marks them as
+        in-flight.
+        """
+        now = self.clock()
+        claimed = []
+        with self._lock:
+            self._expire(now)
+            entries = self._entries
+            for message in messages:
+                message_uuid = message["message_uuid"]
+                if message_uuid in entries:
+                    self.dropped += 1
+                    continue
+                entries[message_uuid] = (IN_FLIGHT, now)
+                claimed.append(message)
+            self._expire(now)
+        return claimed
+
+    def ack(self, messages):
+        """
+        Marks messages as acknowledged by the API.
+        """
+        now = self.clock()
+        with self._lock:
+            entries = self._entries
+            for message in messages:
+                message_uuid = message["message_uuid"]
+                entries[message_uuid] = (ACKNOWLEDGED, now)
+                entries.move_to_end(message_uuid)
+            self._expire(now)
+
+    def release(self, messages):
+        """
+        Forgets in-flight messages that could not be published, so that they
+        can be published again.
+        """
+        with self._lock:
+            entries = self._entries
+            for message in messages:
+                entry = entries.get(message["message_uuid"])
+                if entry is not None and entry[0] == IN_FLIGHT:
+                    del entries[message["message_uuid"]]
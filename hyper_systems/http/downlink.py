@@ -0,0 +1,362 @@
+"""
+downlink
+
+Receiving downlink device messages (values written from the cloud) and
+handing them to the devices as they arrive.
+"""
+import codecs
+import http.client
+import json
+import re
+import socket
+import threading
+import urllib.parse
+
+_skip = re.compile(r"[\s,]*")
+# the characters that change the nesting of a message, in and out of strings
+_string_special = re.compile(r'["\\]')
+_special = re.compile(r'["{}\[\]]')
+
+
+class ReceiveError(Exception):
+    """
+    Raised when the API does not answer a downlink request with messages.
+    """
+
+    def __init__(self, url, status, body):
+        ctx = {"url": url, "status": status, "body": body}
+        super().__init__("could not receive messages: " + str(ctx))
+        self.url = url
+        self.status = status
+        self.body = body
+
+
+class MessageStreamDecoder(object):
+    """
+    Incrementally decodes device messages from a byte stream.
+
+    The stream can be a JSON array of messages (a `DeviceMessageList`),
+    newline-delimited messages, or newline-delimited arrays of messages.
+    `feed` returns the messages completed by each chunk, so messages are
+    available before the whole body is received. Chunks are scanned once:
+    a message is only decoded when its closing brace arrived.
+    """
+
+    def __init__(self, max_buffer=16 * 1024 * 1024):
+        self.max_buffer = max_buffer
+        self._text = codecs.getincrementaldecoder("utf-8")()
+        self._depth = 0
+        # the parts of the message being received and its scan state
+        self._parts = None
+        self._size = 0
+        self._nesting = 0
+        self._in_string = False
+        self._escape = False
+
+    def _scan(self, text, pos):
+        """
+        Scans a message from `pos`, returns the position after its closing
+        brace or None if it does not end in `text`.
+        """
+        nesting = self._nesting
+        in_string = self._in_string
+        if self._escape and pos < len(text):
+            # the character escaped at the end of the previous chunk
+            pos += 1
+            self._escape = False
+        end = len(text)
+        while True:
+            match = (_string_special if in_string else _special).search(text, pos)
+            if match is None:
+                break
+            pos = match.end()
+            char = match.group()
+            if char == "\\":
+                if pos == end:
+                    self._escape = True
+                    break
+                pos += 1
+            elif char == '"':
+                in_string = not in_string
+            elif char in "{[":
+                nesting += 1
+            else:
+                nesting -= 1
+                if nesting == 0:
+                    (self._nesting, self._in_string) = (0, False)
+                    return pos
+        (self._nesting, self._in_string) = (nesting, in_string)
+        return None
+
+    def feed(self, data):
+        text = self._text.decode(data)
+        messages = []
+        pos = 0
+        end = len(text)
+        while True:
+            if self._parts is not None:
+                stop = self._scan(text, pos)
+                if stop is None:
+                    self._parts.append(text[pos:])
+                    self._size += end - pos
+                    if self._size > self.max_buffer:
+                        raise ValueError(
+                            "message larger than %d characters in the message "
+                            "stream" % self.max_buffer
+                        )
+                    break
+                self._parts.append(text[pos:stop])
+                messages.append(json.loads("".join(self._parts)))
+                (self._parts, self._size) = (None, 0)
+                pos = stop
+            pos = _skip.match(text, pos).end()
+            if pos == end:
+                break
+            char = text[pos]
+            if char == "[":
+                self._depth += 1
+                pos += 1
+            elif char == "]":
+                if self._depth == 0:
+                    raise ValueError("unexpected ']' in the message stream")
+                self._depth -= 1
+                pos += 1
+            elif char == "{":
+                self._parts = []
+            else:
+                raise ValueError("unexpected %r in the message stream" % char)
+        return messages
+
+    def close(self):
+        """
+        Checks that the stream did not end in the middle of a message.
+        """
+        rest = self._text.decode(b"", final=True)
+        if self._parts is not None or rest.strip() or self._depth:
+            raise ValueError("the message stream ended with an incomplete message")
+
+
+class DownlinkReceiver(object):
+    """
+    Long-polls the downlink messages of a site over a persistent connection.
+
+    Every request waits up to `wait` seconds for messages. The response is
+    decoded as it is received, and every chunk of decoded messages is passed
+    to `handler(messages)` right away. By default messages are dispatched to
+    `devices` (a `Fleet`, a mapping of vendor device ids to devices or an
+    iterable of devices) with `dispatch_many`.
+
+    Messages that could not be handled, e.g. for an unknown device or with
+    an invalid value, are skipped: they are counted in `failed`, their error
+    is kept in `last_error` and passed to `on_error(messages, error)` if
+    set, and the cursor still moves past them.
+
+    The request is `GET <api_url>/sites/<site_id>/device_messages/v3/outgoing`
+    with the `wait` and, once the API returned an `X-Cursor` header, the
+    `cursor` query parameters.
+    """
+
+    def __init__(
+        self,
+        api_url,
+        api_key,
+        site_id,
+        devices=None,
+        handler=None,
+        wait=30.0,
+        timeout=None,
+        chunk_size=65536,
+        backoff=1.0,
+        max_backoff=60.0,
+        on_error=None,
+    ):
+        if handler is None:
+            if devices is None:
+                raise ValueError("a receiver needs devices or a handler")
+            if not hasattr(devices, "get"):
+                devices = {device.vendor_device_id: device for device in devices}
+            handler = self._dispatcher(devices)
+        parsed = urllib.parse.urlsplit(api_url)
+        if parsed.scheme not in ("http", "https"):
+            raise ValueError("unsupported url scheme: %s" % api_url)
+        self.scheme = parsed.scheme
+        self.netloc = parsed.netloc
+        self.path = (
+            parsed.path.rstrip("/")
+            + "/sites/"
+            + str(site_id)
+            + "/device_messages/v3/outgoing"
+        )
+        self.api_key = api_key
+        self.site_id = site_id
+        self.handler = handler
+        self.wait = wait
+        self.timeout = timeout if timeout is not None else wait + 10.0
+        self.chunk_size = chunk_size
+        self.backoff = backoff
+        self.max_backoff = max_backoff
+        self.cursor = None
+        self.on_error = on_error
+        self.received = 0
+        self.failed = 0
+        self.last_error = None
+        self._conn = None
+        self._thread = None
+        self._stopped = threading.Event()
+
+    def _failed(self, messages, error):
+        self.failed += len(messages)
+        self.last_error = error
+        if self.on_error is not None:
+            self.on_error(messages, error)
+
+    def _dispatcher(self, devices):
+        if hasattr(devices, "dispatch_many"):
+            dispatch = devices.dispatch_many
+        else:
+            from ..devices.device import dispatch_many
+
+            def dispatch(messages):
+                dispatch_many(devices, messages)
+
+        def handler(messages):
+            known = []
+            for message in messages:
+                if devices.get(message.get("vendor_device_id")) is None:
+                    self._failed(
+                        [message],
+                        ValueError(
+                            "tried to dispatch a message for an unknown device "
+                            "'%s'" % message.get("vendor_device_id")
+                        ),
+                    )
+                else:
+                    known.append(message)
+            if not known:
+                return
+            try:
+                dispatch(known)
+            except (TypeError, ValueError, KeyError):
+                # dispatch the valid messages one by one
+                for message in known:
+                    try:
+                        dispatch([message])
+                    except (TypeError, ValueError, KeyError) as e:
+                        self._failed([message], e)
+
+        return handler
+
+    def _connect(self):
+        if self._conn is None:
+            if self.scheme == "https":
+                self._conn = http.client.HTTPSConnection(
+                    self.netloc, timeout=self.timeout
+                )
+            else:
+                self._conn = http.client.HTTPConnection(
+                    self.netloc, timeout=self.timeout
+                )
+        return self._conn
+
+    def close(self):
+        conn = self._conn
+        self._conn = None
+        if conn is not None:
+            conn.close()
+
+    def poll(self):
+        """
+        Performs one long-polling request and returns the number of received
+        messages.
+        """
+        params = {"wait": self.wait}
+        if self.cursor is not None:
+            params["cursor"] = self.cursor
+        path = self.path + "?" + urllib.parse.urlencode(params)
+        headers = {
+            "Authorization": "Bearer %s" % self.api_key,
+            "Accept": "application/x-ndjson, application/json",
+        }
+        conn = self._connect()
+        try:
+            conn.request("GET", path, headers=headers)
+            response = conn.getresponse()
+            if response.status == 204:
+                response.read()
+                return 0
+            if response.status != 200:
+                body = response.read().decode("utf-8", "replace")
+                raise ReceiveError(
+                    "%s://%s%s" % (self.scheme, self.netloc, path),
+                    response.status,
+                    body,
+                )
+            count = self._receive(response)
+        except BaseException:
+            self.close()
+            raise
+        if response.will_close:
+            self.close()
+        cursor = response.getheader("X-Cursor")
+        if cursor is not None:
+            self.cursor = cursor
+        return count
+
+    def _receive(self, response):
+        decoder = MessageStreamDecoder()
+        read = getattr(response, "read1", response.read)
+        count = 0
+        while True:
+            data = read(self.chunk_size)
+            if not data:
+                break
+            messages = decoder.feed(data)
+            if messages:
+                count += len(messages)
+                self.received += len(messages)
+                try:
+                    self.handler(messages)
+                except Exception as e:
+                    # keep receiving, the cursor moves past these messages
+                    self._failed(messages, e)
+        decoder.close()
+        return count
+
+    def start(self):
+        """
+        Starts a background thread polling continuously. Errors are kept in
+        `last_error` and retried with exponential backoff.
+        """
+
+        def loop():
+            delay = self.backoff
+            while not self._stopped.is_set():
+                try:
+                    self.poll()
+                    delay = self.backoff
+                except Exception as e:
+                    if self._stopped.is_set():
+                        break
+                    self.last_error = e
+                    self._stopped.wait(delay)
+                    delay = min(self.max_backoff, delay * 2)
+
+        self._stopped.clear()
+        self._thread = threading.Thread(target=loop, daemon=True)
+        self._thread.start()
+
+    def stop(self, timeout=None):
+        """
+        Stops the background thread, interrupting the pending request.
+        """
+        self._stopped.set()
+        conn = self._conn
+        if conn is not None and conn.sock is not None:
+            try:
+                conn.sock.shutdown(socket.SHUT_RDWR)
+            except OSError:
+                pass
+        if self._thread is not None:
+            self._thread.join(timeout)
+            self._thread = None
+        self.close()
@@ -0,0 +1,220 @@
+"""
+multisite
+
+Publishing device messages to many sites from a single process.
+"""
+import threading
+from collections import deque
+
+from .client import Client
+from .pool import ConnectionPool
+
+
+class _Batch(object):
+    # the message lists queued by one `publish_many` call
+    def __init__(self):
+        self.pending = 0
+        self.errors = []
+
+
+class MultiSiteClient(object):
+    """
+    Publishes device message lists to any number of sites of the same API.
+
+    All the sites share one `ConnectionPool` and one pool of `workers`
+    threads. A lightweight `Client` (with its incoming URL cached) is kept per
+    site, `api_keys` maps site ids to their API key and defaults to
+    `api_key`. `deduplicator`, `retries`, `retry_backoff`, `rate_limiter` and
+    `max_body_bytes` are passed to the site clients.
+
+    Message lists queued with `submit` are scheduled round-robin across
+    sites: a worker publishes one list of a site and puts the site back at the
+    end of the ready queue, so a site with a large backlog cannot starve the
+    others, and the lists of a site are published one at a time in order.
+    """
+
+    def __init__(
+        self,
+        api_url,
+        api_key=None,
+        api_keys=None,
+        workers=8,
+        pool=None,
+        deduplicator=None,
+        retries=0,
+        retry_backoff=0.5,
+        rate_limiter=None,
+        max_errors=1000,
+        max_body_bytes=None,
+    ):
+        self.api_url = api_url
+        self.api_key = api_key
+        self.api_keys = dict(api_keys or {})
+        self.pool = pool or ConnectionPool(api_url, max_size=workers)
+        self.deduplicator = deduplicator
+        self.retries = retries
+        self.retry_backoff = retry_backoff
+        self.rate_limiter = rate_limiter
+        self.max_body_bytes = max_body_bytes
+        self.published = 0
+        self._clients = {}
+        self._queues = {}
+        self._ready = deque()
+        self._pending = 0
+        self._errors = deque(maxlen=max_errors)
+        self._lock = threading.Lock()
+        self._work_ready = threading.Condition(self._lock)
+        self._idle = threading.Condition(self._lock)
+        self._stopped = False
+        self._threads = [
+            threading.Thread(target=self._work, daemon=True) for _ in range(workers)
+        ]
+        for thread in self._threads:
+            thread.start()
+
+    def client(self, site_id):
+        """
+        Returns the `Client` of a site.
+        """
+        client = self._clients.get(site_id)
+        if client is None:
+            api_key = self.api_keys.get(site_id, self.api_key)
+            if api_key is None:
+                raise ValueError("no API key for site %s" % site_id)
+            client = Client(
+                self.api_url,
+                api_key,
+                site_id,
+                deduplicator=self.deduplicator,
+                retries=self.retries,
+                retry_backoff=self.retry_backoff,
+                rate_limiter=self.rate_limiter,
+                pool=self.pool,
+                max_body_bytes=self.max_body_bytes,
+            )
+            self._clients[site_id] = client
+        return client
+
+    def publish(self, site_id, device_message_list):
+        """
+        Publishes a list of device messages to a site from the calling thread.
+        """
+        self.client(site_id).publish_device_message_list(device_message_list)
+
+    def submit(self, site_id, device_message_list):
+        """
+        Queues a list of device messages to be published to a site.
+        """
+        self._submit(site_id, device_message_list, None)
+
+    def _submit(self, site_id, device_message_list, batch):
+        client = self.client(site_id)
+        with self._lock:
+            if self._stopped:
+                raise RuntimeError("the client is closed")
+            self._pending += 1
+            if batch is not None:
+                batch.pending += 1
+            messages = self._queues.get(site_id)
+            if messages is None:
+                self._queues[site_id] = deque([(client, device_message_list, batch)])
+                self._ready.append(site_id)
+                self._work_ready.notify()
+            else:
+                messages.append((client, device_message_list, batch))
+
+    def publish_many(self, site_messages, timeout=None):
+        """
+        Publishes the message lists of many sites, given as a {site_id:
+        message list} dict or an iterable of (site_id, message list) pairs,
+        and waits for them. Returns the list of `(site_id, error)` of the
+        lists that could not be published, leaving out the lists of other
+        calls and of `submit`. Lists still pending after `timeout` seconds
+        are not waited for.
+        """
+        if isinstance(site_messages, dict):
+            site_messages = site_messages.items()
+        batch = _Batch()
+        for (site_id, device_message_list) in site_messages:
+            self._submit(site_id, device_message_list, batch)
+        with self._idle:
+            self._idle.wait_for(lambda: batch.pending == 0, timeout)
+            return list(batch.errors)
+
+    def _work(self):
+        while True:
+            with self._lock:
+                self._work_ready.wait_for(lambda: self._ready or self._stopped)
+                if not self._ready:
+                    return
+                site_id = self._ready.popleft()
+                (client, device_message_list, batch) = self._queues[site_id][0]
+            error = None
+            try:
+                client.publish_device_message_list(device_message_list)
+            except Exception as e:
+                error = e
+            with self._lock:
+                messages = self._queues[site_id]
+                messages.popleft()
+                if messages:
+                    self._ready.append(site_id)
+                    self._work_ready.notify()
+                else:
+                    del self._queues[site_id]
+                if error is None:
+                    self.published += 1
+                elif batch is None:
+                    self._errors.append((site_id, error))
+                else:
+                    batch.errors.append((site_id, error))
+                self._pending -= 1
+                if batch is not None:
+                    batch.pending -= 1
+                if self._pending == 0 or batch is not None and batch.pending == 0:
+                    self._idle.notify_all()
+
+    @property
+    def pending(self):
+        return self._pending
+
+    @property
+    def errors(self):
+        """
+        The list of `(site_id, error)` of the lists queued with `submit` that
+        could not be published.
+        """
+        with self._lock:
+            return list(self._errors)
+
+    def pop_errors(self):
+        """
+        Returns and clears the list of publishing errors.
+        """
+        with self._lock:
+            errors = list(self._errors)
+            self._errors.clear()
+        return errors
+
+    def join(self, timeout=None):
+        """
+        Waits until all the queued message lists are published. Returns False
+        if the timeout expired first.
+        """
+        with self._idle:
+            return self._idle.wait_for(lambda: self._pending == 0, timeout)
+
+    def close(self, wait=True):
+        """
+        Stops the worker threads, once the queued lists are published if
+        `wait` is set, and closes the connection pool.
+        """
+        if wait:
+            self.join()
+        with self._lock:
+            self._stopped = True
+            self._work_ready.notify_all()
+        if wait:
+            for thread in self._threads:
+                thread.join()
+        self.pool.close()
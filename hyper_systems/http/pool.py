@@ -0,0 +1,127 @@
+"""
+pool
+
+Keep-alive HTTP connections to the Hyper API, shared between threads.
+"""
+import http.client
+import json
+import threading
+import urllib.error
+import urllib.parse
+
+from .pysimpleurl import Response
+
+
+class ConnectionPool(object):
+    """
+    A pool of at most `max_size` persistent connections to the host of
+    `api_url`.
+
+    `request` has the same signature and return value as
+    `pysimpleurl.request`, so that a pool can be passed to `Client` to reuse
+    connections instead of opening one per request. Network errors are raised
+    as `urllib.error.URLError`.
+    """
+
+    def __init__(self, api_url, max_size=10, timeout=None):
+        parsed = urllib.parse.urlsplit(api_url)
+        if parsed.scheme not in ("http", "https"):
+            raise ValueError("unsupported url scheme: %s" % api_url)
+        self.scheme = parsed.scheme
+        self.netloc = parsed.netloc
+        self.max_size = max_size
+        self.timeout = timeout
+        self._idle = []
+        self._lock = threading.Lock()
+        self._slots = threading.BoundedSemaphore(max_size)
+        self._closed = False
+
+    def _connect(self):
+        if self.scheme == "https":
+            return http.client.HTTPSConnection(self.netloc, timeout=self.timeout)
+        return http.client.HTTPConnection(self.netloc, timeout=self.timeout)
+
+    def _path(self, url, params):
+        parsed = urllib.parse.urlsplit(url)
+        if (parsed.scheme, parsed.netloc) != (self.scheme, self.netloc):
+            raise ValueError(
+                "url %s is not on %s://%s" % (url, self.scheme, self.netloc)
+            )
+        path = parsed.path or "/"
+        query = parsed.query
+        if params:
+            encoded = urllib.parse.urlencode(params, doseq=True, safe="/")
+            query = query + "&" + encoded if query else encoded
+        return path + "?" + query if query else path
+
+    def request(
+        self,
+        url,
+        data=None,
+        params=None,
+        headers=None,
+        method="GET",
+        data_as_json=True,
+    ):
+        """
+        Performs a request on a pooled connection, see `pysimpleurl.request`.
+        """
+        method = method.upper()
+        path = self._path(url, params)
+        headers = {"Accept": "application/json", **(headers or {})}
+        body = None
+        if isinstance(data, (bytes, bytearray, memoryview)):
+            body = data
+        elif data:
+            if data_as_json:
+                body = json.dumps(data).encode()
+            else:
+                body = urllib.parse.urlencode(data).encode()
+        if body is not None:
+            headers["Content-Length"] = str(len(body))
+            if data_as_json:
+                headers["Content-Type"] = "application/json; charset=UTF-8"
+
+        self._slots.acquire()
+        try:
+            while True:
+                with self._lock:
+                    reused = bool(self._idle)
+                    conn = self._idle.pop() if reused else self._connect()
+                try:
+                    conn.request(method, path, body=body, headers=headers)
+                    httpresponse = conn.getresponse()
+                    content = httpresponse.read()
+                except (http.client.HTTPException, OSError) as e:
+                    conn.close()
+                    if reused:
+                        # the server closed an idle connection, retry on a new one
+                        continue
+                    raise urllib.error.URLError(e)
+                break
+            if httpresponse.will_close or self._closed:
+                conn.close()
+            else:
+                with self._lock:
+                    self._idle.append(conn)
+        finally:
+            self._slots.release()
+
+        charset = httpresponse.msg.get_content_charset("utf-8")
+        return Response(
+            body=content.decode(charset),
+            headers=httpresponse.msg,
+            status=httpresponse.status,
+            error_count=0 if httpresponse.status < 400 else 1,
+        )
+
+    def close(self):
+        """
+        Closes the idle connections. Connections in use are closed once their
+        request completes.
+        """
+        with self._lock:
+            self._closed = True
+            (idle, self._idle) = (self._idle, [])
+        for conn in idle:
+            conn.close()
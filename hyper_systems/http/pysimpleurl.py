@@ -48,7 +48,8 @@ def request(
 
     Args:
         url: url to fetch
-        data: dict of keys/values to be encoded and submitted
+        data: dict of keys/values to be encoded and submitted, or an already
+            encoded body (bytes, bytearray or memoryview)
         params: dict of keys/values to be encoded in URL query string
         headers: optional dict of request headers
         method: HTTP method , such as GET or POST
@@ -78,7 +79,11 @@ def request(
     if params:
         url += "?" + urllib.parse.urlencode(params, doseq=True, safe="/")
 
-    if data:
+    if isinstance(data, (bytes, bytearray, memoryview)):
+        request_data = data
+        if data_as_json:
+            headers["Content-Type"] = "application/json; charset=UTF-8"
+    elif data:
         if data_as_json:
             request_data = json.dumps(data).encode()
             headers["Content-Type"] = "application/json; charset=UTF-8"
@@ -0,0 +1,259 @@
+"""
+ratelimit
+
+Client-side token bucket rate limiting per site and per API key.
+"""
+import os
+import struct
+import tempfile
+import threading
+import time
+import zlib
+
+_STATE = struct.Struct("<dd")
+
+
+class TokenBucket(object):
+    """
+    A thread-safe token bucket refilled at `rate` tokens per second, holding
+    at most `capacity` tokens (one second worth of tokens by default).
+
+    Requests for more tokens than the capacity wait for a full bucket and
+    leave it in debt (with a negative number of tokens), so that the next
+    requests wait until the extra tokens are refilled.
+    """
+
+    def __init__(self, rate, capacity=None, clock=time.monotonic, sleep=time.sleep):
+        self.rate = float(rate)
+        self.capacity = float(capacity if capacity is not None else max(rate, 1))
+        self.clock = clock
+        self.sleep = sleep
+        self._lock = threading.Lock()
+        self._tokens = self.capacity
+        self._last = clock()
+
+    def _load(self):
+        return (self._tokens, self._last)
+
+    def _store(self, tokens, last):
+        self._tokens = tokens
+        self._last = last
+
+    def _locked(self):
+        return self._lock
+
+    def _take(self, tokens):
+        """
+        Takes tokens if available, otherwise returns the seconds to wait.
+        """
+        needed = min(tokens, self.capacity)
+        with self._locked():
+            now = self.clock()
+            (available, last) = self._load()
+            available = min(self.capacity, available + (now - last) * self.rate)
+            if available >= needed:
+                self._store(available - tokens, now)
+                return 0.0
+            self._store(available, now)
+            return (needed - available) / self.rate
+
+    @property
+    def tokens(self):
+        with self._locked():
+            (available, last) = self._load()
+            return min(self.capacity, available + (self.clock() - last) * self.rate)
+
+    def try_acquire(self, tokens=1):
+        return self._take(tokens) == 0.0
+
+    def acquire(self, tokens=1, timeout=None):
+        """
+        Waits until `tokens` tokens are available and takes them. Returns False
+        if they could not be taken within `timeout` seconds.
+        """
+        deadline = None if timeout is None else self.clock() + timeout
+        while True:
+            wait = self._take(tokens)
+            if wait == 0.0:
+                return True
+            if deadline is not None:
+                remaining = deadline - self.clock()
+                if remaining <= 0:
+                    return False
+                wait = min(wait, remaining)
+            self.sleep(wait)
+
+    def penalize(self, seconds):
+        """
+        Empties the bucket so that no tokens are available for `seconds`, e.g.
+        after a 429 response with a Retry-After header.
+        """
+        with self._locked():
+            self._store(-seconds * self.rate, self.clock())
+
+
+class _FileLock(object):
+    def __init__(self, path):
+        import fcntl
+
+        self._flock = fcntl.flock
+        self._lock_ex = fcntl.LOCK_EX
+        self._lock_un = fcntl.LOCK_UN
+        self._fd = os.open(path, os.O_RDWR | os.O_CREAT, 0o600)
+        self._thread_lock = threading.Lock()
+
+    def __enter__(self):
+        self._thread_lock.acquire()
+        self._flock(self._fd, self._lock_ex)
+
+    def __exit__(self, *exc):
+        self._flock(self._fd, self._lock_un)
+        self._thread_lock.release()
+
+
+class SharedTokenBucket(TokenBucket):
+    """
+    A token bucket whose state lives in a named shared memory segment, so that
+    all the processes of a host using the same `name` share the same rate.
+
+    The bucket state is guarded by a file lock in the system temporary
+    directory. Requires python >= 3.8 and a POSIX system.
+    """
+
+    def __init__(
+        self, name, rate, capacity=None, clock=time.monotonic, sleep=time.sleep
+    ):
+        from multiprocessing import shared_memory
+
+        super().__init__(rate, capacity=capacity, clock=clock, sleep=sleep)
+        self.name = name
+        self._file_lock = _FileLock(
+            os.path.join(tempfile.gettempdir(), "hyper_ratelimit_%s.lock" % name)
+        )
+        with self._file_lock:
+            try:
+                self._shm = shared_memory.SharedMemory(
+                    name=name, create=True, size=_STATE.size
+                )
+            except FileExistsError:
+                self._shm = shared_memory.SharedMemory(name=name)
+                # only the creating process should unlink the segment
+                from multiprocessing import resource_tracker
+
+                resource_tracker.unregister(self._shm._name, "shared_memory")
+
+    def _locked(self):
+        return self._file_lock
+
+    def _load(self):
+        (tokens, last) = _STATE.unpack_from(self._shm.buf, 0)
+        if last == 0.0:
+            # fresh segment, start with a full bucket
+            return (self.capacity, float("-inf"))
+        return (tokens, last)
+
+    def _store(self, tokens, last):
+        _STATE.pack_into(self._shm.buf, 0, tokens, last)
+
+    def close(self):
+        self._shm.close()
+
+    def unlink(self):
+        self._shm.unlink()
+
+
+class RateLimiter(object):
+    """
+    Token buckets per site and per API key.
+
+    Every (site id, API key) pair gets a bucket refilled at `rate` (or at
+    `site_rates[site_id]` if set), and API keys listed in `key_rates` get an
+    additional bucket shared by all the sites using them. With
+    `unit="messages"` tokens are counted per published message instead of per
+    request.
+
+    With `shared=True` buckets are `SharedTokenBucket`s, shared with the
+    other processes of the host that use the same `namespace`.
+    """
+
+    def __init__(
+        self,
+        rate=None,
+        capacity=None,
+        unit="requests",
+        site_rates=None,
+        key_rates=None,
+        shared=False,
+        namespace="hyper",
+    ):
+        if unit not in ("requests", "messages"):
+            raise ValueError("the rate limiter unit must be 'requests' or 'messages'")
+        self.rate = rate
+        self.capacity = capacity
+        self.unit = unit
+        self.site_rates = site_rates or {}
+        self.key_rates = key_rates or {}
+        self.shared = shared
+        self.namespace = namespace
+        self._buckets = {}
+        self._lock = threading.Lock()
+
+    def _make_bucket(self, key, rate):
+        if self.shared:
+            # hash() of str is randomised per process, use a stable name
+            name = "%s_%08x" % (self.namespace, zlib.crc32(repr(key).encode()))
+            return SharedTokenBucket(name, rate, capacity=self.capacity)
+        return TokenBucket(rate, capacity=self.capacity)
+
+    def _bucket(self, key, rate):
+        bucket = self._buckets.get(key)
+        if bucket is None:
+            with self._lock:
+                bucket = self._buckets.get(key)
+                if bucket is None:
+                    bucket = self._buckets[key] = self._make_bucket(key, rate)
+        return bucket
+
+    def buckets(self, site_id, api_key):
+        """
+        Returns the buckets that apply to a site and API key.
+        """
+        buckets = []
+        rate = self.site_rates.get(site_id, self.rate)
+        if rate is not None:
+            buckets.append(self._bucket(("site", str(site_id), api_key), rate))
+        key_rate = self.key_rates.get(api_key)
+        if key_rate is not None:
+            buckets.append(self._bucket(("key", api_key), key_rate))
+        return buckets
+
+    def acquire(self, site_id, api_key, messages=1, timeout=None):
+        """
+        Waits for the tokens of a request publishing `messages` messages.
+        """
+        tokens = messages if self.unit == "messages" else 1
+        for bucket in self.buckets(site_id, api_key):
+            if not bucket.acquire(tokens, timeout=timeout):
+                return False
+        return True
+
+    async def acquire_async(self, site_id, api_key, messages=1):
+        """
+        Waits for the tokens of a request like `acquire`, sleeping with
+        `asyncio.sleep` so that the event loop is not blocked.
+        """
+        import asyncio
+
+        tokens = messages if self.unit == "messages" else 1
+        for bucket in self.buckets(site_id, api_key):
+            wait = bucket._take(tokens)
+            while wait != 0.0:
+                await asyncio.sleep(wait)
+                wait = bucket._take(tokens)
+
+    def penalize(self, site_id, api_key, seconds):
+        """
+        Pauses a site and API key for `seconds`, e.g. after a 429 response.
+        """
+        for bucket in self.buckets(site_id, api_key):
+            bucket.penalize(seconds)
@@ -0,0 +1,461 @@
+"""
+transport
+
+Transports sending the requests of a `Client`.
+
+A transport has the `request(url, data, params, headers, method,
+data_as_json)` method of `pysimpleurl.request`, returning a
+`pysimpleurl.Response` and raising network errors as
+`urllib.error.URLError`, and a `close()` method. Asynchronous transports,
+used by `AsyncClient`, have the same methods as coroutines.
+
+- `HTTPTransport`: HTTP(S) over keep-alive connections, a `ConnectionPool`
+  per host.
+- `UnixSocketTransport`: HTTP over a Unix domain socket, e.g. to a local
+  agent.
+- `FileTransport`: appends the published messages to an NDJSON file.
+- `MemoryTransport`: keeps the requests in memory, for tests and to measure
+  the overhead of the SDK.
+
+and `AsyncHTTPTransport`, `AsyncUnixSocketTransport`, `AsyncFileTransport`
+and `AsyncMemoryTransport`.
+"""
+import asyncio
+import email.parser
+import http.client
+import json
+import os
+import socket
+import threading
+import urllib.error
+import urllib.parse
+
+from .pool import ConnectionPool
+from .pysimpleurl import Response
+
+_encode_json = json.JSONEncoder(separators=(",", ":")).encode
+
+
+def encode_body(data, headers, data_as_json=True):
+    """
+    Returns the body of a request and sets its content headers.
+    """
+    body = None
+    if isinstance(data, (bytes, bytearray, memoryview)):
+        body = data
+    elif data:
+        if data_as_json:
+            body = json.dumps(data).encode()
+        else:
+            body = urllib.parse.urlencode(data).encode()
+    if body is not None:
+        headers["Content-Length"] = str(len(body))
+        if data_as_json:
+            headers["Content-Type"] = "application/json; charset=UTF-8"
+    return body
+
+
+def _response(status, body=b"", headers=None):
+    return Response(
+        body=body.decode("utf-8"),
+        headers=headers if headers is not None else http.client.HTTPMessage(),
+        status=status,
+        error_count=0 if status < 400 else 1,
+    )
+
+
+class HTTPTransport(object):
+    """
+    Sends requests over keep-alive connections, with a `ConnectionPool` of
+    at most `max_size` connections per host.
+    """
+
+    def __init__(self, max_size=10, timeout=None):
+        self.max_size = max_size
+        self.timeout = timeout
+        self._pools = {}
+        self._lock = threading.Lock()
+
+    def _pool(self, url):
+        parsed = urllib.parse.urlsplit(url)
+        key = (parsed.scheme, parsed.netloc)
+        pool = self._pools.get(key)
+        if pool is None:
+            with self._lock:
+                pool = self._pools.get(key)
+                if pool is None:
+                    pool = self._pools[key] = ConnectionPool(
+                        "%s://%s" % key, self.max_size, self.timeout
+                    )
+        return pool
+
+    def request(
+        self,
+        url,
+        data=None,
+        params=None,
+        headers=None,
+        method="GET",
+        data_as_json=True,
+    ):
+        return self._pool(url).request(url, data, params, headers, method, data_as_json)
+
+    def close(self):
+        with self._lock:
+            (pools, self._pools) = (self._pools, {})
+        for pool in pools.values():
+            pool.close()
+
+
+class _UnixHTTPConnection(http.client.HTTPConnection):
+    def __init__(self, socket_path, timeout=None):
+        super().__init__("localhost", timeout=timeout)
+        self.socket_path = socket_path
+
+    def connect(self):
+        sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        if self.timeout is not None:
+            sock.settimeout(self.timeout)
+        try:
+            sock.connect(self.socket_path)
+        except OSError:
+            sock.close()
+            raise
+        self.sock = sock
+
+
+class UnixSocketTransport(ConnectionPool):
+    """
+    Sends HTTP requests over keep-alive connections to the Unix domain
+    socket at `socket_path`. Only the path and query of the request urls are
+    used, so the `Client` api url can be e.g. `http://localhost/api`.
+    """
+
+    def __init__(self, socket_path, max_size=10, timeout=None):
+        super().__init__("http://localhost", max_size, timeout)
+        self.socket_path = socket_path
+
+    def _connect(self):
+        return _UnixHTTPConnection(self.socket_path, self.timeout)
+
+    def _path(self, url, params):
+        parsed = urllib.parse.urlsplit(url)
+        query = parsed.query
+        if params:
+            encoded = urllib.parse.urlencode(params, doseq=True, safe="/")
+            query = query + "&" + encoded if query else encoded
+        path = parsed.path or "/"
+        return path + "?" + query if query else path
+
+
+class FileTransport(object):
+    """
+    Appends the messages of the published lists to the file at `path`, one
+    JSON message per line (NDJSON), and answers with a 200 status. With
+    `fsync` every request is synced to disk before it is acknowledged.
+    """
+
+    def __init__(self, path, fsync=False):
+        self.path = path
+        self.fsync = fsync
+        self.messages = 0
+        self._file = None
+        self._lock = threading.Lock()
+
+    def request(
+        self,
+        url,
+        data=None,
+        params=None,
+        headers=None,
+        method="GET",
+        data_as_json=True,
+    ):
+        if isinstance(data, (bytes, bytearray, memoryview)):
+            data = json.loads(bytes(data))
+        if data is None:
+            return _response(200)
+        messages = data if isinstance(data, list) else [data]
+        lines = b"".join(_encode_json(m).encode() + b"\n" for m in messages)
+        with self._lock:
+            if self._file is None:
+                self._file = open(self.path, "ab")
+            self._file.write(lines)
+            self._file.flush()
+            if self.fsync:
+                os.fsync(self._file.fileno())
+            self.messages += len(messages)
+        return _response(200)
+
+    def close(self):
+        with self._lock:
+            if self._file is not None:
+                self._file.close()
+                self._file = None
+
+
+class MemoryTransport(object):
+    """
+    Keeps the (method, url, headers, body) of the requests in `requests` and
+    answers with the queued `statuses`, 200 once the queue is empty.
+    """
+
+    def __init__(self, statuses=None):
+        self.requests = []
+        self.statuses = list(statuses or [])
+        self._lock = threading.Lock()
+
+    def request(
+        self,
+        url,
+        data=None,
+        params=None,
+        headers=None,
+        method="GET",
+        data_as_json=True,
+    ):
+        headers = dict(headers or {})
+        body = encode_body(data, headers, data_as_json)
+        with self._lock:
+            status = self.statuses.pop(0) if self.statuses else 200
+            if status == 200:
+                self.requests.append((method.upper(), url, headers, body))
+        return _response(status)
+
+    @property
+    def messages(self):
+        """
+        The device messages of the accepted requests.
+        """
+        return [
+            m
+            for (_method, _url, _headers, body) in self.requests
+            if body is not None
+            for m in json.loads(bytes(body))
+        ]
+
+    def close(self):
+        pass
+
+
+class AsyncTransportAdapter(object):
+    """
+    Makes a synchronous transport asynchronous, running its requests in the
+    `executor` of the event loop, or directly with `inline` for transports
+    that do not block.
+    """
+
+    def __init__(self, transport, executor=None, inline=False):
+        self.transport = transport
+        self.executor = executor
+        self.inline = inline
+
+    async def request(
+        self,
+        url,
+        data=None,
+        params=None,
+        headers=None,
+        method="GET",
+        data_as_json=True,
+    ):
+        args = (url, data, params, headers, method, data_as_json)
+        if self.inline:
+            return self.transport.request(*args)
+        return await asyncio.get_running_loop().run_in_executor(
+            self.executor, lambda: self.transport.request(*args)
+        )
+
+    async def close(self):
+        self.transport.close()
+
+
+class AsyncFileTransport(AsyncTransportAdapter):
+    """
+    `FileTransport` writing in the executor of the event loop.
+    """
+
+    def __init__(self, path, fsync=False, executor=None):
+        super().__init__(FileTransport(path, fsync), executor)
+
+
+class AsyncMemoryTransport(AsyncTransportAdapter):
+    """
+    `MemoryTransport` for `AsyncClient`, its `requests` and `messages` are
+    those of `transport`.
+    """
+
+    def __init__(self, statuses=None):
+        super().__init__(MemoryTransport(statuses), inline=True)
+
+    @property
+    def requests(self):
+        return self.transport.requests
+
+    @property
+    def messages(self):
+        return self.transport.messages
+
+
+class AsyncHTTPTransport(object):
+    """
+    Sends HTTP/1.1 requests with asyncio streams, over keep-alive
+    connections: at most `max_size` per host, reused between requests.
+    Every request times out after `timeout` seconds.
+    """
+
+    def __init__(self, max_size=10, timeout=None):
+        self.max_size = max_size
+        self.timeout = timeout
+        self._idle = {}
+        self._slots = {}
+
+    async def _open(self, scheme, host, port):
+        if scheme == "https":
+            return await asyncio.open_connection(host, port or 443, ssl=True)
+        return await asyncio.open_connection(host, port or 80)
+
+    def _close(self, connection):
+        connection[1].close()
+
+    async def request(
+        self,
+        url,
+        data=None,
+        params=None,
+        headers=None,
+        method="GET",
+        data_as_json=True,
+    ):
+        parsed = urllib.parse.urlsplit(url)
+        if parsed.scheme not in ("http", "https"):
+            raise urllib.error.URLError("unsupported url scheme: %s" % url)
+        path = parsed.path or "/"
+        query = parsed.query
+        if params:
+            encoded = urllib.parse.urlencode(params, doseq=True, safe="/")
+            query = query + "&" + encoded if query else encoded
+        if query:
+            path += "?" + query
+        headers = {
+            "Host": parsed.netloc,
+            "Accept": "application/json",
+            **(headers or {}),
+        }
+        body = encode_body(data, headers, data_as_json)
+        if body is None and method.upper() in ("POST", "PUT", "PATCH"):
+            headers["Content-Length"] = "0"
+        head = "".join(
+            ["%s %s HTTP/1.1\r\n" % (method.upper(), path)]
+            + ["%s: %s\r\n" % item for item in headers.items()]
+            + ["\r\n"]
+        ).encode("latin-1")
+
+        key = (parsed.scheme, parsed.netloc)
+        slots = self._slots.get(key)
+        if slots is None:
+            slots = self._slots[key] = asyncio.Semaphore(self.max_size)
+        idle = self._idle.setdefault(key, [])
+        async with slots:
+            while True:
+                reused = bool(idle)
+                try:
+                    if reused:
+                        connection = idle.pop()
+                    else:
+                        connection = await self._open(
+                            parsed.scheme, parsed.hostname, parsed.port
+                        )
+                except OSError as e:
+                    raise urllib.error.URLError(e)
+                try:
+                    (status, message, content, keep_alive) = await asyncio.wait_for(
+                        self._exchange(connection, head, body, method.upper()),
+                        self.timeout,
+                    )
+                except asyncio.TimeoutError as e:
+                    self._close(connection)
+                    raise urllib.error.URLError(e)
+                except (OSError, asyncio.IncompleteReadError, ValueError) as e:
+                    self._close(connection)
+                    if reused:
+                        # the server closed an idle connection, retry on a new one
+                        continue
+                    raise urllib.error.URLError(e)
+                break
+            if keep_alive:
+                idle.append(connection)
+            else:
+                self._close(connection)
+
+        charset = message.get_content_charset("utf-8")
+        return Response(
+            body=content.decode(charset),
+            headers=message,
+            status=status,
+            error_count=0 if status < 400 else 1,
+        )
+
+    async def _exchange(self, connection, head, body, method):
+        (reader, writer) = connection
+        writer.write(head + bytes(body) if body is not None else head)
+        await writer.drain()
+        line = await reader.readline()
+        if not line:
+            raise ConnectionResetError("the server closed the connection")
+        parts = line.decode("latin-1").rstrip("\r\n").split(" ", 2)
+        (version, status) = (parts[0], int(parts[1]))
+        lines = []
+        while True:
+            line = await reader.readline()
+            if line in (b"\r\n", b"\n", b""):
+                break
+            lines.append(line)
+        message = email.parser.Parser(_class=http.client.HTTPMessage).parsestr(
+            b"".join(lines).decode("iso-8859-1")
+        )
+        keep_alive = (
+            version == "HTTP/1.1"
+            and (message.get("Connection") or "").lower() != "close"
+        )
+        length = message.get("Content-Length")
+        if method == "HEAD" or status in (204, 304) or 100 <= status < 200:
+            content = b""
+        elif (message.get("Transfer-Encoding") or "").lower() == "chunked":
+            chunks = []
+            while True:
+                size = int((await reader.readline()).split(b";")[0], 16)
+                if size == 0:
+                    # trailers
+                    while (await reader.readline()) not in (b"\r\n", b"\n", b""):
+                        pass
+                    break
+                chunks.append(await reader.readexactly(size))
+                await reader.readline()
+            content = b"".join(chunks)
+        elif length is not None:
+            content = await reader.readexactly(int(length))
+        else:
+            content = await reader.read()
+            keep_alive = False
+        return (status, message, content, keep_alive)
+
+    async def close(self):
+        (idle, self._idle) = (self._idle, {})
+        for connections in idle.values():
+            for connection in connections:
+                self._close(connection)
+
+
+class AsyncUnixSocketTransport(AsyncHTTPTransport):
+    """
+    `AsyncHTTPTransport` connecting to the Unix domain socket at
+    `socket_path`, whatever the host of the request urls.
+    """
+
+    def __init__(self, socket_path, max_size=10, timeout=None):
+        super().__init__(max_size, timeout)
+        self.socket_path = socket_path
+
+    async def _open(self, scheme, host, port):
+        return await asyncio.open_unix_connection(self.socket_path)
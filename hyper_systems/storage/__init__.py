@@ -0,0 +1,11 @@
+from .._lazy import lazy_exports
+
+_exports = {
+    "MessageIndex": ".index",
+    "MessageLog": ".log",
+    "MessageView": ".log",
+}
+
+__all__ = ["MessageIndex", "MessageLog", "MessageView"]
+
+(__getattr__, __dir__) = lazy_exports(globals(), _exports)
@@ -0,0 +1,229 @@
+"""
+index
+
+Time and device index over a `MessageLog`.
+
+For every vendor device id the index keeps two parallel arrays sorted by
+created time: the created epochs and the sequence numbers of the matching
+records in the log. Optionally the same pair of arrays is kept for every
+(vendor device id, slot) pair. Range queries are two binary searches.
+"""
+import os
+import struct
+from array import array
+from bisect import bisect_left, bisect_right
+
+INDEX_MAGIC = b"HYPDIX1\n"
+
+_HEADER = struct.Struct("<QB")
+_KEY_HEADER = struct.Struct("<HHQ")
+
+
+class _Series(object):
+    """
+    Parallel (created epoch, sequence number) arrays sorted by created epoch.
+    """
+
+    __slots__ = ("times", "seqs")
+
+    def __init__(self):
+        self.times = array("d")
+        self.seqs = array("Q")
+
+    def add(self, created, seq):
+        times = self.times
+        if not times or created >= times[-1]:
+            times.append(created)
+            self.seqs.append(seq)
+        else:
+            i = bisect_right(times, created)
+            times.insert(i, created)
+            self.seqs.insert(i, seq)
+
+    def range(self, start, end):
+        lo = 0 if start is None else bisect_left(self.times, start)
+        hi = len(self.times) if end is None else bisect_left(self.times, end)
+        return self.seqs[lo:hi]
+
+
+class MessageIndex(object):
+    """
+    A per-device (and optionally per-slot) time index over a message log.
+
+    The index is updated incrementally: messages appended to the log since
+    the last update are indexed on the next `update` or `query` call.
+    """
+
+    def __init__(self, log, slots=False):
+        self.log = log
+        self.slots = slots
+        self._devices = {}
+        self._device_slots = {}
+        self._indexed = 0
+
+    @classmethod
+    def build(cls, log, slots=False):
+        """
+        Rebuilds the index from the raw log.
+        """
+        index = cls(log, slots=slots)
+        index.update()
+        return index
+
+    def __len__(self):
+        return self._indexed
+
+    @property
+    def devices(self):
+        return list(self._devices)
+
+    def add(self, view):
+        """
+        Adds a single message view to the index.
+        """
+        created = view.created_epoch
+        vendor_device_id = view.vendor_device_id
+        series = self._devices.get(vendor_device_id)
+        if series is None:
+            series = self._devices[vendor_device_id] = _Series()
+        series.add(created, view.seq)
+        if self.slots:
+            for slot in view.slots:
+                key = (vendor_device_id, slot)
+                series = self._device_slots.get(key)
+                if series is None:
+                    series = self._device_slots[key] = _Series()
+                series.add(created, view.seq)
+
+    def update(self):
+        """
+        Indexes the messages appended to the log since the last update.
+        """
+        count = len(self.log)
+        for view in self.log.iter(self._indexed, count):
+            self.add(view)
+        self._indexed = count
+
+    def seqs(self, device_id, start=None, end=None, slots=None):
+        """
+        Returns the sequence numbers of the messages of a device created in the
+        [start, end) epoch range, ordered by created time.
+        """
+        if self._indexed < len(self.log):
+            self.update()
+        series = self._devices.get(device_id)
+        if series is None:
+            return []
+        if slots is None:
+            return list(series.range(start, end))
+        if not self.slots:
+            slots = [str(slot) for slot in slots]
+            return [
+                seq
+                for seq in series.range(start, end)
+                if any(slot in self.log[seq] for slot in slots)
+            ]
+        found = set()
+        for slot in slots:
+            slot_series = self._device_slots.get((device_id, str(slot)))
+            if slot_series is not None:
+                found.update(slot_series.range(start, end))
+        return sorted(found, key=lambda seq: (self.log.created_epoch(seq), seq))
+
+    def query(self, device_id, start=None, end=None, slots=None):
+        """
+        Returns the views of the messages of a device created in the
+        [start, end) epoch range, optionally restricted to messages with a value
+        for any of the given slots.
+        """
+        log = self.log
+        return [log[seq] for seq in self.seqs(device_id, start, end, slots)]
+
+    def save(self, path=None):
+        """
+        Writes the index next to the log (or to `path`).
+        """
+        path = path or self.log.path + ".didx"
+        tmp_path = path + ".tmp"
+        with open(tmp_path, "wb") as f:
+            f.write(INDEX_MAGIC)
+            f.write(_HEADER.pack(self._indexed, 1 if self.slots else 0))
+            entries = [(k, "", s) for (k, s) in self._devices.items()] + [
+                (k, slot, s) for ((k, slot), s) in self._device_slots.items()
+            ]
+            for (device_id, slot, series) in entries:
+                device_id = device_id.encode()
+                slot = slot.encode()
+                f.write(_KEY_HEADER.pack(len(device_id), len(slot), len(series.times)))
+                f.write(device_id)
+                f.write(slot)
+                f.write(series.times.tobytes())
+                f.write(series.seqs.tobytes())
+        os.replace(tmp_path, path)
+
+    @classmethod
+    def load(cls, log, path=None, slots=None):
+        """
+        Loads an index saved with `save` and catches up with the log.
+
+        Falls back to rebuilding the index if the saved file is missing,
+        invalid or does not match the log, or was saved with another `slots`
+        setting than the requested one. With `slots=None` the saved setting
+        is kept, and a rebuilt index has no per-slot series.
+        """
+        path = path or log.path + ".didx"
+        rebuild_slots = bool(slots)
+        if not os.path.exists(path):
+            return cls.build(log, slots=rebuild_slots)
+        with open(path, "rb") as f:
+            data = f.read()
+        try:
+            index = cls._decode(log, data, slots)
+        except (ValueError, struct.error):
+            index = None
+        if index is None:
+            return cls.build(log, slots=rebuild_slots)
+        index.update()
+        return index
+
+    @classmethod
+    def _decode(cls, log, data, slots):
+        """
+        Decodes a saved index, or returns None if it cannot be used for the
+        log.
+        """
+        if not data.startswith(INDEX_MAGIC):
+            return None
+        pos = len(INDEX_MAGIC)
+        (indexed, saved_slots) = _HEADER.unpack_from(data, pos)
+        pos += _HEADER.size
+        if saved_slots > 1:
+            return None
+        if indexed > len(log):
+            # the log was truncated after the index was saved
+            return None
+        if slots is not None and bool(slots) != bool(saved_slots):
+            return None
+        index = cls(log, slots=bool(saved_slots))
+        while pos < len(data):
+            (id_len, slot_len, n) = _KEY_HEADER.unpack_from(data, pos)
+            pos += _KEY_HEADER.size
+            device_id = data[pos : pos + id_len].decode()
+            pos += id_len
+            slot = data[pos : pos + slot_len].decode()
+            pos += slot_len
+            if pos + 16 * n > len(data):
+                return None
+            series = _Series()
+            series.times.frombytes(data[pos : pos + 8 * n])
+            pos += 8 * n
+            series.seqs.frombytes(data[pos : pos + 8 * n])
+            pos += 8 * n
+            if any(seq >= indexed for seq in series.seqs):
+                return None
+            if slot:
+                index._device_slots[(device_id, slot)] = series
+            else:
+                index._devices[device_id] = series
+        index._indexed = indexed
+        return index
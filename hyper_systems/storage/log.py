@@ -0,0 +1,497 @@
+"""
+log
+
+Append-only, memory-mapped device message log.
+
+A log is made of two files: the data file (`path`) holding the encoded
+messages back to back and the offset index (`path + ".idx"`) holding one
+fixed-size entry per message. The sequence number of a message is the
+position of its entry in the index, so random access by sequence number is a
+single `struct.unpack_from` on the mapped index.
+
+Each record in the data file is laid out as:
+
+    header        <dIHBBB  created epoch, device class id, value count,
+                           and the lengths of the uuid, created time
+                           and vendor device id strings
+    strings       message_uuid, created_time, vendor_device_id (utf-8)
+    value table   value count * <HI  slot, encoded value length
+    values        JSON-encoded values, in value table order
+
+Slot values are only decoded when accessed through a `MessageView`.
+"""
+import bisect
+import calendar
+import json
+import mmap
+import os
+import struct
+from datetime import datetime
+
+LOG_MAGIC = b"HYPLOG1\n"
+INDEX_MAGIC = b"HYPIDX1\n"
+
+_RECORD_HEADER = struct.Struct("<dIHBBB")
+_VALUE_ENTRY = struct.Struct("<HI")
+# offset in the data file, record length, created epoch
+_INDEX_ENTRY = struct.Struct("<QQd")
+
+_encode_value = json.JSONEncoder(separators=(",", ":")).encode
+
+
+def parse_time(created_time):
+    """
+    Converts a message `created_time` string into a UTC epoch timestamp.
+    """
+    if len(created_time) == 20 and created_time[-1] == "Z":
+        # fast path for the "%Y-%m-%dT%H:%M:%SZ" format produced by devices
+        return float(
+            calendar.timegm(
+                (
+                    int(created_time[0:4]),
+                    int(created_time[5:7]),
+                    int(created_time[8:10]),
+                    int(created_time[11:13]),
+                    int(created_time[14:16]),
+                    int(created_time[17:19]),
+                )
+            )
+        )
+    return datetime.fromisoformat(created_time.replace("Z", "+00:00")).timestamp()
+
+
+def encode_message(message):
+    """
+    Encodes a device message dict into a log record.
+    """
+    if hasattr(message, "to_json"):
+        message = message.to_json()
+    message_uuid = message["message_uuid"].encode()
+    created_time = message["created_time"]
+    vendor_device_id = message["vendor_device_id"].encode()
+    values = message["values"]
+    device_class_id = message["device_class_id"]
+    if type(device_class_id) is not int or not 0 <= device_class_id <= 0xFFFFFFFF:
+        raise ValueError(
+            "the device_class_id of a logged message must be an integer from 0 to "
+            "4294967295, got %r" % (device_class_id,)
+        )
+    if not isinstance(values, dict):
+        raise ValueError(
+            "the values of a logged message must be a dict, got %s"
+            % type(values).__name__
+        )
+    for (name, field) in (
+        ("message_uuid", message_uuid),
+        ("vendor_device_id", vendor_device_id),
+    ):
+        if len(field) > 255:
+            raise ValueError(
+                "the %s of a logged message must be at most 255 bytes, got %d"
+                % (name, len(field))
+            )
+
+    table = []
+    encoded_values = []
+    for (slot, value) in values.items():
+        encoded = _encode_value(value).encode()
+        if not 0 <= int(slot) <= 0xFFFF:
+            raise ValueError(
+                "the slots of a logged message must be from 0 to 65535, got %s" % slot
+            )
+        table.append(_VALUE_ENTRY.pack(int(slot), len(encoded)))
+        encoded_values.append(encoded)
+
+    created_epoch = parse_time(created_time)
+    created_time = created_time.encode()
+    if len(created_time) > 255:
+        raise ValueError(
+            "the created_time of a logged message must be at most 255 bytes, got %d"
+            % len(created_time)
+        )
+    header = _RECORD_HEADER.pack(
+        created_epoch,
+        device_class_id,
+        len(values),
+        len(message_uuid),
+        len(created_time),
+        len(vendor_device_id),
+    )
+    record = b"".join(
+        [header, message_uuid, created_time, vendor_device_id] + table + encoded_values
+    )
+    return (record, created_epoch)
+
+
+class MessageView(object):
+    """
+    A read-only view over a single record of a mapped log.
+
+    The envelope fields are decoded on first access, slot values are decoded
+    one by one when requested.
+    """
+
+    __slots__ = ("seq", "_buf", "_offset", "_envelope", "_table")
+
+    def __init__(self, buf, offset, seq):
+        self.seq = seq
+        self._buf = buf
+        self._offset = offset
+        self._envelope = None
+        self._table = None
+
+    def _decode_envelope(self):
+        buf = self._buf
+        (
+            created_epoch,
+            device_class_id,
+            value_count,
+            uuid_len,
+            time_len,
+            vid_len,
+        ) = _RECORD_HEADER.unpack_from(buf, self._offset)
+        pos = self._offset + _RECORD_HEADER.size
+        message_uuid = buf[pos : pos + uuid_len].decode()
+        pos += uuid_len
+        created_time = buf[pos : pos + time_len].decode()
+        pos += time_len
+        vendor_device_id = buf[pos : pos + vid_len].decode()
+        pos += vid_len
+        self._envelope = (
+            created_epoch,
+            device_class_id,
+            value_count,
+            message_uuid,
+            created_time,
+            vendor_device_id,
+            pos,
+        )
+        return self._envelope
+
+    def _decode_table(self):
+        envelope = self._envelope or self._decode_envelope()
+        value_count = envelope[2]
+        pos = envelope[6]
+        values_pos = pos + value_count * _VALUE_ENTRY.size
+        table = {}
+        for _ in range(value_count):
+            (slot, length) = _VALUE_ENTRY.unpack_from(self._buf, pos)
+            table[str(slot)] = (values_pos, length)
+            pos += _VALUE_ENTRY.size
+            values_pos += length
+        self._table = table
+        return table
+
+    @property
+    def created_epoch(self):
+        return _RECORD_HEADER.unpack_from(self._buf, self._offset)[0]
+
+    @property
+    def device_class_id(self):
+        return (self._envelope or self._decode_envelope())[1]
+
+    @property
+    def message_uuid(self):
+        return (self._envelope or self._decode_envelope())[3]
+
+    @property
+    def created_time(self):
+        return (self._envelope or self._decode_envelope())[4]
+
+    @property
+    def vendor_device_id(self):
+        return (self._envelope or self._decode_envelope())[5]
+
+    @property
+    def slots(self):
+        """
+        The list of slots that have a value in this message.
+        """
+        return list(self._table or self._decode_table())
+
+    def __contains__(self, slot):
+        return str(slot) in (self._table or self._decode_table())
+
+    def __getitem__(self, slot):
+        (pos, length) = (self._table or self._decode_table())[str(slot)]
+        return json.loads(self._buf[pos : pos + length])
+
+    def raw(self, slot):
+        """
+        Returns the encoded JSON bytes of a slot value without decoding them.
+        """
+        (pos, length) = (self._table or self._decode_table())[str(slot)]
+        return self._buf[pos : pos + length]
+
+    @property
+    def values(self):
+        buf = self._buf
+        return {
+            slot: json.loads(buf[pos : pos + length])
+            for (slot, (pos, length)) in (self._table or self._decode_table()).items()
+        }
+
+    def to_message(self):
+        """
+        Materialises the record as a device message dict.
+        """
+        return {
+            "message_uuid": self.message_uuid,
+            "created_time": self.created_time,
+            "vendor_device_id": self.vendor_device_id,
+            "device_class_id": self.device_class_id,
+            "values": self.values,
+        }
+
+    def __repr__(self):
+        return "<MessageView %d: %s>" % (self.seq, self.vendor_device_id)
+
+
+def _open_file(path, magic):
+    if not os.path.exists(path) or os.path.getsize(path) == 0:
+        with open(path, "wb") as f:
+            f.write(magic)
+    f = open(path, "r+b")
+    if f.read(len(magic)) != magic:
+        f.close()
+        raise ValueError("invalid message log file: %s" % path)
+    return f
+
+
+class _CreatedEpochs(object):
+    """
+    The created times of the first `count` messages of a log, as a sequence
+    for `bisect`.
+    """
+
+    def __init__(self, log, count):
+        self._log = log
+        self._count = count
+
+    def __len__(self):
+        return self._count
+
+    def __getitem__(self, seq):
+        return self._log.created_epoch(seq)
+
+
+class MessageLog(object):
+    """
+    An append-only message log with an offset index, read through `mmap`.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self.index_path = path + ".idx"
+        self._data = _open_file(self.path, LOG_MAGIC)
+        self._index = _open_file(self.index_path, INDEX_MAGIC)
+        self._data_map = None
+        self._index_map = None
+        self._mapped_count = 0
+        # whether created times never decrease, None until first needed
+        self._ordered = None
+        self._last_created = None
+        self._recover()
+
+    def _recover(self):
+        """
+        Drops any partially written trailing record or index entry.
+        """
+        index_size = os.fstat(self._index.fileno()).st_size
+        count = (index_size - len(INDEX_MAGIC)) // _INDEX_ENTRY.size
+        data_size = os.fstat(self._data.fileno()).st_size
+        data_end = len(LOG_MAGIC)
+        while count > 0:
+            self._index.seek(len(INDEX_MAGIC) + (count - 1) * _INDEX_ENTRY.size)
+            (offset, length, _created) = _INDEX_ENTRY.unpack(
+                self._index.read(_INDEX_ENTRY.size)
+            )
+            if offset + length <= data_size:
+                data_end = offset + length
+                break
+            count -= 1
+        self._index.truncate(len(INDEX_MAGIC) + count * _INDEX_ENTRY.size)
+        self._data.truncate(data_end)
+        self._count = count
+        self._data.seek(0, os.SEEK_END)
+        self._index.seek(0, os.SEEK_END)
+
+    def __len__(self):
+        return self._count
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+    def append(self, message):
+        """
+        Appends a device message and returns its sequence number.
+        """
+        return self._write(*encode_message(message))
+
+    def _write(self, record, created_epoch):
+        offset = self._data.tell()
+        self._data.write(record)
+        self._index.write(_INDEX_ENTRY.pack(offset, len(record), created_epoch))
+        if self._ordered is not None:
+            self._ordered = self._ordered and created_epoch >= self._last_created
+            self._last_created = created_epoch
+        seq = self._count
+        self._count += 1
+        return seq
+
+    def extend(self, messages):
+        """
+        Appends a list of device messages and returns the first sequence number.
+        Nothing is appended when a message cannot be encoded.
+        """
+        records = [encode_message(message) for message in messages]
+        first = self._count
+        for (record, created_epoch) in records:
+            self._write(record, created_epoch)
+        return first
+
+    def flush(self):
+        self._data.flush()
+        self._index.flush()
+
+    def sync(self):
+        """
+        Flushes and fsyncs both the data and the index files.
+        """
+        self.flush()
+        os.fsync(self._data.fileno())
+        os.fsync(self._index.fileno())
+
+    def _remap(self):
+        self.flush()
+        self._data_map = mmap.mmap(self._data.fileno(), 0, access=mmap.ACCESS_READ)
+        self._index_map = mmap.mmap(self._index.fileno(), 0, access=mmap.ACCESS_READ)
+        self._mapped_count = self._count
+
+    def _entry(self, seq):
+        if seq >= self._mapped_count:
+            self._remap()
+        return _INDEX_ENTRY.unpack_from(
+            self._index_map, len(INDEX_MAGIC) + seq * _INDEX_ENTRY.size
+        )
+
+    def __getitem__(self, seq):
+        if seq < 0:
+            seq += self._count
+        if not 0 <= seq < self._count:
+            raise IndexError("message log sequence number out of range")
+        (offset, _length, _created) = self._entry(seq)
+        return MessageView(self._data_map, offset, seq)
+
+    def created_epoch(self, seq):
+        """
+        Returns the created time of a message without touching the data file.
+        """
+        return self._entry(seq)[2]
+
+    def offset(self, seq):
+        """
+        Returns the (offset, length) of a record in the data file.
+        """
+        (offset, length, _created) = self._entry(seq)
+        return (offset, length)
+
+    def view_at(self, offset, seq=None):
+        """
+        Returns a view for the record at a given data file offset.
+        """
+        if self._data_map is None or offset >= len(self._data_map):
+            self._remap()
+        return MessageView(self._data_map, offset, seq)
+
+    def iter(self, start=0, end=None):
+        """
+        Iterates over the views of the messages in the [start, end) range.
+        """
+        end = self._count if end is None else min(end, self._count)
+        if end > self._mapped_count:
+            self._remap()
+        index_map = self._index_map
+        data_map = self._data_map
+        pos = len(INDEX_MAGIC) + start * _INDEX_ENTRY.size
+        for seq in range(start, end):
+            offset = _INDEX_ENTRY.unpack_from(index_map, pos)[0]
+            pos += _INDEX_ENTRY.size
+            yield MessageView(data_map, offset, seq)
+
+    def __iter__(self):
+        return self.iter()
+
+    def between(self, start, end):
+        """
+        Iterates over the views of messages created in the [start, end) epoch
+        time range.
+
+        Only the index is read; records outside of the range are never read.
+        While messages were appended in created time order the range is
+        found by bisecting the index, otherwise the whole index is scanned.
+        """
+        if self._count > self._mapped_count:
+            self._remap()
+        index_map = self._index_map
+        data_map = self._data_map
+        count = self._count
+        if self._ordered is None:
+            self._ordered = True
+            self._last_created = float("-inf")
+            for seq in range(count):
+                created = self.created_epoch(seq)
+                if created < self._last_created:
+                    self._ordered = False
+                self._last_created = created
+        if self._ordered:
+            epochs = _CreatedEpochs(self, count)
+            first = bisect.bisect_left(epochs, start)
+            last = bisect.bisect_left(epochs, end, first)
+            pos = len(INDEX_MAGIC) + first * _INDEX_ENTRY.size
+            for seq in range(first, last):
+                offset = _INDEX_ENTRY.unpack_from(index_map, pos)[0]
+                pos += _INDEX_ENTRY.size
+                yield MessageView(data_map, offset, seq)
+            return
+        pos = len(INDEX_MAGIC)
+        for seq in range(count):
+            (offset, _length, created) = _INDEX_ENTRY.unpack_from(index_map, pos)
+            pos += _INDEX_ENTRY.size
+            if start <= created < end:
+                yield MessageView(data_map, offset, seq)
+
+    def replay(self, client, batch_size=500, start=0, end=None):
+        """
+        Publishes the messages in the [start, end) range with `client` in
+        batches of `batch_size` messages.
+
+        Only one batch is materialised at a time. Returns the number of
+        published messages.
+        """
+        count = 0
+        batch = []
+        for view in self.iter(start, end):
+            batch.append(view.to_message())
+            if len(batch) >= batch_size:
+                client.publish_device_message_list(batch)
+                count += len(batch)
+                batch = []
+        if batch:
+            client.publish_device_message_list(batch)
+            count += len(batch)
+        return count
+
+    def close(self):
+        self.flush()
+        for m in (self._data_map, self._index_map):
+            if m is not None:
+                m.close()
+        self._data_map = None
+        self._index_map = None
+        self._mapped_count = 0
+        self._data.close()
+        self._index.close()
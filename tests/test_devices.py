@@ -1,11 +1,23 @@
 #!/usr/bin/env python3
-import os, sys
+import asyncio, json, os, sys, tempfile, time
 
 PROJECT_ROOT = os.path.dirname(os.path.dirname(os.path.realpath(__file__)))
 sys.path.append(PROJECT_ROOT)
-from hyper_systems.devices import Schema, Device
+# compiled schemas (here and in subprocesses) are cached in a temporary directory
+codegen_dir = tempfile.TemporaryDirectory()
+os.environ["HYPER_CODEGEN_DIR"] = codegen_dir.name
+from hyper_systems.devices import Schema, Device, Fleet
+from hyper_systems.devices.executor import (
+    AsyncioExecutor,
+    CallbackExecutor,
+    InlineExecutor,
+    ThreadPoolExecutor,
+)
+from hyper_systems.devices.encoding import MessageEncoder, Quantizer, float32_round
+from hyper_systems.devices.keyed import KeyedArray
 
 SCHEMA_FILE = os.path.join(PROJECT_ROOT, "./tests/hyper_device_schema_12.json")
+SCHEMA_FILE_12 = SCHEMA_FILE
 
 schema = Schema.load(SCHEMA_FILE)
 dev1 = Device.from_schema(schema, device_id="DE:AD:BE:EF:FF:00")
@@ -31,6 +43,18 @@ assert dev1.attributes == [
     "sht31_ambient_temperature_0",
 ]
 
+# slot <-> attribute name lookups
+assert dev1.slot_of("sht31_relative_humidity_1") == 1
+assert dev1.slug_of(1) == "sht31_relative_humidity_1"
+assert dev1.slug_of("4") == "reboot_1_4"
+try:
+    dev1.slot_of("invalid_attribute")
+    assert False
+except AttributeError as err:
+    assert (
+        err.args[0] == "no attribute 'invalid_attribute' found in device with schema 12"
+    )
+
 # set valid attribute value
 assert dev1.sht31_ambient_temperature_0 is None
 dev1.sht31_ambient_temperature_0 = 2.2
@@ -117,6 +141,117 @@ dev1.dispatch(invalid_value_msg)
 assert dev1.publish_interval_s_6 == 42
 assert expected_value_attr_6 == 42
 
+# dispatch many messages at once
+fleet = Fleet(
+    [
+        Device.from_schema(schema, device_id="DE:AD:BE:EF:FF:01"),
+        Device.from_schema(schema, device_id="DE:AD:BE:EF:FF:02"),
+    ]
+)
+updates = []
+fleet["DE:AD:BE:EF:FF:01"].on_publish_interval_s_6_update = updates.append
+applied = fleet.dispatch_many(
+    [
+        {"vendor_device_id": "DE:AD:BE:EF:FF:01", "values": {"6": 10}},
+        {"vendor_device_id": "DE:AD:BE:EF:FF:02", "values": {"6": 20, "4": True}},
+        {"vendor_device_id": "DE:AD:BE:EF:FF:01", "values": {"6": 30}},
+    ]
+)
+assert applied == {
+    "DE:AD:BE:EF:FF:01": {"6": 30},
+    "DE:AD:BE:EF:FF:02": {"6": 20, "4": True},
+}
+assert updates == [30]
+assert fleet["DE:AD:BE:EF:FF:01"].publish_interval_s_6 == 30
+assert fleet["DE:AD:BE:EF:FF:02"].publish_interval_s_6 == 20
+
+# dispatch many validates the whole batch before applying values
+try:
+    fleet.dispatch_many(
+        [
+            {"vendor_device_id": "DE:AD:BE:EF:FF:01", "values": {"6": 40}},
+            {"vendor_device_id": "DE:AD:BE:EF:FF:02", "values": {"5": 1}},
+        ]
+    )
+    assert False
+except TypeError as err:
+    assert (
+        err.args[0] == "received incoming value 1 for read-only attribute 'uptime_ms_5'"
+    )
+assert fleet["DE:AD:BE:EF:FF:01"].publish_interval_s_6 == 30
+assert updates == [30]
+
+try:
+    fleet.dispatch_many([{"vendor_device_id": "YY:XX:XX:XX:XX:XX", "values": {}}])
+    assert False
+except ValueError as err:
+    assert (
+        err.args[0]
+        == "tried to dispatch a message for an unknown device 'YY:XX:XX:XX:XX:XX'"
+    )
+
+# run write bindings on a thread pool, in order per device
+executor = ThreadPoolExecutor(workers=2, max_pending=4)
+threaded_updates = []
+
+
+def failing_update(x):
+    threaded_updates.append(x)
+    if x == 13:
+        raise RuntimeError("hardware error")
+
+
+dev_threaded = fleet["DE:AD:BE:EF:FF:02"]
+dev_threaded.set_executor(executor)
+dev_threaded.on_publish_interval_s_6_update = failing_update
+for i in range(10, 20):
+    dev_threaded.dispatch({"vendor_device_id": "DE:AD:BE:EF:FF:02", "values": {"6": i}})
+assert executor.join(timeout=5)
+assert threaded_updates == list(range(10, 20))
+errors = executor.pop_errors()
+assert len(errors) == 1 and errors[0].slot == "6" and errors[0].value == 13
+assert executor.errors == []
+executor.shutdown()
+
+# the base executor and the inline one run write bindings inline
+for executor in (CallbackExecutor(), InlineExecutor()):
+    dev_threaded.set_executor(executor)
+    del threaded_updates[:]
+    for i in (12, 13):
+        dev_threaded.dispatch(
+            {"vendor_device_id": "DE:AD:BE:EF:FF:02", "values": {"6": i}}
+        )
+    assert threaded_updates == [12, 13] and executor.pending == 0
+    assert [error.value for error in executor.pop_errors()] == [13]
+
+# await coroutine write bindings on an asyncio loop
+loop = asyncio.new_event_loop()
+async_updates = []
+
+
+async def slow_update(x):
+    await asyncio.sleep(0.5 if x == 1 else 0)
+    async_updates.append(x)
+
+
+async def dispatch_async():
+    executor = AsyncioExecutor(loop, timeout=0.1)
+    dev_threaded.set_executor(executor)
+    dev_threaded.on_publish_interval_s_6_update = slow_update
+    for i in range(3):
+        dev_threaded.dispatch(
+            {"vendor_device_id": "DE:AD:BE:EF:FF:02", "values": {"6": i}}
+        )
+    await executor.drain()
+    return executor
+
+
+executor = loop.run_until_complete(dispatch_async())
+loop.close()
+assert async_updates == [0, 2]
+assert [(e.value, type(e.error)) for e in executor.errors] == [(1, TimeoutError)]
+dev_threaded.set_executor(None)
+
 # clear all values
 dev1.uptime_ms_5 = 100
 dev1.veml7700_ambient_light_2 = 321.60
@@ -124,6 +259,11 @@ assert dev1.uptime_ms_5 == 100 and dev1.veml7700_ambient_light_2 == 321.60
 dev1.clear()
 assert dev1.uptime_ms_5 is None and dev1.veml7700_ambient_light_2 is None
 
+# get the dict of set values
+dev1.uptime_ms_5 = 100
+assert dev1.values == {"uptime_ms_5": 100}
+dev1.clear()
+
 # set value by slot
 dev1[5] = 1000
 assert dev1[5] == 1000
@@ -186,3 +326,554 @@ except TypeError as err:
         err.args[0]
         == "keyed attribute slot `0` (`temperature_by_material_0`) must be a dict[string, float]"
     )
+
+# keyed values are validated against the inner format
+dev_keyed6 = Device.from_schema(schema, device_id="ABC4321")
+try:
+    dev_keyed6.temperature_by_material_0["plastic"] = "hot"
+    assert False
+except TypeError as err:
+    assert (
+        err.args[0]
+        == "value 'hot' for key 'plastic' of keyed attribute slot `0` (`temperature_by_material_0`) has an invalid type: expected float, got str"
+    )
+
+# bulk update is validated before any value is stored
+dev_keyed6.temperature_by_material_0.update({"steel": 20.0, "wood": 21.5})
+try:
+    dev_keyed6.temperature_by_material_0.update({"glass": 1.0, 42: 10.0})
+    assert False
+except TypeError:
+    pass
+assert dev_keyed6.temperature_by_material_0 == {"steel": 20.0, "wood": 21.5}
+
+# assigned dicts are validated too
+try:
+    dev_keyed6.temperature_by_material_0 = {"steel": "cold"}
+    assert False
+except TypeError:
+    pass
+dev_keyed6[0] = {"steel": 25}
+assert dev_keyed6.message["values"] == {"0": {"steel": 25.0}}
+
+# compact array-backed keyed values
+keyed_format = schema.attributes["0"].format.value.value
+materials = KeyedArray(0, "temperature_by_material_0", keyed_format)
+materials.update({"material_%d" % i: float(i) for i in range(1000)})
+materials["material_5"] = 0.5
+del materials["material_0"]
+assert len(materials) == 999
+assert materials["material_5"] == 0.5 and materials["material_999"] == 999.0
+dev_keyed6.temperature_by_material_0 = materials
+assert dev_keyed6.message["values"]["0"] == materials.to_dict()
+assert "material_0" not in dev_keyed6.message["values"]["0"]
+
+# cached messages hold a copy of keyed values, changes make a new message
+for compiled in (False, True):
+    dev_keyed7 = Device.from_schema(schema, "ABC7777", compiled=compiled)
+    held = dev_keyed7[0]
+    held["steel"] = 1.0
+    message = dev_keyed7.message
+    held["steel"] = 2.0
+    assert message["values"] == {"0": {"steel": 1.0}}
+    assert dev_keyed7.message["values"] == {"0": {"steel": 2.0}}
+    assert dev_keyed7.message is not message
+    message = dev_keyed7.message
+    del held["steel"]
+    assert dev_keyed7.message["values"] == {"0": {}}
+
+# out of range values are rejected before the key is added
+from types import SimpleNamespace
+
+counts = KeyedArray(1, "counts_1", SimpleNamespace(kind="Uint8"), {"a": 1})
+for bad in ({"b": 256}, {"b": -1}):
+    try:
+        counts.update(dict(bad, c=2))
+        assert False
+    except TypeError as err:
+        assert "is out of range: expected 0 to 255" in err.args[0]
+    try:
+        counts["b"] = bad["b"]
+        assert False
+    except TypeError:
+        pass
+assert "b" not in counts and "c" not in counts
+assert counts.keys() == ["a"] and counts.items() == [("a", 1)]
+try:
+    materials["hot"] = 1e39
+    assert False
+except TypeError:
+    pass
+materials["inf"] = float("inf")
+assert "hot" not in materials and len(materials) == 1000
+
+# encode messages from cached fragments
+encoder = MessageEncoder()
+dev_encoded = Device.from_schema(Schema.load(SCHEMA_FILE_12), "DE:AD:BE:EF:FF:03")
+dev_encoded.uptime_ms_5 = 1000
+dev_encoded.sht31_ambient_temperature_0 = 21.5
+dev_encoded.firmware_version_data_1_3 = 'v1 "beta"'
+message = dev_encoded.message
+assert json.loads(bytes(encoder.encode_list([message]))) == [message]
+decoded = json.loads(encoder.encode_device(dev_encoded))
+assert decoded["values"] == message["values"]
+assert decoded["vendor_device_id"] == "DE:AD:BE:EF:FF:03"
+decoded = json.loads(bytes(encoder.encode_list([dev_encoded, dev_keyed6])))
+assert [m["device_class_id"] for m in decoded] == [12, 91]
+assert decoded[1]["values"] == {"0": materials.to_dict()}
+
+# quantize float values according to the schema
+assert float32_round(200.112) == 200.112
+assert float32_round(0.1 + 0.2) == 0.3
+assert float32_round(1e39) == 1e39
+quantizer = Quantizer(precision={2: 0})
+dev_encoded.sht31_ambient_temperature_0 = 21.5 + 1e-9
+dev_encoded.sht31_relative_humidity_1 = 55.55555
+dev_encoded.veml7700_ambient_light_2 = 200.112 * 3
+message = quantizer.quantize_message(dev_encoded.schema, dev_encoded.message)
+assert message["values"]["0"] == 21.5
+assert message["values"]["1"] == 55.6
+assert message["values"]["2"] == 600.0
+assert message["values"]["5"] == 1000
+quantized_encoder = MessageEncoder(quantizer=quantizer)
+decoded = json.loads(quantized_encoder.encode_device(dev_encoded))
+assert decoded["values"] == message["values"]
+assert b"21.500000001" not in quantized_encoder.encode_device(dev_encoded)
+assert Fleet([dev_encoded]).messages(quantizer)[0]["values"] == message["values"]
+exported = json.loads(bytes(Fleet([dev_encoded]).encode(quantized_encoder)))
+assert exported[0]["values"] == message["values"]
+
+# compile schemas to generated device classes
+from hyper_systems.devices import codegen
+from hyper_systems.devices.codegen import compile_schema, module_name
+
+cache_dir = codegen_dir.name
+schema_12 = Schema.load(SCHEMA_FILE_12)
+Device12 = compile_schema(schema_12, cache_dir=cache_dir)
+assert os.path.exists(os.path.join(cache_dir, module_name(schema_12) + ".py"))
+assert compile_schema(schema_12, cache_dir=cache_dir) is Device12
+dev_compiled = Device.from_schema(schema_12, "de:ad:be:ef:ff:04", compiled=True)
+dev_generic = Device.from_schema(schema_12, "DE:AD:BE:EF:FF:04")
+assert type(dev_compiled) is Device12 and dev_compiled.__slots__
+assert str(dev_compiled) == "'<Device12: DE:AD:BE:EF:FF:04>'"
+assert dev_compiled.attributes == dev_generic.attributes
+for dev in (dev_compiled, dev_generic):
+    dev.uptime_ms_5 = 1000
+    dev[0] = 21.5
+    assert dev.sht31_ambient_temperature_0 == 21.5 and dev[5] == 1000
+message = dev_compiled.message
+assert dev_compiled.to_message() is message
+assert message["values"] == dev_generic.message["values"] == {"5": 1000, "0": 21.5}
+assert dev_compiled.values == dev_generic.values
+del dev_compiled.sht31_ambient_temperature_0
+assert dev_compiled.message["values"] == {"5": 1000}
+for dev in (dev_compiled, dev_generic):
+    try:
+        dev.uptime_ms_5 = "1000"
+        assert False
+    except TypeError as err:
+        assert (
+            err.args[0]
+            == "value '1000' for attribute 'uptime_ms_5' has an invalid type: expected int, got str"
+        )
+    try:
+        dev[4] = True
+        assert False
+    except TypeError as err:
+        assert err.args[0].startswith("cannot set value: no read attribute for slot 4")
+
+# compiled devices keep their own values, bindings and executor
+other_compiled = Device12("DE:AD:BE:EF:FF:05")
+assert other_compiled.uptime_ms_5 is None
+updates = []
+dev_compiled.on_publish_interval_s_6_update = updates.append
+dev_compiled.dispatch({"vendor_device_id": "DE:AD:BE:EF:FF:04", "values": {"6": 30}})
+assert updates == [30] and dev_compiled.publish_interval_s_6 == 30
+assert other_compiled.publish_interval_s_6 is None
+assert other_compiled.on_publish_interval_s_6_update is None
+assert json.loads(encoder.encode_device(dev_compiled))["values"] == {
+    "6": 30,
+    "5": 1000,
+}
+
+# compiled keyed attributes
+Device91 = compile_schema(schema, cache_dir=cache_dir)
+dev_keyed_compiled = Device91("ABC1234")
+dev_keyed_compiled[0]["plastic"] = 1234
+assert dev_keyed_compiled.message["values"] == {"0": {"plastic": 1234.0}}
+dev_keyed_compiled.temperature_by_material_0 = materials
+assert dev_keyed_compiled.message["values"]["0"] == materials.to_dict()
+try:
+    dev_keyed_compiled.temperature_by_material_0 = {"steel": "cold"}
+    assert False
+except TypeError:
+    pass
+
+# incoming keyed values are validated, and stored like local ones
+from hyper_systems.devices.keyed import KeyedValues
+
+writable = Schema.load(SCHEMA_FILE)
+writable.attributes["0"].access.write = True
+for dev in (
+    Device.from_schema(writable, "K1"),
+    Device.from_schema(writable, "K1", compiled=True),
+):
+    dev.dispatch({"vendor_device_id": "K1", "values": {"0": {"steel": 20}}})
+    assert type(dev[0]) is KeyedValues and dev[0] == {"steel": 20.0}
+    dev[0]["iron"] = 1500.0
+    assert dev.message["values"]["0"] == {"steel": 20.0, "iron": 1500.0}
+    try:
+        dev.dispatch({"vendor_device_id": "K1", "values": {"0": {"steel": "hot"}}})
+        assert False
+    except TypeError as err:
+        assert err.args[0].startswith("value 'hot' for key 'steel'")
+    assert dev[0] == {"steel": 20.0, "iron": 1500.0}
+
+# profile slot accesses, validation, message builds and callbacks
+from hyper_systems.devices.profiling import Profiler
+
+profiler = Profiler()
+dev_profiled = Device.from_schema(schema_12, "DE:AD:BE:EF:FF:06")
+fleet = Fleet([dev_profiled, dev_compiled])
+fleet.set_profiler(profiler)
+dev_profiled.uptime_ms_5 = 1
+dev_profiled[5] = 2
+dev_profiled.uptime_ms_5
+dev_profiled.message
+dev_profiled.on_publish_interval_s_6_update = lambda value: None
+fleet.dispatch_many(
+    [
+        {"vendor_device_id": "DE:AD:BE:EF:FF:06", "values": {"6": 10}},
+        {"vendor_device_id": "DE:AD:BE:EF:FF:04", "values": {"6": 20}},
+    ]
+)
+dev_compiled.message
+profile = profiler.to_dict()
+assert profile["slots"]["12"]["5"] == {"gets": 1, "sets": 2, "incoming": 0}
+assert profile["slots"]["12"]["6"]["incoming"] == 2
+assert profile["devices"]["DE:AD:BE:EF:FF:06"]["incoming"] == 1
+assert profile["validation"]["12"]["count"] == 2
+assert profile["message_build"]["12"]["count"] == 2
+assert profile["callbacks"]["12/6"]["count"] == 2
+assert profiler.top_devices(1)[0][1] == 1
+prometheus = profiler.to_prometheus()
+assert 'hyper_devices_slot_sets_total{device_class_id="12",slot="5"} 2' in prometheus
+assert 'hyper_devices_validation_seconds_count{device_class_id="12"} 2' in prometheus
+assert (
+    'hyper_devices_callback_seconds_bucket{device_class_id="12",slot="6",le="+Inf"} 2'
+    in prometheus
+)
+
+# sampling skips the timings but keeps the counters
+profiler = Profiler(sample_rate=0.0)
+dev_profiled.set_profiler(profiler)
+dev_profiled.dispatch({"vendor_device_id": "DE:AD:BE:EF:FF:06", "values": {"6": 5}})
+assert profiler.to_dict()["validation"] == {}
+assert profiler.to_dict()["slots"]["12"]["6"]["incoming"] == 1
+dev_profiled.set_profiler(None)
+
+# publish each device at its own interval, grouping the devices due together
+from hyper_systems.devices.scheduler import PublishScheduler
+
+now = [0.0]
+published = []
+scheduler = PublishScheduler(published.append, clock=lambda: now[0])
+scheduled = [Device.from_schema(schema_12, "DE:AD:BE:EF:10:%02d" % i) for i in range(4)]
+for (i, dev) in enumerate(scheduled):
+    dev.publish_interval_s_6 = 10 if i < 3 else 30
+    dev.uptime_ms_5 = i
+    scheduler.add(dev)
+scheduler.add(Device.from_schema(schema_12, "DE:AD:BE:EF:10:99"))
+assert len(scheduler) == 5 and scheduler.next_due() == 10.0
+assert scheduler.tick() == 0
+now[0] = 10.0
+assert scheduler.tick() == 3 and len(published) == 1
+assert [m["values"]["5"] for m in published[0]] == [0, 1, 2]
+
+# unchanged devices are published again as new messages
+now[0] = 20.0
+scheduler.tick()
+assert published[1][0]["values"] == published[0][0]["values"]
+assert published[1][0]["message_uuid"] != published[0][0]["message_uuid"]
+
+# interval changes received from the cloud are applied immediately
+scheduled[3].dispatch({"vendor_device_id": "DE:AD:BE:EF:10:03", "values": {"6": 5}})
+assert scheduler.next_due() == 20.0
+now[0] = 21.0
+assert scheduler.tick() == 1 and published[-1][0]["vendor_device_id"].endswith("03")
+scheduled[0].dispatch({"vendor_device_id": "DE:AD:BE:EF:10:00", "values": {"6": 0}})
+now[0] = 30.0
+assert scheduler.tick() == 3
+scheduler.remove("DE:AD:BE:EF:10:01")
+now[0] = 40.0
+assert scheduler.tick() == 2
+assert sorted(m["values"]["5"] for m in published[-1]) == [2, 3]
+
+# a background thread publishes the due devices
+scheduler = PublishScheduler(published.append, default_interval=0.05)
+scheduler.add(Device.from_schema(schema_12, "DE:AD:BE:EF:10:50"))
+del published[:]
+scheduler.start()
+time.sleep(0.3)
+scheduler.stop()
+assert 3 <= len(published) <= 7
+
+import random
+from types import SimpleNamespace
+
+from hyper_systems.devices.simulator import LocalSink, Simulator, make_generator
+
+# simulated devices generate valid values for every read attribute
+sink = LocalSink()
+simulator = Simulator(schema_12, sink, count=10, rate=100.0, seed=3)
+(first, second) = (simulator.generate(10, 0.0), simulator.generate(10, 1000.0))
+assert [m["vendor_device_id"] for m in first][:2] == [
+    "02:0C:00:00:00:00",
+    "02:0C:00:00:00:01",
+]
+assert set(first[0]["values"]) == {"0", "1", "2", "3", "5", "6"}
+assert 0.0 <= first[0]["values"]["1"] <= 100.0
+assert len(first[0]["values"]["3"]) == 32 and first[0]["values"]["6"] == 60
+# uptime counts the elapsed milliseconds
+assert second[0]["values"]["5"] - first[0]["values"]["5"] == 1000
+replica = Device.from_schema(schema_12, first[0]["vendor_device_id"])
+for (slot, value) in first[0]["values"].items():
+    replica[int(slot)] = value
+assert Simulator(schema_12, sink, count=10, seed=3).generate(1, 0.0)[0]["values"] == (
+    first[0]["values"]
+)
+keyed = Simulator(
+    Schema.load(os.path.join(PROJECT_ROOT, "./tests/hyper_device_schema_91.json")),
+    sink,
+    count=2,
+    keys=4,
+    seed=3,
+)
+keyed_values = keyed.generate(1)[0]["values"]["0"]
+assert len(keyed_values) == 4 and all(type(v) is float for v in keyed_values.values())
+enum_format = SimpleNamespace(
+    kind="Enum", value=SimpleNamespace(value={"1": "a", "3": "b"})
+)
+enum_values = make_generator(
+    SimpleNamespace(format=enum_format, access=None), random.Random(1)
+)
+assert {enum_values(0) for _ in range(1000)} == {1, 3}
+
+# messages are published at the configured rate, following an absolute
+# schedule, in batches of the messages due
+now = [0.0]
+
+
+def fake_sleep(seconds):
+    # coarse sleeps, as on a busy machine
+    now[0] += max(seconds, 0.005)
+
+
+simulator = Simulator(
+    schema_12,
+    sink,
+    count=10,
+    rate=1000.0,
+    batch_size=20,
+    clock=lambda: now[0],
+    sleep=fake_sleep,
+)
+stats = simulator.run(messages=95)
+assert sink.messages == 95 and stats["sent"] == 95 and stats["errors"] == 0
+assert stats["batches"] == sink.requests == 20
+assert stats["latency"]["count"] == 20 and 0.09 <= stats["elapsed"] <= 0.1
+
+# compiled devices can be simulated too, in a background thread
+sink = LocalSink(encode=False)
+simulator = Simulator(schema_12, sink, count=5, rate=200.0, compiled=True)
+simulator.start()
+time.sleep(0.25)
+simulator.stop()
+assert 30 <= sink.messages <= 70
+
+from hyper_systems.devices.checkpoint import (
+    CheckpointError,
+    Checkpointer,
+    read_checkpoint,
+    restore_checkpoint,
+    write_checkpoint,
+)
+
+# checkpoints restore the values of generic and compiled devices
+schema_91 = Schema.load(
+    os.path.join(PROJECT_ROOT, "./tests/hyper_device_schema_91.json")
+)
+simulator = Simulator(schema_12, LocalSink(), count=20, seed=5)
+simulator.generate(20, 0.0)
+devices = [simulated.device for simulated in simulator.devices]
+devices[3][1] = 200.5  # out of the random walk, still a float
+del devices[4].sht31_relative_humidity_1
+devices[5].clear()
+devices.append(Device.from_schema(schema_12, "DE:AD:BE:EF:FF:10", compiled=True))
+devices[-1][0] = -3.25
+devices[-1][6] = 65535
+keyed_device = Device.from_schema(schema_91, "K1")
+keyed_device[0] = {"steel": 20.5, "wood": 1.0}
+devices.append(keyed_device)
+expected = {device.vendor_device_id: device.values for device in devices}
+with tempfile.TemporaryDirectory() as directory:
+    path = os.path.join(directory, "fleet.ckpt")
+    checkpointer = Checkpointer(Fleet(devices), path)
+    assert checkpointer.restore() == []
+    assert checkpointer.checkpoint() == 22
+    assert os.listdir(directory) == ["fleet.ckpt"]
+    groups = read_checkpoint(path)
+    assert [(group[0], len(group[2])) for group in groups] == [(12, 21), (91, 1)]
+    assert groups[0][3]["1"][4] is None and groups[0][3]["6"][20] == 65535
+
+    fleet = Fleet(
+        [
+            Device.from_schema(schema_12, devices[0].vendor_device_id),
+            Device.from_schema(schema_12, devices[5].vendor_device_id, compiled=True),
+            Device.from_schema(schema_12, "DE:AD:BE:EF:FF:10"),
+        ]
+    )
+    fleet[devices[5].vendor_device_id][0] = 1.0
+    listened = []
+    fleet[devices[0].vendor_device_id].add_listener(lambda *args: listened.append(args))
+    restored = restore_checkpoint(path, fleet)
+    assert len(restored) == 3 and listened == []
+    for device in fleet:
+        assert device.values == expected[device.vendor_device_id]
+        assert (
+            device.message["values"]
+            == devices[
+                [d.vendor_device_id for d in devices].index(device.vendor_device_id)
+            ].message["values"]
+        )
+    # missing devices are created for the given schemas
+    restored = restore_checkpoint(path, fleet, schemas=[schema_91], compiled=True)
+    assert len(restored) == 4 and len(fleet) == 4
+    assert fleet["K1"][0] == {"steel": 20.5, "wood": 1.0}
+    restored = restore_checkpoint(path, {}, schemas=[schema_12, schema_91])
+    assert {device.vendor_device_id: device.values for device in restored} == expected
+
+    # devices of a changed schema are skipped
+    changed = Schema.load(SCHEMA_FILE_12)
+    changed.attributes["0"].unit = "kelvin"
+    stale = Device.from_schema(changed, devices[0].vendor_device_id)
+    assert restore_checkpoint(path, [stale]) == [] and stale.values == {}
+
+    with open(path, "r+b") as f:
+        f.truncate(100)
+    try:
+        read_checkpoint(path)
+        assert False
+    except CheckpointError as err:
+        assert err.path == path
+
+    # checkpoints are written periodically, and when stopping
+    checkpointer = Checkpointer(devices, path, interval=0.05)
+    checkpointer.start()
+    time.sleep(0.18)
+    checkpointer.stop()
+    assert 3 <= checkpointer.checkpoints <= 5 and checkpointer.last_error is None
+    assert len(read_checkpoint(path)[0][2]) == 21
+
+    # keyed values stored by dispatch are checkpointed
+    dispatched = Device.from_schema(schema_91, "K2")
+    dispatched._apply_incoming({"0": {"iron": 7.5}})
+    assert type(dispatched._rvalues["0"]) is KeyedValues
+    assert write_checkpoint(path, [dispatched]) == 1
+    # checkpoints outlive code generator upgrades
+    codegen.CODEGEN_VERSION += 1
+    restored = restore_checkpoint(path, {}, schemas=[schema_91])
+    codegen.CODEGEN_VERSION -= 1
+    assert restored[0][0] == {"iron": 7.5}
+
+# device values shared with other processes through shared memory
+if sys.version_info >= (3, 8):
+    import subprocess
+
+    from hyper_systems.devices.shared import SharedDeviceStore
+
+    name = "hyper_test_devices_%d" % os.getpid()
+    store = SharedDeviceStore(schema_12, name, capacity=4, create=True)
+    for device in devices[3:6]:
+        store.write_device(device)
+    store.write_device(devices[3])
+    assert len(store) == 3 and store.version(devices[3].vendor_device_id) == 4
+    assert store.read(devices[4].vendor_device_id) == devices[4]._rvalues
+    assert store.read("unknown") is None
+    script = (
+        "import json, sys\n"
+        "from hyper_systems.devices import Device, Schema\n"
+        "from hyper_systems.devices.shared import SharedDeviceStore\n"
+        "schema = Schema.load(%r)\n"
+        "store = SharedDeviceStore(schema, %r)\n"
+        "device = Device.from_schema(schema, %r, compiled=True)\n"
+        "assert store.update_device(device)\n"
+        "print(json.dumps([store.read_all(), device.values]))\n"
+        "try:\n"
+        "    SharedDeviceStore(Schema.load(%r), %r)\n"
+        "    sys.exit(1)\n"
+        "except ValueError as err:\n"
+        "    assert 'holds another schema' in str(err)\n"
+        % (SCHEMA_FILE_12, name, devices[4].vendor_device_id, SCHEMA_FILE, name)
+    )
+    (shared_values, updated) = json.loads(
+        subprocess.check_output([sys.executable, "-c", script], cwd=PROJECT_ROOT)
+    )
+    assert shared_values == {
+        device.vendor_device_id: device._rvalues for device in devices[3:6]
+    }
+    assert updated == devices[4].values and "sht31_relative_humidity_1" not in updated
+    try:
+        store.write("DE:AD:BE:EF:FF:20", {"3": "x" * 33})
+        assert False
+    except ValueError as err:
+        assert err.args[0] == "the value of slot 3 does not fit in its 32 bytes"
+    store.write("DE:AD:BE:EF:FF:20", {})
+    try:
+        store.write("DE:AD:BE:EF:FF:21", {})
+        assert False
+    except ValueError as err:
+        assert "is full" in err.args[0]
+
+    # values out of range leave the record readable, readers give up on
+    # records that stay locked
+    version = store.version("DE:AD:BE:EF:FF:20")
+    try:
+        store.write("DE:AD:BE:EF:FF:20", {"6": 70000})
+        assert False
+    except ValueError as err:
+        assert "do not fit in their slots" in err.args[0]
+    assert store.version("DE:AD:BE:EF:FF:20") == version
+    assert store.read("DE:AD:BE:EF:FF:20")["6"] is None
+    offset = store._offset(store.index("DE:AD:BE:EF:FF:20"))
+    store._shm.buf[offset] += 1
+    store.read_timeout = 0.01
+    try:
+        store.read("DE:AD:BE:EF:FF:20")
+        assert False
+    except TimeoutError as err:
+        assert "still being written" in err.args[0]
+    store._shm.buf[offset] -= 1
+    store.read_timeout = 1.0
+
+    # readers never see partly written records
+    writer = (
+        "from hyper_systems.devices import Schema\n"
+        "from hyper_systems.devices.shared import SharedDeviceStore\n"
+        "store = SharedDeviceStore(Schema.load(%r), %r)\n"
+        "for i in range(20000):\n"
+        "    store.write('DE:AD:BE:EF:FF:20', {'0': i / 2, '1': i / 2, '5': i})\n"
+        % (SCHEMA_FILE_12, name)
+    )
+    process = subprocess.Popen([sys.executable, "-c", writer], cwd=PROJECT_ROOT)
+    reads = 0
+    while process.poll() is None or reads == 0:
+        values = store.read("DE:AD:BE:EF:FF:20")
+        if values["5"] is not None:
+            assert values["0"] == values["1"] == values["5"] / 2
+        reads += 1
+    assert process.returncode == 0 and store.read("DE:AD:BE:EF:FF:20")["5"] == 19999
+    store.close()
+    store.unlink()
+
+codegen_dir.cleanup()
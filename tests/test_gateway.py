@@ -0,0 +1,329 @@
+#!/usr/bin/env python3
+import asyncio, json, os, socket, sys, tempfile, threading, time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+PROJECT_ROOT = os.path.dirname(os.path.dirname(os.path.realpath(__file__)))
+sys.path.append(PROJECT_ROOT)
+from hyper_systems.devices import Device, Fleet, Schema
+from hyper_systems.gateway.ingest import (
+    ConnectionStats,
+    IngestServer,
+    ReadingParser,
+    encode_reading,
+)
+from hyper_systems.gateway.relay import RelayQueue, RelayServer
+from hyper_systems.http import Client, PublishError
+from hyper_systems.http.transport import MemoryTransport
+
+SCHEMA_FILE = os.path.join(PROJECT_ROOT, "./tests/hyper_device_schema_12.json")
+
+schema = Schema.load(SCHEMA_FILE)
+
+# readings are parsed from JSON lines or binary records, across chunks
+parser = ReadingParser()
+assert parser.feed(b'{"vendor_device_id": "A", "slot": 5, "value": 1}\n{"vendor') == [
+    ("A", "5", 1)
+]
+assert parser.feed(b'_device_id": "B", "values": {"0": 2.5, "1": 3}}\nnot json\n') == [
+    ("B", "0", 2.5),
+    ("B", "1", 3),
+]
+assert parser.errors == 1 and not parser.binary
+parser = ReadingParser()
+records = (
+    encode_reading("A", 5, 1000)
+    + encode_reading("A", 0, -1.5)
+    + encode_reading("B", 3, "v1")
+    + encode_reading("B", 4, True)
+)
+assert parser.feed(records[:7]) == []
+assert parser.feed(records[7:]) == [
+    ("A", "5", 1000),
+    ("A", "0", -1.5),
+    ("B", "3", "v1"),
+    ("B", "4", True),
+]
+assert parser.binary and parser.errors == 0
+
+
+# readings received over TCP and UDP are validated, applied and published
+async def ingest():
+    fleet = Fleet(
+        Device.from_schema(schema, "DE:AD:BE:EF:20:%02d" % i) for i in range(2)
+    )
+    published = []
+    created = []
+
+    def factory(vendor_device_id):
+        if vendor_device_id.startswith("DE:AD:BE:EF:21"):
+            created.append(vendor_device_id)
+            return Device.from_schema(schema, vendor_device_id)
+
+    server = IngestServer(
+        fleet, publish=published.append, device_factory=factory, flush_interval=0.05
+    )
+    tcp = await server.start_tcp("127.0.0.1", 0)
+    port = tcp.sockets[0].getsockname()[1]
+    (reader, writer) = await asyncio.open_connection("127.0.0.1", port)
+    writer.write(
+        b'{"vendor_device_id": "DE:AD:BE:EF:20:00", "slot": 5, "value": 1}\n'
+        b'{"vendor_device_id": "DE:AD:BE:EF:20:00", "values": {"0": 21, "5": 2}}\n'
+        b'{"vendor_device_id": "DE:AD:BE:EF:20:01", "slot": 5, "value": "x"}\n'
+        b'{"vendor_device_id": "DE:AD:BE:EF:21:00", "slot": 1, "value": 40.5}\n'
+        b'{"vendor_device_id": "unknown", "slot": 1, "value": 40.5}\n'
+    )
+    await writer.drain()
+    (binary_reader, binary_writer) = await asyncio.open_connection("127.0.0.1", port)
+    binary_writer.write(encode_reading("DE:AD:BE:EF:20:01", 2, 100.0))
+    await binary_writer.drain()
+    await asyncio.sleep(0.2)
+
+    assert fleet["DE:AD:BE:EF:20:00"].uptime_ms_5 == 2
+    assert fleet["DE:AD:BE:EF:20:00"].sht31_ambient_temperature_0 == 21.0
+    assert fleet["DE:AD:BE:EF:20:01"].veml7700_ambient_light_2 == 100.0
+    assert created == ["DE:AD:BE:EF:21:00"] and "DE:AD:BE:EF:21:00" in fleet
+    messages = [m for batch in published for m in batch]
+    assert sorted(m["vendor_device_id"] for m in messages) == [
+        "DE:AD:BE:EF:20:00",
+        "DE:AD:BE:EF:20:01",
+        "DE:AD:BE:EF:21:00",
+    ]
+    stats = server.stats
+    assert stats["totals"]["readings"] == 5
+    assert stats["totals"]["errors"] == 1 and stats["totals"]["dropped"] == 1
+    assert sorted(c["readings"] for c in stats["connections"]) == [1, 4]
+
+    udp = await server.start_udp("127.0.0.1", 0)
+    sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+    sock.sendto(
+        b'{"vendor_device_id": "DE:AD:BE:EF:20:01", "slot": 5, "value": 7}',
+        udp.get_extra_info("sockname"),
+    )
+    sock.close()
+    await asyncio.sleep(0.1)
+    await server.drain()
+    assert fleet["DE:AD:BE:EF:20:01"].uptime_ms_5 == 7
+
+    writer.close()
+    binary_writer.close()
+    await server.close()
+    assert server.stats["totals"]["readings"] == 6
+    assert server.published == len([m for batch in published for m in batch])
+
+
+asyncio.run(ingest())
+
+
+# a full queue slows down TCP senders instead of buffering without bounds
+async def back_pressure():
+    fleet = Fleet([Device.from_schema(schema, "DE:AD:BE:EF:22:00")])
+
+    def slow_publish(messages):
+        time.sleep(0.1)
+
+    server = IngestServer(
+        fleet, publish=slow_publish, max_pending=2, batch_size=1, read_size=64
+    )
+    tcp = await server.start_tcp("127.0.0.1", 0)
+    port = tcp.sockets[0].getsockname()[1]
+    (reader, writer) = await asyncio.open_connection("127.0.0.1", port)
+    line = b'{"vendor_device_id": "DE:AD:BE:EF:22:00", "slot": 5, "value": 1}\n'
+    for _ in range(20):
+        writer.write(line)
+    await writer.drain()
+    await asyncio.sleep(0.1)
+    assert server.stats["pending"] <= 2
+    assert server.stats["totals"]["readings"] < 20
+    writer.close()
+    while server.connections:
+        await asyncio.sleep(0.05)
+    await server.drain()
+    assert server.stats["totals"]["readings"] == 20
+    await server.close()
+
+
+asyncio.run(back_pressure())
+
+
+# devices whose message could not be published are published with the next flush
+async def failed_publish():
+    fleet = Fleet(
+        Device.from_schema(schema, "DE:AD:BE:EF:23:%02d" % i) for i in range(3)
+    )
+    transport = MemoryTransport(statuses=[503])
+    client = Client("http://localhost/api", "key", 1, transport=transport)
+    server = IngestServer(fleet, publish=client.publish_device_message_list)
+    server._ensure_started()
+    stats = ConnectionStats("test")
+    server.apply(stats, [("DE:AD:BE:EF:23:00", "5", 1), ("DE:AD:BE:EF:23:01", "5", 1)])
+    assert await server.flush() == 0
+    assert server.last_error.status == 503 and transport.messages == []
+    server.apply(stats, [("DE:AD:BE:EF:23:01", "5", 2), ("DE:AD:BE:EF:23:02", "5", 1)])
+    assert await server.flush() == 3
+    assert sorted(
+        (m["vendor_device_id"], m["values"]["5"]) for m in transport.messages
+    ) == [("DE:AD:BE:EF:23:00", 1), ("DE:AD:BE:EF:23:01", 2), ("DE:AD:BE:EF:23:02", 1)]
+    assert await server.flush() == 0 and server.published == 3
+    await server.close()
+
+
+asyncio.run(failed_publish())
+
+
+class Upstream(ThreadingHTTPServer):
+    """
+    A local stand-in for the Hyper API recording the posted message lists.
+    """
+
+    daemon_threads = True
+
+    def __init__(self):
+        super().__init__(("127.0.0.1", 0), UpstreamHandler)
+        self.requests = []
+        self.statuses = []
+        threading.Thread(target=self.serve_forever, daemon=True).start()
+
+    @property
+    def url(self):
+        return "http://127.0.0.1:%d/api" % self.server_address[1]
+
+
+class UpstreamHandler(BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"
+
+    def do_POST(self):
+        body = self.rfile.read(int(self.headers["Content-Length"]))
+        status = self.server.statuses.pop(0) if self.server.statuses else 200
+        if status == 200:
+            self.server.requests.append(
+                (self.path, self.headers["Authorization"], json.loads(body))
+            )
+        self.send_response(status)
+        self.send_header("Content-Length", "0")
+        self.end_headers()
+
+    def log_message(self, *args):
+        pass
+
+
+def collector_messages(site_id, n):
+    return [
+        Device.from_schema(schema, "DE:AD:BE:EF:%02d:%02d" % (site_id, i)).message
+        for i in range(n)
+    ]
+
+
+# queued messages are kept in per-site logs across restarts
+with tempfile.TemporaryDirectory() as directory:
+    queue = RelayQueue(directory)
+    queue.put(1, collector_messages(1, 3))
+    queue.put("2", collector_messages(2, 1))
+    assert queue.sizes() == {"1": 3, "2": 1}
+    batches = queue.batches(2)
+    assert [m["vendor_device_id"] for m in batches["1"]] == [
+        "DE:AD:BE:EF:01:00",
+        "DE:AD:BE:EF:01:01",
+    ]
+    queue.commit("1", 2)
+    queue.close()
+    queue = RelayQueue(directory)
+    assert queue.sizes() == {"1": 1, "2": 1}
+    assert queue.batches(10)["1"][0]["vendor_device_id"] == "DE:AD:BE:EF:01:02"
+    queue.close()
+
+# lists posted by collectors are acknowledged locally and forwarded in batches
+upstream = Upstream()
+with tempfile.TemporaryDirectory() as directory:
+    relay = RelayServer(
+        upstream.url,
+        api_key="relay-key",
+        api_keys={"2": "site-2-key"},
+        tokens={"1": "collector-1", "2": "collector-2"},
+        directory=directory,
+        flush_interval=60,
+    )
+    relay.start()
+    for site_id in (1, 2):
+        collector = Client(relay.url, "collector-%d" % site_id, site_id)
+        for _ in range(5):
+            collector.publish_device_message_list(collector_messages(site_id, 2))
+    try:
+        Client(relay.url, "collector-1", 1).publish_device_message_list([{}])
+    except PublishError as e:
+        assert e.status == 400
+    else:
+        assert False, "invalid messages are rejected"
+    for (field, value) in (
+        ("created_time", "yesterday"),
+        ("device_class_id", "12"),
+        ("values", [1]),
+        ("values", {"65536": 1}),
+        ("values", {"-1": 1}),
+    ):
+        invalid = collector_messages(1, 2)
+        invalid[1][field] = value
+        try:
+            Client(relay.url, "collector-1", 1).publish_device_message_list(invalid)
+        except PublishError as e:
+            assert e.status == 400
+        else:
+            assert False, "messages that cannot be queued are rejected"
+    # collectors need the token of their site
+    for (token, site_id) in (("collector-2", 1), ("relay-key", 1), ("", 3)):
+        try:
+            Client(relay.url, token, site_id).publish_device_message_list(
+                collector_messages(site_id, 1)
+            )
+        except PublishError as e:
+            assert e.status == 401
+        else:
+            assert False, "unauthorized collectors are rejected"
+    assert relay.received == 20 and relay.queue.pending() == 20
+    assert upstream.requests == []
+
+    upstream.statuses = [500]
+    assert relay.forward() == 10
+    assert relay.queue.sizes() == {"1": 10} or relay.queue.sizes() == {"2": 10}
+    assert relay.last_error is not None
+    assert relay.forward() == 10 and relay.queue.pending() == 0
+    # lists refused for good are dead-lettered instead of retried
+    Client(relay.url, "collector-1", 1).publish_device_message_list(
+        collector_messages(1, 2)
+    )
+    upstream.statuses = [400]
+    assert relay.forward() == 0 and relay.queue.pending() == 0
+    assert relay.rejected == 2 and relay.last_error.status == 400
+    assert [(site_id, len(m)) for (site_id, m, _e) in relay.dead_letters] == [("1", 2)]
+    assert sorted(
+        (path, key, len(body)) for (path, key, body) in upstream.requests
+    ) == [
+        ("/api/sites/1/device_messages/v3/incoming", "Bearer relay-key", 10),
+        ("/api/sites/2/device_messages/v3/incoming", "Bearer site-2-key", 10),
+    ]
+
+    # messages not forwarded before a stop are forwarded after a restart
+    Client(relay.url, "collector-1", 1).publish_device_message_list(
+        collector_messages(1, 3)
+    )
+    relay.stop(flush=False)
+    relay = RelayServer(upstream.url, api_key="relay-key", directory=directory)
+    assert relay.queue.pending() == 3
+    relay.stop()
+    assert upstream.requests[-1][1] == "Bearer relay-key"
+    assert len(upstream.requests[-1][2]) == 3
+
+    # a full batch is forwarded without waiting for the flush interval
+    relay = RelayServer(
+        upstream.url, api_key="relay-key", batch_size=4, flush_interval=60
+    )
+    relay.start()
+    Client(relay.url, "relay-key", 3).publish_device_message_list(
+        collector_messages(3, 4)
+    )
+    deadline = time.time() + 5
+    while relay.forwarded < 4 and time.time() < deadline:
+        time.sleep(0.01)
+    assert relay.forwarded == 4
+    relay.stop()
+upstream.shutdown()
+upstream.server_close()
@@ -0,0 +1,810 @@
+#!/usr/bin/env python3
+import asyncio, json, os, socketserver, sys, tempfile, threading, time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+PROJECT_ROOT = os.path.dirname(os.path.dirname(os.path.realpath(__file__)))
+sys.path.append(PROJECT_ROOT)
+from hyper_systems.devices import Device, Schema
+from hyper_systems.devices.encoding import EncodedMessages, MessageEncoder
+from hyper_systems.http import Client, PublishError
+from hyper_systems.http.client import AsyncClient
+from hyper_systems.http.adaptive import AdaptiveController, AdaptivePublisher
+from hyper_systems.http.breaker import (
+    CircuitBreaker,
+    CircuitOpenError,
+    FailoverClient,
+    LocalBuffer,
+)
+from hyper_systems.http.dedup import MessageDeduplicator
+from hyper_systems.http.downlink import (
+    DownlinkReceiver,
+    MessageStreamDecoder,
+    ReceiveError,
+)
+from hyper_systems.http.multisite import MultiSiteClient
+from hyper_systems.http.ratelimit import RateLimiter, SharedTokenBucket, TokenBucket
+from hyper_systems.http.transport import (
+    AsyncMemoryTransport,
+    AsyncUnixSocketTransport,
+    FileTransport,
+    MemoryTransport,
+    UnixSocketTransport,
+)
+
+SCHEMA_FILE = os.path.join(PROJECT_ROOT, "./tests/hyper_device_schema_12.json")
+
+
+class StubServer(ThreadingHTTPServer):
+    """
+    A local stand-in for the Hyper API that records the published messages and
+    answers with the queued statuses (200 once the queue is empty), after
+    `delay` seconds.
+    """
+
+    daemon_threads = True
+
+    def __init__(self):
+        super().__init__(("127.0.0.1", 0), StubHandler)
+        self.requests = []
+        self.statuses = []
+        self.delay = 0
+        self.max_body = None
+        self.downlink = []
+        self.downlink_paths = []
+        self.thread = threading.Thread(target=self.serve_forever, daemon=True)
+        self.thread.start()
+
+    def stream(self, *chunks, delay=0.0, status=200, headers=None):
+        """
+        Queues a downlink response, sent as a chunked body.
+        """
+        self.downlink.append((status, headers or {}, chunks, delay))
+
+    @property
+    def url(self):
+        return "http://127.0.0.1:%d/api/" % self.server_address[1]
+
+    @property
+    def messages(self):
+        return [m for (_path, body) in self.requests for m in json.loads(body)]
+
+    def stop(self):
+        self.shutdown()
+        self.server_close()
+
+
+class StubHandler(BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"
+
+    def do_POST(self):
+        body = self.rfile.read(int(self.headers["Content-Length"]))
+        time.sleep(self.server.delay)
+        status = self.server.statuses.pop(0) if self.server.statuses else 200
+        if self.server.max_body is not None and len(body) > self.server.max_body:
+            status = 413
+        if status == 200:
+            self.server.requests.append((self.path, body))
+        self.send_response(status)
+        self.send_header("Content-Length", "0")
+        self.end_headers()
+
+    def do_GET(self):
+        self.server.downlink_paths.append(self.path)
+        if not self.server.downlink:
+            self.send_response(204)
+            self.send_header("Content-Length", "0")
+            self.end_headers()
+            return
+        (status, headers, chunks, delay) = self.server.downlink.pop(0)
+        self.send_response(status)
+        self.send_header("Transfer-Encoding", "chunked")
+        for (name, value) in headers.items():
+            self.send_header(name, value)
+        self.end_headers()
+        for chunk in chunks:
+            self.wfile.write(b"%x\r\n%s\r\n" % (len(chunk), chunk))
+            self.wfile.flush()
+            time.sleep(delay)
+        self.wfile.write(b"0\r\n\r\n")
+
+    def log_message(self, *args):
+        pass
+
+
+server = StubServer()
+schema = Schema.load(SCHEMA_FILE)
+device = Device.from_schema(schema, device_id="DE:AD:BE:EF:FF:00")
+
+# reading the message twice gives the same message
+device.uptime_ms_5 = 100
+message = device.message
+assert device.message["message_uuid"] == message["message_uuid"]
+device.uptime_ms_5 = 200
+assert device.message["message_uuid"] != message["message_uuid"]
+
+# duplicate messages are dropped before publishing
+client = Client(server.url, "key", 1, deduplicator=MessageDeduplicator())
+client.publish_device_message(device.message)
+client.publish_device_message(device.message)
+client.publish_device_message_list([device.message, device.message])
+assert len(server.requests) == 1
+assert server.requests[0][0] == "/api/sites/1/device_messages/v3/incoming"
+assert client.deduplicator.dropped == 3
+
+# keyed values changed in place are published in a new message
+keyed_device = Device.from_schema(
+    Schema.load(os.path.join(PROJECT_ROOT, "./tests/hyper_device_schema_91.json")),
+    "KEYED-1",
+)
+materials = keyed_device.temperature_by_material_0
+materials["steel"] = 20.0
+client.publish_device_message(keyed_device.message)
+materials["steel"] = 25.0
+client.publish_device_message(keyed_device.message)
+assert [m["values"]["0"] for m in server.messages[1:]] == [
+    {"steel": 20.0},
+    {"steel": 25.0},
+]
+del server.requests[1:]
+
+# failed messages can be published again, retries resend the same message
+device.uptime_ms_5 = 300
+server.statuses = [400]
+try:
+    client.publish_device_message(device.message)
+    assert False
+except Exception as err:
+    assert "'status': 400" in err.args[0]
+client.retries = 2
+client.retry_backoff = 0
+server.statuses = [503, 429]
+client.publish_device_message(device.message)
+assert [m["values"]["5"] for m in server.messages] == [200, 300]
+
+# encoded lists are deduplicated too, with the uuids of the device messages
+del server.requests[:]
+dropped = client.deduplicator.dropped
+encoder = MessageEncoder()
+body = encoder.encode_list([device])
+assert body.message_uuids == [device.message["message_uuid"]]
+assert encoder.encode_list([device]) == body
+client.publish_device_message_list(body)
+client.publish_device_message_list(bytes(body))
+client.publish_device_message(device.message)
+assert server.requests == [] and client.deduplicator.dropped == dropped + 3
+device.uptime_ms_5 = 301
+client.publish_device_message_list(bytes(encoder.encode_list([device])))
+assert len(server.requests) == 1 and client.deduplicator.dropped == dropped + 3
+assert device.message["message_uuid"] in client.deduplicator
+del server.requests[:]
+
+# accepted counts are positions in the published list, duplicates included
+transport = MemoryTransport(statuses=[200, 200, 500])
+backlog = [
+    {"message_uuid": str(i), "created_time": "", "values": {"5": i}} for i in range(4)
+]
+client = Client(
+    "http://localhost/api",
+    "key",
+    1,
+    deduplicator=MessageDeduplicator(),
+    transport=transport,
+    max_body_bytes=len(json.dumps(backlog[:1]).replace(" ", "")),
+)
+client.publish_device_message(backlog[0])
+try:
+    client.publish_device_message_list(backlog)
+    assert False
+except PublishError as err:
+    assert err.status == 500 and err.accepted == 2
+assert transport.messages == backlog[:2]
+transport.statuses = [500]
+try:
+    client.publish_device_message_list(json.dumps(backlog).encode())
+    assert False
+except PublishError as err:
+    assert err.accepted == 2
+
+# deduplicated uuids expire after the window
+now = [0.0]
+deduplicator = MessageDeduplicator(window=10, max_size=2, clock=lambda: now[0])
+assert deduplicator.claim([{"message_uuid": "a"}, {"message_uuid": "a"}]) == [
+    {"message_uuid": "a"}
+]
+deduplicator.ack([{"message_uuid": "a"}])
+now[0] = 11.0
+assert deduplicator.claim([{"message_uuid": "a"}]) == [{"message_uuid": "a"}]
+deduplicator.claim([{"message_uuid": "b"}, {"message_uuid": "c"}])
+assert len(deduplicator) == 2 and "a" not in deduplicator
+
+# adaptive batch sizing grows batches while the API is fast
+del server.requests[:]
+client = Client(server.url, "key", 1)
+controller = AdaptiveController(batch_size=10, batch_increase=10, target_latency=0.5)
+publisher = AdaptivePublisher(client, controller)
+messages = [
+    {"message_uuid": str(i), "created_time": "", "values": {"5": i}} for i in range(300)
+]
+assert publisher.publish(messages) == 300
+assert sorted(m["values"]["5"] for m in server.messages) == list(range(300))
+assert controller.batch_size > 10 and controller.concurrency > 1
+
+# and backs off when requests are throttled or slow
+concurrency = controller.concurrency
+server.statuses = [429]
+assert publisher.publish(messages[:1]) == 1
+assert controller.setpoints["throttled"] == 1
+assert controller.concurrency == max(1, concurrency // 2)
+batch_size = controller.batch_size
+server.delay = 0.6
+publisher.publish(messages[:1])
+server.delay = 0
+assert controller.batch_size == batch_size // 2
+# batches are sent by a fixed pool of workers
+assert len(publisher._workers) == controller.max_concurrency
+workers = list(publisher._workers)
+assert publisher.publish(messages) == 300
+assert publisher._workers == workers and all(t.is_alive() for t in workers)
+
+
+# connection errors are retried after a backoff, and throttled batches after
+# their Retry-After time
+class FlakyClient(object):
+    def __init__(self, errors):
+        self.errors = errors
+        self.times = []
+
+    def publish_device_message_list(self, batch):
+        self.times.append(time.monotonic())
+        if self.errors:
+            raise self.errors.pop(0)
+
+
+flaky = FlakyClient(
+    [ConnectionResetError(), PublishError("url", 429, "", retry_after=0.2)]
+)
+flaky_publisher = AdaptivePublisher(flaky, AdaptiveController(), retry_backoff=0.1)
+assert flaky_publisher.publish(messages[:5]) == 5
+(backoff, retry_after) = [b - a for (a, b) in zip(flaky.times, flaky.times[1:])]
+assert 0.1 <= backoff < 0.2 and 0.2 <= retry_after < 0.3
+flaky.errors = [ValueError("bug")]
+try:
+    flaky_publisher.publish(messages[:5])
+    assert False
+except ValueError:
+    assert len(flaky.times) == 4
+flaky_publisher.close()
+assert flaky_publisher._workers == []
+
+# buffered publishing from a background thread
+del server.requests[:]
+publisher.start(interval=0.05)
+for message in messages[:20]:
+    publisher.submit(message)
+time.sleep(0.3)
+publisher.submit(messages[20])
+publisher.stop()
+assert len(server.messages) == 21
+
+# token buckets refill at their rate, up to their capacity
+now = [0.0]
+waits = []
+
+
+def fake_sleep(seconds):
+    waits.append(seconds)
+    now[0] += seconds
+
+
+bucket = TokenBucket(10, capacity=5, clock=lambda: now[0], sleep=fake_sleep)
+assert all(bucket.try_acquire() for _ in range(5))
+assert not bucket.try_acquire()
+assert bucket.acquire(2)
+assert abs(sum(waits) - 0.2) < 1e-9
+assert not bucket.acquire(5, timeout=0.1)
+now[0] += 10
+assert bucket.tokens == 5
+bucket.penalize(2)
+assert not bucket.try_acquire()
+now[0] += 2.2
+assert bucket.try_acquire()
+
+# requests larger than the capacity pay for all their tokens
+bucket = TokenBucket(100, clock=lambda: now[0], sleep=fake_sleep)
+start = now[0]
+for _ in range(10):
+    assert bucket.acquire(1000)
+assert bucket.tokens < 0 and not bucket.try_acquire()
+assert bucket.acquire()
+assert abs(now[0] - start - 99.01) < 1e-6
+
+# rate limited clients are throttled per site and per API key
+limiter = RateLimiter(rate=20, capacity=1, site_rates={2: 1000}, key_rates={"k": 30})
+assert len(limiter.buckets(1, "key")) == 1 and len(limiter.buckets(1, "k")) == 2
+assert limiter.buckets(1, "key")[0] is not limiter.buckets(2, "key")[0]
+del server.requests[:]
+client = Client(server.url, "key", 1, rate_limiter=limiter)
+start = time.monotonic()
+for i in range(5):
+    client.publish_device_message_list(messages[i : i + 1])
+assert time.monotonic() - start >= 0.15
+assert len(server.requests) == 5
+
+# a 429 response pauses the site for its Retry-After time
+client.retries = 1
+client.retry_backoff = 0
+server.statuses = [429]
+start = time.monotonic()
+client.publish_device_message_list(messages[:1])
+assert time.monotonic() - start >= 0.9
+
+# messages limits count the messages of encoded bodies too
+limiter = RateLimiter(rate=100, capacity=100, unit="messages")
+client = Client(server.url, "key", 1, rate_limiter=limiter)
+client.publish_device_message_list(json.dumps(messages[:40]).encode())
+assert limiter.buckets(1, "key")[0].tokens < 61
+limiter = RateLimiter(rate=1, capacity=100, unit="messages")
+client = Client(server.url, "key", 1, rate_limiter=limiter)
+keyed = dict(messages[0], values={"0": {"message_uuid": 1.0}})
+client.publish_device_message_list(json.dumps([keyed, messages[1]]).encode())
+assert 98 <= limiter.buckets(1, "key")[0].tokens < 99
+body = EncodedMessages(json.dumps([keyed] * 3).encode())
+body.message_uuids = ["a", "b", "c"]
+client.publish_device_message_list(body)
+assert 95 <= limiter.buckets(1, "key")[0].tokens < 96
+
+# shared buckets are seen by every process of the host
+if sys.version_info >= (3, 8):
+    import subprocess
+
+    name = "hyper_test_%d" % os.getpid()
+    shared = SharedTokenBucket(name, 1, capacity=3)
+    subprocess.check_call(
+        [
+            sys.executable,
+            "-c",
+            "from hyper_systems.http.ratelimit import SharedTokenBucket\n"
+            "assert SharedTokenBucket(%r, 1, capacity=3).try_acquire(6)" % name,
+        ],
+        cwd=PROJECT_ROOT,
+    )
+    assert not shared.try_acquire() and shared.tokens < -2
+    shared.close()
+    shared.unlink()
+
+# multi-site publishing schedules sites round-robin over shared connections
+del server.requests[:]
+multisite = MultiSiteClient(server.url, "key", api_keys={3: "other"}, workers=1)
+errors = multisite.publish_many(
+    [(1, messages[i : i + 1]) for i in range(4)]
+    + [(2, messages[:1]), (3, messages[:1])]
+)
+assert errors == [] and multisite.published == 6
+sites = [path.split("/")[3] for (path, _body) in server.requests]
+assert sites[:3] == ["1", "2", "3"] and sites[3:] == ["1", "1", "1"]
+assert multisite.client(3).api_key == "other"
+assert (
+    multisite.client(1)._get_incoming_url() is multisite.client(1)._get_incoming_url()
+)
+assert len(multisite.pool._idle) == 1
+
+# failed lists are reported per site
+server.statuses = [400]
+errors = multisite.publish_many({5: messages[:1]})
+assert [(site_id, e.status) for (site_id, e) in errors] == [(5, 400)]
+# only the errors of the lists of the call are returned
+server.statuses = [400]
+multisite.submit(6, messages[:1])
+multisite.join()
+errors = multisite.publish_many({5: messages[:1]})
+assert errors == [] and [site_id for (site_id, e) in multisite.errors] == [6]
+server.statuses = [400]
+errors = multisite.publish_many({5: messages[:1]})
+assert len(errors) == 1 and len(multisite.pop_errors()) == 1
+multisite.close()
+try:
+    multisite.submit(1, messages[:1])
+    assert False
+except RuntimeError:
+    pass
+
+# downlink messages are decoded incrementally
+decoder = MessageStreamDecoder()
+assert decoder.feed(b'[{"a": 1}, {"b"') == [{"a": 1}]
+assert decoder.feed(b': "\xc3') == []
+assert decoder.feed(b'\xa9"}]\n{"c": 2}\n[{"d": 3}]') == [
+    {"b": "\u00e9"},
+    {"c": 2},
+    {"d": 3},
+]
+decoder.close()
+decoder.feed(b'{"a": ')
+try:
+    decoder.close()
+    assert False
+except ValueError:
+    pass
+
+# and dispatched to the devices as soon as they arrive
+received = []
+device.on_publish_interval_s_6_update = lambda value: received.append(
+    (value, time.monotonic())
+)
+receiver = DownlinkReceiver(server.url, "key", 1, devices=[device], wait=1)
+downlink = lambda value: (
+    b'{"vendor_device_id": "DE:AD:BE:EF:FF:00", "values": {"6": %d}}' % value
+)
+server.stream(
+    b"[" + downlink(10)[:20],
+    downlink(10)[20:] + b",",
+    downlink(20) + b"]",
+    delay=0.2,
+    headers={"X-Cursor": "abc"},
+)
+start = time.monotonic()
+assert receiver.poll() == 2
+assert [value for (value, _t) in received] == [10, 20]
+assert received[0][1] - start < time.monotonic() - start - 0.2
+assert device.publish_interval_s_6 == 20 and receiver.cursor == "abc"
+
+# messages that cannot be dispatched are skipped, and the cursor moves on
+errors = []
+receiver.on_error = lambda messages, error: errors.append((messages, error))
+server.stream(
+    b'[{"vendor_device_id": "unknown", "values": {"6": 1}},'
+    + downlink(15)
+    + b',{"vendor_device_id": "DE:AD:BE:EF:FF:00", "values": {"6": "x"}}]',
+    headers={"X-Cursor": "abd"},
+)
+assert receiver.poll() == 3 and receiver.cursor == "abd"
+assert device.publish_interval_s_6 == 15 and receiver.failed == 2
+assert [messages[0]["values"]["6"] for (messages, _e) in errors] == [1, "x"]
+assert "unknown device" in str(errors[0][1])
+server.stream(
+    b'[{"vendor_device_id": "DE:AD:BE:EF:FF:00", "values": 1}]',
+    headers={"X-Cursor": "abc"},
+)
+assert receiver.poll() == 1 and receiver.cursor == "abc"
+assert receiver.failed == 3 and isinstance(receiver.last_error, AttributeError)
+(receiver.on_error, receiver.last_error) = (None, None)
+
+# a large message in many chunks is scanned once
+decoder = MessageStreamDecoder()
+body = json.dumps([{"values": {str(i): 'v\\"}' for i in range(5000)}}]).encode()
+start = time.monotonic()
+decoded = []
+for i in range(0, len(body), 64):
+    decoded += decoder.feed(body[i : i + 64])
+assert time.monotonic() - start < 1.0
+assert decoded == json.loads(body)
+decoder.close()
+
+# empty polls reuse the connection and send the cursor
+assert receiver.poll() == 0
+assert (
+    server.downlink_paths[-1]
+    == "/api/sites/1/device_messages/v3/outgoing?wait=1&cursor=abc"
+)
+server.stream(b"", status=401)
+try:
+    receiver.poll()
+    assert False
+except ReceiveError as err:
+    assert err.status == 401
+
+# a background thread keeps polling
+del received[:]
+server.stream(downlink(30) + b"\n", downlink(40) + b"\n")
+receiver.start()
+time.sleep(0.3)
+receiver.stop()
+assert [value for (value, _t) in received] == [30, 40]
+assert receiver.received == 8 and receiver.last_error is None
+
+# lists are cut to the body size limit at message boundaries
+backfill = [
+    {"message_uuid": "%04d" % i, "created_time": "", "values": {"5": 1000 + i}}
+    for i in range(100)
+]
+size = len(json.dumps(backfill[0], separators=(",", ":")))
+del server.requests[:]
+client = Client(server.url, "key", 1, max_body_bytes=10 * (size + 1) + 1)
+client.publish_device_message_list(backfill)
+assert [len(json.loads(body)) for (_path, body) in server.requests] == [10] * 10
+assert max(len(body) for (_path, body) in server.requests) <= client.max_body_bytes
+
+# lists rejected with a 413 are bisected, and the limit is lowered
+del server.requests[:]
+server.max_body = 30 * (size + 1)
+client = Client(server.url, "key", 1, deduplicator=MessageDeduplicator())
+client.publish_device_message_list(backfill)
+assert [m["values"]["5"] for m in server.messages] == list(range(1000, 1100))
+assert [len(json.loads(body)) for (_path, body) in server.requests] == [25, 25, 25, 25]
+assert client.body_limit == 25 * (size + 1) + 1
+del server.requests[:]
+client.publish_device_message_list(
+    [dict(m, message_uuid="b" + m["message_uuid"][1:]) for m in backfill]
+)
+assert len(server.requests) == 4
+
+# a message too large on its own fails, after the ones before it
+del server.requests[:]
+huge = dict(backfill[0], message_uuid="huge", values={"5": "x" * server.max_body})
+try:
+    client.publish_device_message_list(
+        [dict(m, message_uuid="c" + m["message_uuid"]) for m in backfill[:3]] + [huge]
+    )
+    assert False
+except PublishError as err:
+    assert err.status == 413 and err.accepted == 3
+assert len(server.messages) == 3
+assert "huge" not in client.deduplicator and "c0000" in client.deduplicator
+server.max_body = None
+
+# clients can publish through other transports
+transport = MemoryTransport(statuses=[503])
+client = Client("http://localhost/api", "key", 1, transport=transport, retries=1)
+client.retry_backoff = 0
+client.publish_device_message_list(backfill[:2])
+assert transport.messages == backfill[:2]
+(method, url, headers, _body) = transport.requests[0]
+assert (method, url) == (
+    "POST",
+    "http://localhost/api/sites/1/device_messages/v3/incoming",
+)
+assert headers["Authorization"] == "Bearer key"
+
+with tempfile.TemporaryDirectory() as directory:
+    path = os.path.join(directory, "messages.ndjson")
+    transport = FileTransport(path)
+    client = Client("http://localhost/api", "key", 1, transport=transport)
+    client.publish_device_message_list(backfill[:2])
+    client.publish_device_message_list(json.dumps(backfill[2:3]).encode())
+    transport.close()
+    with open(path) as f:
+        assert [json.loads(line) for line in f] == backfill[:3]
+
+
+class UnixStubServer(socketserver.ThreadingMixIn, socketserver.UnixStreamServer):
+    daemon_threads = True
+
+    def __init__(self, path):
+        super().__init__(path, StubHandler)
+        self.requests = []
+        self.statuses = []
+        self.delay = 0
+        self.max_body = None
+        self.downlink = []
+        self.downlink_paths = []
+        threading.Thread(target=self.serve_forever, daemon=True).start()
+
+
+with tempfile.TemporaryDirectory() as directory:
+    unix_server = UnixStubServer(os.path.join(directory, "agent.sock"))
+    transport = UnixSocketTransport(unix_server.server_address)
+    client = Client("http://localhost/api", "key", 1, transport=transport)
+    client.publish_device_message_list(backfill[:2])
+    client.publish_device_message_list(backfill[2:4])
+    assert [path for (path, _body) in unix_server.requests] == [
+        "/api/sites/1/device_messages/v3/incoming"
+    ] * 2
+    assert len(transport._idle) == 1
+    transport.close()
+
+    async def publish_async():
+        client = AsyncClient(server.url, "key", 2)
+        await client.publish_device_message_list(backfill[:2])
+        await client.publish_device_message(backfill[2])
+        assert len(client.transport._idle[("http", server.url[7:-5])]) == 1
+        # chunked responses are read
+        server.stream(b"[1,", b"2]")
+        response = await client.transport.request(server.url + "sites/2/outgoing")
+        assert (response.status, response.json()) == (200, [1, 2])
+        await client.close()
+
+        transport = AsyncUnixSocketTransport(unix_server.server_address)
+        client = AsyncClient("http://localhost/api", "key", 3, transport=transport)
+        unix_server.max_body = 3 * (size + 1) + 1
+        await client.publish_device_message_list(backfill[:10])
+        sizes = [len(json.loads(body)) for (_path, body) in unix_server.requests[2:]]
+        assert sizes == [2] * 5
+        await client.close()
+
+        transport = AsyncMemoryTransport(statuses=[400])
+        client = AsyncClient("http://localhost/api", "key", 4, transport=transport)
+        try:
+            await client.publish_device_message_list(backfill[:1])
+            assert False
+        except PublishError as err:
+            assert err.status == 400
+        await client.publish_device_message_list(backfill[:1])
+        assert transport.messages == backfill[:1]
+
+        # rate limiters wait without blocking the event loop
+        ticks = []
+
+        async def tick():
+            while True:
+                ticks.append(time.monotonic())
+                await asyncio.sleep(0.01)
+
+        limiter = RateLimiter(rate=20, capacity=1)
+        transport = AsyncMemoryTransport(statuses=[429])
+        client = AsyncClient(
+            "http://localhost/api", "key", 5, None, 1, 0, limiter, transport=transport
+        )
+        assert client.rate_limiter is limiter and client.retries == 1
+        ticker = asyncio.ensure_future(tick())
+        start = time.monotonic()
+        await client.publish_device_message_list(backfill[:1])
+        assert time.monotonic() - start >= 0.9
+        for message in backfill[1:5]:
+            await client.publish_device_message(message)
+        assert time.monotonic() - start >= 1.1 and len(ticks) > 50
+        ticker.cancel()
+        assert transport.messages == backfill[:5]
+
+    del server.requests[:]
+    asyncio.run(publish_async())
+    assert [m["message_uuid"] for m in server.messages] == ["0000", "0001", "0002"]
+    unix_server.shutdown()
+    unix_server.server_close()
+
+# circuits open on the failure rate of their window, and probe after a timeout
+now = [0.0]
+breaker = CircuitBreaker(window=4, min_calls=4, reset_timeout=10, clock=lambda: now[0])
+for success in (True, False, True, False):
+    assert breaker.allow()
+    breaker.record(success)
+assert breaker.state == "open" and not breaker.allow()
+now[0] = 10.0
+assert breaker.state == "half_open"
+assert breaker.allow() and not breaker.allow()
+breaker.record(False)
+assert breaker.state == "open" and breaker.opened == 2
+now[0] = 20.0
+assert breaker.allow()
+breaker.record(True)
+assert breaker.state == "closed" and breaker.failure_ratio == 0.0
+
+# failover publishes to the next healthy endpoint
+transports = {
+    "http://primary/api": MemoryTransport(statuses=[503] * 3),
+    "http://backup/api": MemoryTransport(),
+}
+failover = FailoverClient(
+    list(transports),
+    "key",
+    1,
+    breaker_factory=lambda: CircuitBreaker(
+        window=2, min_calls=2, reset_timeout=10, clock=lambda: now[0]
+    ),
+    transport_factory=transports.get,
+)
+for message in backfill[:3]:
+    failover.publish_device_message(message)
+assert transports["http://backup/api"].messages == backfill[:3]
+assert failover.states == {"http://primary/api": "open", "http://backup/api": "closed"}
+# open circuits are skipped without a request
+failover.publish_device_message(backfill[3])
+assert transports["http://primary/api"].statuses == [503]
+# client errors are raised, without failing over
+transports["http://backup/api"].statuses = [400]
+try:
+    failover.publish_device_message(backfill[4])
+    assert False
+except PublishError as err:
+    assert err.status == 400
+assert failover.states["http://backup/api"] == "closed"
+
+# lists are buffered while every circuit is open, and replayed in order
+transports["http://backup/api"].statuses = [503, 503]
+failover.buffer = LocalBuffer(max_messages=4)
+failover.publish_device_message_list(backfill[5:7])
+failover.publish_device_message_list(backfill[7:9])
+assert failover.states["http://backup/api"] == "open"
+start = time.monotonic()
+failover.publish_device_message_list(backfill[9:10])
+assert time.monotonic() - start < 0.1
+assert failover.diverted == 5 and failover.buffer.dropped == 2
+assert failover.buffer.messages == 3
+del transports["http://primary/api"].statuses[:]
+failover.publish_device_message_list(backfill[10:11])
+assert len(failover.buffer) == 3
+now[0] = 30.0
+failover.publish_device_message_list(backfill[11:12])
+assert len(failover.buffer) == 0
+assert transports["http://primary/api"].messages == backfill[7:12]
+# buffered lists refused by a healthy endpoint are dead-lettered
+transports["http://primary/api"].statuses = [503, 503]
+failover.publish_device_message_list(backfill[12:14])
+failover.publish_device_message_list(backfill[14:15])
+assert len(failover.buffer) == 2
+now[0] = 50.0
+transports["http://primary/api"].statuses = [400]
+failover.publish_device_message_list(backfill[15:16])
+assert len(failover.buffer) == 0 and failover.rejected == 2
+assert [batch for (batch, _error) in failover.dead_letters] == [backfill[12:14]]
+assert failover.dead_letters[0][1].status == 400
+assert transports["http://primary/api"].messages[-2:] == backfill[14:16]
+# without a buffer, lists that no endpoint took are raised
+failover.buffer = None
+for endpoint in transports.values():
+    endpoint.statuses = [503]
+try:
+    failover.publish_device_message_list(backfill[12:14])
+    assert False
+except CircuitOpenError as err:
+    assert err.urls == list(transports) and err.last_error.status == 503
+
+# only the unpublished part of a list is buffered and replayed
+transports = {
+    "http://primary/api": MemoryTransport(statuses=[200, 503]),
+    "http://backup/api": MemoryTransport(statuses=[503]),
+}
+failover = FailoverClient(
+    list(transports),
+    "key",
+    1,
+    buffer=LocalBuffer(),
+    breaker_factory=lambda: CircuitBreaker(
+        window=1, min_calls=1, reset_timeout=10, clock=lambda: now[0]
+    ),
+    transport_factory=transports.get,
+    max_body_bytes=len(json.dumps(backfill[:1]).replace(" ", "")),
+)
+failover.publish_device_message_list(backfill[:3])
+assert failover.buffer.peek() == backfill[1:3] and failover.diverted == 2
+assert failover.buffer.messages == 2
+now[0] = 70.0
+transports["http://primary/api"].statuses = [200, 503]
+transports["http://backup/api"].statuses = [503]
+assert failover.flush_buffer() == 0
+assert failover.buffer.peek() == backfill[2:3] and failover.buffer.messages == 1
+now[0] = 90.0
+assert failover.flush_buffer() == 1 and len(failover.buffer) == 0
+assert transports["http://primary/api"].messages == backfill[:3]
+assert transports["http://backup/api"].messages == []
+
+# slow endpoints time out and fail fast once their circuit is open
+server.delay = 0.3
+failover = FailoverClient(
+    server.url,
+    "key",
+    1,
+    timeout=0.05,
+    buffer=LocalBuffer(),
+    breaker_factory=lambda: CircuitBreaker(window=2, min_calls=2),
+)
+start = time.monotonic()
+for message in backfill[:10]:
+    failover.publish_device_message(message)
+assert time.monotonic() - start < 0.5
+assert failover.states[server.url[:-1]] == "open" and failover.buffer.messages == 10
+server.delay = 0
+failover.close()
+
+# importing the http client loads neither the device schemas nor urllib.request
+import subprocess
+
+loaded = subprocess.check_output(
+    [
+        sys.executable,
+        "-c",
+        "import sys\nfrom hyper_systems.http import Client\nprint(sorted(sys.modules))",
+    ],
+    cwd=PROJECT_ROOT,
+    universal_newlines=True,
+)
+assert "hyper_systems.devices.device_schema_gen" not in loaded
+assert "'urllib.request'" not in loaded and "hyper_systems.http.client" in loaded
+import hyper_systems.http
+
+assert "AsyncClient" in dir(hyper_systems.http)
+try:
+    hyper_systems.http.Missing
+    assert False
+except AttributeError as err:
+    assert err.args[0] == "module 'hyper_systems.http' has no attribute 'Missing'"
+
+server.stop()
@@ -0,0 +1,165 @@
+#!/usr/bin/env python3
+import os, sys, tempfile
+
+PROJECT_ROOT = os.path.dirname(os.path.dirname(os.path.realpath(__file__)))
+sys.path.append(PROJECT_ROOT)
+from hyper_systems.storage import MessageIndex, MessageLog
+
+
+def make_message(i, vendor_device_id="DE:AD:BE:EF:FF:00"):
+    return {
+        "message_uuid": "00000000-0000-0000-0000-%012d" % i,
+        "created_time": "2023-01-01T00:%02d:%02dZ" % (i // 60, i % 60),
+        "vendor_device_id": vendor_device_id,
+        "device_class_id": 12,
+        "values": {"0": 20.5 + i, "5": i * 1000, "3": "abc"},
+    }
+
+
+class RecordingClient:
+    def __init__(self):
+        self.batches = []
+
+    def publish_device_message_list(self, device_message_list):
+        self.batches.append(device_message_list)
+
+
+TMP_DIR = tempfile.mkdtemp()
+LOG_FILE = os.path.join(TMP_DIR, "messages.log")
+
+# append and random access
+log = MessageLog(LOG_FILE)
+for i in range(10):
+    assert log.append(make_message(i)) == i
+assert len(log) == 10
+
+view = log[3]
+assert view.seq == 3
+assert view.vendor_device_id == "DE:AD:BE:EF:FF:00"
+assert view.device_class_id == 12
+assert view.created_time == "2023-01-01T00:00:03Z"
+assert sorted(view.slots) == ["0", "3", "5"]
+assert view[5] == 3000 and view["0"] == 23.5
+assert view.raw(3) == b'"abc"'
+assert view.to_message() == make_message(3)
+assert log[-1].seq == 9
+
+try:
+    log[10]
+    assert False
+except IndexError:
+    pass
+
+# append after mapping
+log.append(make_message(10))
+assert log[10].to_message() == make_message(10)
+
+# time range
+start = log[2].created_epoch
+end = log[5].created_epoch
+assert [v.seq for v in log.between(start, end)] == [2, 3, 4]
+assert [v.seq for v in log.between(end, end + 3600)] == [5, 6, 7, 8, 9, 10]
+assert log._ordered
+
+# out of order appends fall back to scanning the index
+log.append(make_message(3))
+assert [v.seq for v in log.between(start, end)] == [2, 3, 4, 11]
+assert not log._ordered
+log.close()
+os.unlink(LOG_FILE)
+os.unlink(LOG_FILE + ".idx")
+log = MessageLog(LOG_FILE)
+log.extend([make_message(i) for i in range(11)])
+
+# strings longer than their length fields are rejected
+try:
+    log.append(make_message(0, vendor_device_id="x" * 256))
+    assert False
+except ValueError as err:
+    assert "vendor_device_id" in err.args[0]
+# and so are fields of the wrong type or out of range
+for (field, value) in (
+    ("device_class_id", "12"),
+    ("device_class_id", -1),
+    ("values", [1]),
+    ("values", {"65536": 1}),
+    ("values", {"-1": 1}),
+):
+    message = make_message(0)
+    message[field] = value
+    try:
+        log.append(message)
+        assert False
+    except ValueError as err:
+        assert field[:6] in err.args[0] or "slots" in err.args[0]
+assert len(log) == 11
+
+# replay in batches
+client = RecordingClient()
+assert log.replay(client, batch_size=4) == 11
+assert [len(b) for b in client.batches] == [4, 4, 3]
+assert client.batches[1][0] == make_message(4)
+log.close()
+
+# reopen and drop a partially written record
+with open(LOG_FILE, "ab") as f:
+    f.write(b"\x00\x01\x02")
+log = MessageLog(LOG_FILE)
+assert len(log) == 11
+assert log.append(make_message(11)) == 11
+assert log[11].to_message() == make_message(11)
+log.close()
+
+# device and time index
+INDEX_LOG_FILE = os.path.join(TMP_DIR, "indexed.log")
+log = MessageLog(INDEX_LOG_FILE)
+for i in range(20):
+    message = make_message(i, "DEV-%d" % (i % 2))
+    if i % 4 == 0:
+        message["values"] = {"1": 55.0}
+    log.append(message)
+log.append(make_message(1, "DEV-1"))  # out of order
+
+index = MessageIndex.build(log)
+assert sorted(index.devices) == ["DEV-0", "DEV-1"]
+epoch = lambda i: log[i].created_epoch
+assert index.seqs("DEV-1", epoch(1), epoch(6)) == [1, 20, 3, 5]
+assert index.seqs("DEV-0", epoch(4), epoch(12), slots=[1]) == [4, 8]
+assert index.seqs("DEV-0", epoch(4), epoch(12), slots=[5]) == [6, 10]
+assert index.seqs("NOPE") == []
+assert [v.seq for v in index.query("DEV-0", end=epoch(3))] == [0, 2]
+
+# incremental updates and per-slot index
+slot_index = MessageIndex.build(log, slots=True)
+assert slot_index.seqs("DEV-0", epoch(4), epoch(12), slots=[1]) == [4, 8]
+log.append(make_message(30, "DEV-0"))
+assert slot_index.seqs("DEV-0", epoch(12), slots=["5"]) == [14, 18, 21]
+assert index.seqs("DEV-0", epoch(19)) == [21]
+
+# persistence
+slot_index.save()
+log.append(make_message(31, "DEV-0"))
+loaded = MessageIndex.load(log)
+assert loaded.slots and len(loaded) == 23
+assert loaded.seqs("DEV-0", epoch(12), slots=[5]) == [14, 18, 21, 22]
+assert loaded.seqs("DEV-1") == slot_index.seqs("DEV-1")
+log.close()
+
+# corrupted or mismatching index files are rebuilt
+with open(log.path + ".didx", "r+b") as f:
+    f.seek(len(b"HYPDIX1\n") + 9 + 12)
+    f.write(b"\xff" * 4)
+log = MessageLog(INDEX_LOG_FILE)
+rebuilt = MessageIndex.load(log, slots=True)
+assert rebuilt.slots and len(rebuilt) == 23
+assert rebuilt.seqs("DEV-0", epoch(12), slots=[5]) == [14, 18, 21, 22]
+with open(log.path + ".didx", "r+b") as f:
+    f.write(b"garbage!")
+assert not MessageIndex.load(log).slots
+assert MessageIndex.load(log, slots=True).slots
+slot_index = MessageIndex.build(log, slots=True)
+slot_index.save()
+assert not MessageIndex.load(log, slots=False).slots
+os.unlink(log.path + ".didx")
+assert MessageIndex.load(log, slots=True).seqs("DEV-1") == slot_index.seqs("DEV-1")
+log.close()